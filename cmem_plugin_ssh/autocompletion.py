@@ -1,15 +1,101 @@
 """Autocompletion for plugin parameters"""
 
+import contextlib
+import re
+import shlex
 import stat
-from typing import Any, ClassVar
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, ClassVar
 
-import paramiko
 from cmem_plugin_base.dataintegration.context import PluginContext
 from cmem_plugin_base.dataintegration.types import Autocompletion, StringParameterType
-from paramiko import SFTPAttributes, SFTPClient, SSHClient
 
+from cmem_plugin_ssh.connection import (
+    SSH_CONNECTIONS,
+    ConnectionKey,
+    connection_key,
+    open_sftp_session,
+)
+from cmem_plugin_ssh.lazy import paramiko
+from cmem_plugin_ssh.retrieval import FIND_CHUNK_SIZE
 from cmem_plugin_ssh.utils import load_private_key
 
+if TYPE_CHECKING:
+    from paramiko import SFTPClient, SSHClient
+
+LISTING_CACHE_SIZE = 256
+LISTING_CACHE_TTL = 60
+PREFETCH_FOLDERS = 4
+PREFETCH_WORKERS = 2
+PREFETCH_QUEUE_SIZE = 16
+SUGGESTION_LIMIT = 100
+
+# connection and directory as entered, None for the home directory
+ListingKey = tuple[ConnectionKey, str | None]
+# resolved directory and the names of its subfolders, at most SUGGESTION_LIMIT
+Listing = tuple[str, list[str]]
+
+
+class ListingCache:
+    """Least recently used folder listings, each valid for `ttl` seconds"""
+
+    def __init__(self, size: int = LISTING_CACHE_SIZE, ttl: float = LISTING_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._listings: OrderedDict[ListingKey, tuple[Listing, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: ListingKey) -> Listing | None:
+        """Get a listing that is not expired yet"""
+        with self._lock:
+            entry = self._listings.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.monotonic():
+                del self._listings[key]
+                return None
+            self._listings.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: ListingKey, listing: Listing) -> None:
+        """Add a listing, dropping the least recently used one if the cache is full"""
+        with self._lock:
+            self._listings[key] = (listing, time.monotonic() + self.ttl)
+            self._listings.move_to_end(key)
+            if len(self._listings) > self.size:
+                self._listings.popitem(last=False)
+
+    def clear(self) -> None:
+        """Drop all listings"""
+        with self._lock:
+            self._listings.clear()
+
+
+LISTING_CACHE = ListingCache()
+PREFETCH_EXECUTOR = ThreadPoolExecutor(
+    max_workers=PREFETCH_WORKERS, thread_name_prefix="ssh-autocompletion-prefetch"
+)
+PREFETCH_LOCK = threading.Lock()
+PREFETCHING: set[ListingKey] = set()
+
+
+def listing_key(depend_on_parameter_values: list[Any], directory: str | None) -> ListingKey:
+    """Key of the cached listing of a directory for the connection parameters"""
+    return (
+        connection_key(
+            hostname=depend_on_parameter_values[0],
+            port=depend_on_parameter_values[1],
+            username=depend_on_parameter_values[2],
+            authentication_method=depend_on_parameter_values[5],
+            private_key=depend_on_parameter_values[3],
+            password=depend_on_parameter_values[4],
+        ),
+        directory,
+    )
+
 
 def sort_suggestions(suggestions: list[Autocompletion], query_terms: list[str]) -> None:
     """Sort autocompleted suggestions"""
@@ -21,7 +107,62 @@ def sort_suggestions(suggestions: list[Autocompletion], query_terms: list[str])
     )
 
 
-def connect_ssh_client(depend_on_parameter_values: list[Any], ssh_client: SSHClient) -> None:
+def change_directory(sftp: "SFTPClient", directory: str | None) -> str:
+    """Change into a directory and return the filter for the names of its subfolders
+
+    If the directory does not exist, its last segment is taken as part of a folder
+    name: the session changes into the parent and the segment is returned as filter.
+    """
+    try:
+        sftp.chdir(directory)
+    except FileNotFoundError:
+        parent, separator, name_filter = (directory or "").rpartition("/")
+        if name_filter == "":
+            raise
+        sftp.chdir(parent or separator or None)
+        return name_filter
+    return ""
+
+
+def find_folders(
+    ssh_client: "SSHClient", directory: str, name_filter: str, limit: int = SUGGESTION_LIMIT
+) -> list[str] | None:
+    """List up to limit subfolders whose name contains the filter with a remote GNU find
+
+    Only folders are sent and the filter is applied on the server, so the time does not
+    depend on the number of files. The directory itself is printed first as proof that
+    find was run, None is returned if it is not available or failed.
+    """
+    command = f"find {shlex.quote(directory)} -maxdepth 1 -type d"
+    if name_filter:
+        pattern = "*" + re.sub(r"([*?\[\]\\])", r"\\\1", name_filter) + "*"
+        command += f" \\( -samefile {shlex.quote(directory)} -o -iname {shlex.quote(pattern)} \\)"
+    command += " -printf '%d %f\\0'"
+    try:
+        _, stdout, _ = ssh_client.exec_command(command, timeout=20)
+        channel = stdout.channel
+        try:
+            channel.shutdown_write()
+            buffer = b""
+            records: list[bytes] = []
+            while len(records) <= limit:
+                chunk = channel.recv(FIND_CHUNK_SIZE)
+                if not chunk:
+                    if channel.recv_exit_status() != 0:
+                        return None
+                    break
+                *complete, buffer = (buffer + chunk).split(b"\0")
+                records.extend(complete)
+        finally:
+            channel.close()
+    except (paramiko.SSHException, OSError):
+        return None
+    if not records or not records[0].startswith(b"0 "):
+        return None
+    return [record[2:].decode(errors="replace") for record in records[1 : limit + 1]]
+
+
+def connect_ssh_client(depend_on_parameter_values: list[Any], ssh_client: "SSHClient") -> None:
     """Connect to the ssh client with the selected authentication method"""
     if depend_on_parameter_values[5] == "key":
         pw = (
@@ -52,10 +193,17 @@ def connect_ssh_client(depend_on_parameter_values: list[Any], ssh_client: SSHCli
         )
 
 
-def close_connection(sftp: SFTPClient, ssh_client: SSHClient) -> None:
-    """Close SFTP and SSH session connection"""
-    sftp.close()
-    ssh_client.close()
+def open_sftp(
+    depend_on_parameter_values: list[Any], key: ConnectionKey
+) -> "tuple[SSHClient, SFTPClient]":
+    """Open an SFTP session on a pooled connection, or on a new one if there is none"""
+
+    def connect(ssh_client: "SSHClient") -> None:
+        """Authenticate a new connection with the parameter values"""
+        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        connect_ssh_client(depend_on_parameter_values, ssh_client)
+
+    return open_sftp_session(key, connect)
 
 
 class DirectoryParameterType(StringParameterType):
@@ -98,79 +246,102 @@ class DirectoryParameterType(StringParameterType):
     ) -> list[Autocompletion]:
         """Autocomplete the folders"""
         _ = context
-        result = []
         entered_directory = "".join(query_terms)
         selected_path = depend_on_parameter_values[6]
+        if selected_path != "" and entered_directory == "":
+            return self.suggestions
 
-        ssh_client = paramiko.SSHClient()
-        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())  # noqa: S507
-        connect_ssh_client(depend_on_parameter_values, ssh_client)
-
-        sftp = ssh_client.open_sftp()
-
-        if selected_path == "":
-            sftp.chdir(None)
-            files_and_folders = self.list_folders(sftp)
-            folders = [
-                f.filename
-                for f in files_and_folders
-                if f.st_mode is not None and stat.S_ISDIR(f.st_mode)
-            ]
-            current_dir = sftp.normalize(".")
-            result = [
-                Autocompletion(
-                    value=current_dir + "/" + f if current_dir != "/" else "/" + f,
-                    label=current_dir + "/" + f if current_dir != "/" else "/" + f,
-                )
-                for f in folders
-            ]
-            sort_suggestions(result, query_terms)
-            result.append(Autocompletion(value=current_dir, label=current_dir))
-            parent_dir = (
-                current_dir.rsplit("/", 1)[0] or "/" if not current_dir.endswith("/") else "/"
+        current_dir, folders = self.list_directory(
+            depend_on_parameter_values, entered_directory if selected_path != "" else None
+        )
+        result = [
+            Autocompletion(
+                value=current_dir + "/" + f if current_dir != "/" else "/" + f,
+                label=current_dir + "/" + f if current_dir != "/" else "/" + f,
             )
+            for f in folders
+        ]
+        sort_suggestions(result, query_terms)
+        self.prefetch(depend_on_parameter_values, [r.value for r in result[:PREFETCH_FOLDERS]])
+        result.append(Autocompletion(value=current_dir, label=current_dir))
+        parent_dir = current_dir.rsplit("/", 1)[0] or "/" if not current_dir.endswith("/") else "/"
+        if current_dir != "/":
             result.append(Autocompletion(value=parent_dir, label=parent_dir))
-            self.suggestions = result
-            close_connection(sftp, ssh_client)
-            return self.suggestions
+        self.suggestions = result
+        return self.suggestions
 
-        if selected_path != "" and entered_directory == "":
-            close_connection(sftp, ssh_client)
-            return self.suggestions
+    def list_directory(
+        self, depend_on_parameter_values: list[Any], directory: str | None
+    ) -> Listing:
+        """Resolve a directory and list its subfolders, from the cache if listed recently
+
+        The home directory is listed if directory is None. Connections are taken from
+        and returned to the SSH connection pool, failed listings are not cached.
+        """
+        key = listing_key(depend_on_parameter_values, directory)
+        listing = LISTING_CACHE.get(key)
+        if listing is not None:
+            return listing
 
-        if entered_directory:
-            sftp.chdir(entered_directory)
-            files_and_folders = self.list_folders(sftp)
-            folders = [
-                f.filename
-                for f in files_and_folders
-                if f.st_mode is not None and stat.S_ISDIR(f.st_mode)
-            ]
+        ssh_client, sftp = open_sftp(depend_on_parameter_values, key[0])
+        try:
+            name_filter = change_directory(sftp, directory)
             current_dir = sftp.normalize(".")
-            result = [
-                Autocompletion(
-                    value=current_dir + "/" + f if current_dir != "/" else "/" + f,
-                    label=current_dir + "/" + f if current_dir != "/" else "/" + f,
-                )
-                for f in folders
-            ]
-            sort_suggestions(result, query_terms)
-            result.append(Autocompletion(value=current_dir, label=current_dir))
-            parent_dir = (
-                current_dir.rsplit("/", 1)[0] or "/" if not current_dir.endswith("/") else "/"
-            )
-            if sftp.getcwd() != "/":
-                result.append(Autocompletion(value=parent_dir, label=parent_dir))
-            self.suggestions = result
-            close_connection(sftp, ssh_client)
-            return self.suggestions
+            folders = find_folders(ssh_client, current_dir, name_filter)
+            if folders is None:
+                folders = self.list_folders(sftp, name_filter)
+        finally:
+            sftp.close()
+            SSH_CONNECTIONS.checkin(key[0], ssh_client)
 
-        return self.suggestions
+        listing = (current_dir, folders)
+        LISTING_CACHE.put(key, listing)
+        return listing
+
+    def prefetch(self, depend_on_parameter_values: list[Any], directories: list[str]) -> None:
+        """List the top suggested subfolders in the background to answer the next query
+
+        At most `PREFETCH_WORKERS` listings run at the same time, directories that are
+        cached or already queued are skipped, and nothing is queued beyond
+        `PREFETCH_QUEUE_SIZE` pending listings.
+        """
+        for directory in directories:
+            key = listing_key(depend_on_parameter_values, directory)
+            if LISTING_CACHE.get(key) is not None:
+                continue
+            with PREFETCH_LOCK:
+                if key in PREFETCHING or len(PREFETCHING) >= PREFETCH_QUEUE_SIZE:
+                    continue
+                PREFETCHING.add(key)
+            PREFETCH_EXECUTOR.submit(self.prefetch_listing, depend_on_parameter_values, key)
+
+    def prefetch_listing(self, depend_on_parameter_values: list[Any], key: ListingKey) -> None:
+        """Cache the listing of a directory, errors are left to the query for it"""
+        try:
+            # a separate instance, so the suggestions of this one are not changed on errors
+            with contextlib.suppress(Exception):
+                DirectoryParameterType(self.url_expand, self.display_name).list_directory(
+                    depend_on_parameter_values, key[1]
+                )
+        finally:
+            with PREFETCH_LOCK:
+                PREFETCHING.discard(key)
 
-    def list_folders(self, sftp: SFTPClient) -> list[SFTPAttributes]:
-        """List folders from given SFTP client"""
+    def list_folders(
+        self, sftp: "SFTPClient", name_filter: str = "", limit: int = SUGGESTION_LIMIT
+    ) -> list[str]:
+        """List up to limit subfolders whose name contains the filter from given SFTP client"""
+        folders: list[str] = []
         try:
-            files_and_folders = sftp.listdir_attr()
+            for item in sftp.listdir_iter():
+                if (
+                    item.st_mode is not None
+                    and stat.S_ISDIR(item.st_mode)
+                    and name_filter.lower() in item.filename.lower()
+                ):
+                    folders.append(item.filename)
+                    if len(folders) >= limit:
+                        break
         except (paramiko.ChannelException, OSError, paramiko.SFTPError) as e:
             current_dir = sftp.normalize(".")
             parent_dir = (
@@ -178,4 +349,4 @@ class DirectoryParameterType(StringParameterType):
             )
             self.suggestions = [Autocompletion(value=parent_dir, label=parent_dir)]
             raise ValueError(f"Unable to list folder items at '{current_dir or '.'}': {e}") from e
-        return files_and_folders
+        return folders
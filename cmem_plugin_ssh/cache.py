@@ -0,0 +1,129 @@
+"""Persistent local cache of downloaded files"""
+
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+CACHE_VERSION = 1
+INDEX_NAME = "index.json"
+
+
+class TransferCache:
+    """Downloaded files by host and remote path, reused while size and mtime match
+
+    Every file is stored in a folder named by a hash of the host and remote path, under
+    its original name. The index maps the hash to the name, size and modification time
+    of the remote file, ordered from the least to the most recently used file. An entry
+    is only added once its file is completely downloaded, a file with a changed size or
+    modification time is downloaded again. Files used least recently are evicted once
+    the cache holds more than `max_size` bytes, except files used in the current run.
+    """
+
+    def __init__(self, directory: str | Path, host: str, max_size: int):
+        self.directory = Path(directory)
+        self.host = host
+        self.max_size = max_size
+        self.entries: dict[str, list] = self._load()
+        self.total = sum(entry[1] or 0 for entry in self.entries.values())
+        self.used: set[str] = set()
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict[str, list]:
+        """Load the index of the cache, an empty one if there is none"""
+        try:
+            data = json.loads((self.directory / INDEX_NAME).read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            raise ValueError(f"Unable to read cache index in '{self.directory}': {e}") from e
+        if data.get("version") != CACHE_VERSION:
+            return {}
+        entries: dict[str, list] = data["entries"]
+        return entries
+
+    def key(self, remote_path: str) -> str:
+        """Hash of the host and remote path of a file"""
+        return hashlib.sha256(f"{self.host}\0{remote_path}".encode()).hexdigest()
+
+    def local_path(self, remote_path: str) -> Path:
+        """Path a file is downloaded to and cached at"""
+        folder = self.directory / self.key(remote_path)
+        folder.mkdir(parents=True, exist_ok=True)
+        return folder / Path(remote_path).name
+
+    def lookup(self, remote_path: str, size: int | None, mtime: int | None) -> Path | None:
+        """Return the cached file of an unchanged remote file, None if it has to be downloaded"""
+        key = self.key(remote_path)
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            local_path = Path(self.directory, key, entry[0])
+            if entry[1:] != [size, mtime] or not self._complete(local_path, size):
+                self._remove(key)
+                return None
+            self._use(key, self.entries.pop(key))
+            return local_path
+
+    def add(self, remote_path: str, size: int | None, mtime: int | None, local_path: Path) -> None:
+        """Add a completely downloaded file and evict files beyond the size limit"""
+        key = self.key(remote_path)
+        with self._lock:
+            if key in self.entries:
+                self._remove(key)
+            self._use(key, [local_path.name, size, mtime])
+            self.total += size or 0
+            if self.total > self.max_size:
+                self._evict()
+
+    @staticmethod
+    def _complete(local_path: Path, size: int | None) -> bool:
+        """Check whether a cached file still exists with its size"""
+        try:
+            return local_path.stat().st_size == size
+        except OSError:
+            return False
+
+    def _use(self, key: str, entry: list) -> None:
+        """Put an entry at the most recently used end, the caller holds the lock"""
+        self.entries[key] = entry
+        self.used.add(key)
+
+    def _evict(self) -> None:
+        """Remove the least recently used files beyond the size limit, the caller holds the lock"""
+        evicted = []
+        excess = self.total - self.max_size
+        for key, entry in self.entries.items():
+            # the files used in this run are at the end
+            if excess <= 0 or key in self.used:
+                break
+            evicted.append(key)
+            excess -= entry[1] or 0
+        for key in evicted:
+            self._remove(key)
+            shutil.rmtree(self.directory / key, ignore_errors=True)
+
+    def _remove(self, key: str) -> None:
+        """Remove an entry from the index, the caller holds the lock"""
+        entry = self.entries.pop(key)
+        self.total -= entry[1] or 0
+
+    def save(self) -> None:
+        """Replace the index of the cache"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            data = json.dumps({"version": CACHE_VERSION, "entries": self.entries})
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=f".{INDEX_NAME}.")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as file:
+                file.write(data)
+            Path(temp_path).replace(self.directory / INDEX_NAME)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                Path(temp_path).unlink()
+            raise
@@ -0,0 +1,536 @@
+"""Pooled SSH connection resources"""
+
+import contextlib
+import hashlib
+import itertools
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from types import TracebackType
+from typing import TYPE_CHECKING
+
+from cmem_plugin_base.dataintegration.parameter.password import Password
+
+from cmem_plugin_ssh.lazy import paramiko
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterator, Sequence
+
+    from paramiko import SFTPClient, SSHClient
+
+OPEN_RETRIES = 3
+OPEN_RETRY_DELAY = 0.5
+GROWTH_ROUNDS = 4
+
+MAX_CONNECTIONS_PER_HOST = 16
+MAX_IDLE_PER_HOST = 4
+IDLE_TIMEOUT = 300
+KEEPALIVE_INTERVAL = 30
+CONNECT_WAIT = 60
+
+PROBE_TIMEOUT = 20
+PROBE_POLL_INTERVAL = 0.05
+
+
+class SFTPChannelPool:
+    """Bounded pool of SFTP channels on the transports of one or more SSH clients
+
+    Channels are opened on demand up to `limit`, handed out with `checkout` and
+    returned with `checkin`. A channel that is closed or whose transport is no longer
+    active is dropped on checkin or checkout and replaced by a new one.
+
+    The limit adapts to the sessions the server allows: if it refuses to open another
+    channel, the limit drops to the channels already open and the caller waits for one
+    of them instead of failing. After `GROWTH_ROUNDS` rounds of checkins at the current
+    limit, it grows by one again, up to `max_size`. Only if not even a single channel
+    can be opened, opening is retried `OPEN_RETRIES` times with increasing delay.
+
+    With further SSH clients given as `transports`, new channels are opened on the
+    client with the fewest channels, so the packet handling and encryption of each
+    transport is shared by fewer channels.
+
+    With `connect`, a client whose transport was lost is replaced by a new connection
+    from it, opened by the first thread that fails to open a channel on the client, up
+    to `OPEN_RETRIES` times per checkout. The caller owns and closes the new clients.
+
+    Closing the pool closes all idle channels and every channel checked in afterward.
+    """
+
+    def __init__(
+        self,
+        ssh_client: "SSHClient",
+        max_size: int,
+        transports: "Sequence[SSHClient]" = (),
+        connect: "Callable[[], SSHClient] | None" = None,
+    ):
+        if max_size < 1:
+            raise ValueError("The SFTP channel pool needs a maximum size of at least 1")
+        self.ssh_client = ssh_client
+        self.ssh_clients = [ssh_client, *transports]
+        self._channels = [0] * len(self.ssh_clients)  # open and reserved per client
+        self._owners: dict[SFTPClient, int] = {}
+        self._connect = connect
+        self._connect_lock = threading.Lock()
+        self.max_size = max_size
+        self.limit = max_size
+        self._successes = 0
+        self._idle: deque[SFTPClient] = deque()
+        self._open = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._tickets = itertools.count()
+        self._waiting: deque[int] = deque()
+
+    def __enter__(self) -> "SFTPChannelPool":
+        """Use the pool as context manager, closing it on exit"""
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        """Close the pool"""
+        self.close()
+
+    @property
+    def size(self) -> int:
+        """Number of open channels, idle and checked out"""
+        return self._open
+
+    @staticmethod
+    def is_healthy(client: "SFTPClient") -> bool:
+        """Check whether a channel is still open on an active transport"""
+        channel = client.get_channel()
+        if channel is None or channel.closed:
+            return False
+        transport = channel.get_transport()
+        return transport is not None and transport.is_active()
+
+    def transport_active(self, index: int = 0) -> bool:
+        """Check whether the SSH transport of a client is still active"""
+        transport = self.ssh_clients[index].get_transport()
+        return transport is not None and transport.is_active()
+
+    def checkout(self) -> "SFTPClient":
+        """Take an idle channel, open a new one or wait until one is checked in"""
+        attempt = 0
+        while True:
+            taken = self._take_or_reserve()
+            if not isinstance(taken, int):
+                return taken
+            try:
+                client = self.ssh_clients[taken].open_sftp()
+            except paramiko.SSHException:
+                # concurrent refusals may surface as SSHException instead of ChannelException
+                if not self.transport_active(taken):
+                    self._release(taken)
+                    if attempt >= OPEN_RETRIES or not self._reconnect(taken):
+                        raise
+                    attempt += 1
+                    continue
+                if not self._refused(taken, attempt):
+                    raise
+                attempt += 1
+            except BaseException:
+                self._release(taken)
+                raise
+            else:
+                with self._condition:
+                    self._owners[client] = taken
+                return client
+
+    def checkin(self, client: "SFTPClient") -> None:
+        """Return a checked out channel, close it if it is broken or the pool is closed"""
+        with self._condition:
+            if self._closed or not self.is_healthy(client):
+                self._discard(client)
+            else:
+                self._idle.append(client)
+                self._grow()
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def channel(self) -> "Iterator[SFTPClient]":
+        """Check out a channel for the duration of the context"""
+        client = self.checkout()
+        try:
+            yield client
+        finally:
+            self.checkin(client)
+
+    def close(self) -> None:
+        """Close all idle channels and every channel that is checked in later"""
+        with self._condition:
+            self._closed = True
+            while self._idle:
+                self._discard(self._idle.pop())
+            self._condition.notify_all()
+
+    def _take_or_reserve(self) -> "SFTPClient | int":
+        """Take a healthy idle channel, or reserve the place for a new one on a client
+
+        The index of the SSH client with the fewest channels is returned for a new one.
+
+        Waiting threads are served in order of arrival, so a thread that checks a
+        channel in and out again right away does not starve the others.
+        """
+        with self._condition:
+            ticket = next(self._tickets)
+            self._waiting.append(ticket)
+            try:
+                while True:
+                    if self._closed:
+                        raise ValueError("The SFTP channel pool is closed")
+                    if self._waiting[0] == ticket:
+                        while self._idle:
+                            client = self._idle.pop()
+                            if self.is_healthy(client):
+                                return client
+                            self._discard(client)
+                        if self._open < self.limit:
+                            self._open += 1
+                            index = self._channels.index(min(self._channels))
+                            self._channels[index] += 1
+                            return index
+                    self._condition.wait()
+            finally:
+                self._waiting.remove(ticket)
+                self._condition.notify_all()
+
+    def _reconnect(self, index: int) -> bool:
+        """Replace a client with a lost transport by a new one, return False without `connect`
+
+        Threads failing on the same client wait for the first one to replace it. The new
+        client is only used once it is authenticated.
+        """
+        if self._connect is None:
+            return False
+        with self._connect_lock:
+            if not self.transport_active(index):
+                self.ssh_clients[index] = self._connect()
+        return True
+
+    def _release(self, index: int) -> None:
+        """Free a place reserved for a channel that could not be opened"""
+        with self._condition:
+            self._open -= 1
+            self._channels[index] -= 1
+            self._condition.notify_all()
+
+    def _refused(self, index: int, attempt: int) -> bool:
+        """Shrink the limit after the server refused a channel, return whether to retry"""
+        with self._condition:
+            self._open -= 1
+            self._channels[index] -= 1
+            self._successes = 0
+            self._condition.notify_all()
+            if self._open > 0:
+                # the server limits the sessions, continue with the channels it accepted
+                self.limit = self._open
+                return True
+            self.limit = 1
+        if attempt >= OPEN_RETRIES:
+            return False
+        # the sessions are used elsewhere, wait for one to be released
+        time.sleep(OPEN_RETRY_DELAY * 2**attempt)
+        return True
+
+    def _grow(self) -> None:
+        """Raise the limit by one after some rounds without refusal, the caller holds the lock"""
+        self._successes += 1
+        if self.limit < self.max_size and self._successes >= self.limit * GROWTH_ROUNDS:
+            self.limit += 1
+            self._successes = 0
+
+    def _discard(self, client: "SFTPClient") -> None:
+        """Close a channel and free its place in the pool, the caller holds the lock"""
+        self._open -= 1
+        index = self._owners.pop(client, None)
+        if index is not None:
+            self._channels[index] -= 1
+        with contextlib.suppress(OSError, EOFError, paramiko.SSHException):
+            client.close()
+
+
+# hostname, port, username and fingerprint of the credentials
+ConnectionKey = tuple[str, int, str, str]
+
+
+def connection_key(  # noqa: PLR0913
+    hostname: str,
+    port: int,
+    username: str,
+    authentication_method: str,
+    private_key: str | Password,
+    password: str | Password,
+) -> ConnectionKey:
+    """Key of pooled connections, the credentials are only kept as fingerprint"""
+    private_key = private_key if isinstance(private_key, str) else private_key.decrypt()
+    password = password if isinstance(password, str) else password.decrypt()
+    credentials = f"{authentication_method}\0{private_key}\0{password}"
+    fingerprint = hashlib.sha256(credentials.encode()).hexdigest()
+    return hostname, int(port), username, fingerprint
+
+
+class SSHConnectionPool:
+    """Process-wide pool of authenticated SSH connections
+
+    Plugins check out an idle connection with the same host, port, user and
+    credentials, or open a new one, instead of connecting and authenticating again,
+    and check it in once they are finished. Connections are only handed out while
+    their transport is active and authenticated.
+
+    At most `max_per_host` connections are open per host and port, checked out and
+    idle. At the limit, an idle connection with other credentials is closed, or the
+    caller waits up to `connect_wait` seconds for a connection to be checked in.
+    At most `max_idle_per_host` idle connections are kept per host and port, further
+    ones are closed on checkin. Idle connections send keepalive packets every
+    `keepalive_interval` seconds and are closed by a reaper thread after
+    `idle_timeout` seconds, which runs while there are idle connections.
+    """
+
+    def __init__(
+        self,
+        max_per_host: int = MAX_CONNECTIONS_PER_HOST,
+        max_idle_per_host: int = MAX_IDLE_PER_HOST,
+        idle_timeout: float = IDLE_TIMEOUT,
+        keepalive_interval: int = KEEPALIVE_INTERVAL,
+        connect_wait: float = CONNECT_WAIT,
+    ):
+        self.max_per_host = max_per_host
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.keepalive_interval = keepalive_interval
+        self.connect_wait = connect_wait
+        self._idle: dict[ConnectionKey, list[tuple[SSHClient, float]]] = {}
+        self._checked_out: dict[tuple[str, int], set[SSHClient]] = {}
+        self._connecting: Counter[tuple[str, int]] = Counter()
+        self._condition = threading.Condition()
+        self._reaper: threading.Thread | None = None
+
+    @staticmethod
+    def is_healthy(ssh_client: "SSHClient") -> bool:
+        """Check whether the transport of a connection is active and authenticated"""
+        transport = ssh_client.get_transport()
+        return transport is not None and transport.is_active() and transport.is_authenticated()
+
+    def checkout(self, key: ConnectionKey) -> "SSHClient | None":
+        """Take a healthy idle connection for the key, None if there is none"""
+        with self._condition:
+            ssh_client = self._take(key)
+            if ssh_client is not None:
+                self._checked_out.setdefault(key[:2], set()).add(ssh_client)
+            return ssh_client
+
+    def open(
+        self, key: ConnectionKey, connect: "Callable[[SSHClient], None]", wait: float | None = None
+    ) -> "SSHClient":
+        """Open a new connection for the key, authenticated with `connect`
+
+        At the limit of connections to the host, a ValueError is raised if no
+        connection is checked in within `wait` seconds, by default `connect_wait`.
+        """
+        host = key[:2]
+        deadline = time.monotonic() + (self.connect_wait if wait is None else wait)
+        with self._condition:
+            while self._count(host) >= self.max_per_host and not self._close_idle(host):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ValueError(
+                        f"All {self.max_per_host} SSH connections to {key[0]}:{key[1]} are in use"
+                    )
+                self._condition.wait(remaining)
+            # counted under the lock, so concurrent opens cannot all pass the check
+            self._connecting[host] += 1
+        ssh_client = paramiko.SSHClient()
+        try:
+            connect(ssh_client)
+        except BaseException:
+            ssh_client.close()
+            raise
+        else:
+            with self._condition:
+                self._checked_out.setdefault(host, set()).add(ssh_client)
+        finally:
+            with self._condition:
+                self._connecting[host] -= 1
+                self._condition.notify_all()
+        return ssh_client
+
+    def checkin(self, key: ConnectionKey, ssh_client: "SSHClient") -> None:
+        """Keep a connection for later checkouts, close it if it is broken or not needed"""
+        with self._condition:
+            self._condition.notify_all()
+            self._checked_out.get(key[:2], set()).discard(ssh_client)
+            self._evict()
+            connections = self._idle.setdefault(key, [])
+            if any(idle is ssh_client for idle, _ in connections):
+                return
+            host = key[:2]
+            idle_per_host = sum(
+                len(idle) for idle_key, idle in self._idle.items() if idle_key[:2] == host
+            )
+            if idle_per_host >= self.max_idle_per_host or not self.is_healthy(ssh_client):
+                ssh_client.close()
+                return
+            transport = ssh_client.get_transport()
+            if transport is not None:
+                transport.set_keepalive(self.keepalive_interval)
+            connections.append((ssh_client, time.monotonic()))
+            if self._reaper is None:
+                self._reaper = threading.Thread(
+                    target=self._reap, name="ssh-connection-reaper", daemon=True
+                )
+                self._reaper.start()
+
+    def clear(self) -> None:
+        """Close all idle connections"""
+        with self._condition:
+            for connections in self._idle.values():
+                for ssh_client, _ in connections:
+                    ssh_client.close()
+            self._idle.clear()
+            self._condition.notify_all()
+
+    def _take(self, key: ConnectionKey) -> "SSHClient | None":
+        """Take a healthy idle connection for the key, the caller holds the lock"""
+        self._evict()
+        connections = self._idle.get(key, [])
+        while connections:
+            ssh_client, _ = connections.pop()
+            if self.is_healthy(ssh_client):
+                return ssh_client
+            ssh_client.close()
+        return None
+
+    def _count(self, host: tuple[str, int]) -> int:
+        """Count the open connections to a host, the caller holds the lock
+
+        Checked out connections that were closed by their user are no longer counted.
+        """
+        checked_out = self._checked_out.get(host, set())
+        for ssh_client in list(checked_out):
+            transport = ssh_client.get_transport()
+            if transport is None or not transport.is_active():
+                checked_out.discard(ssh_client)
+        idle = sum(len(idle) for key, idle in self._idle.items() if key[:2] == host)
+        return len(checked_out) + self._connecting[host] + idle
+
+    def _close_idle(self, host: tuple[str, int]) -> bool:
+        """Close the oldest idle connection to a host, the caller holds the lock"""
+        oldest = min(
+            (
+                (since, key, index)
+                for key, connections in self._idle.items()
+                if key[:2] == host
+                for index, (_, since) in enumerate(connections)
+            ),
+            default=None,
+        )
+        if oldest is None:
+            return False
+        _, key, index = oldest
+        ssh_client, _ = self._idle[key].pop(index)
+        ssh_client.close()
+        return True
+
+    def _evict(self) -> None:
+        """Close connections idle for longer than the idle timeout, the caller holds the lock"""
+        deadline = time.monotonic() - self.idle_timeout
+        for key, connections in list(self._idle.items()):
+            for entry in [entry for entry in connections if entry[1] < deadline]:
+                connections.remove(entry)
+                entry[0].close()
+            if not connections:
+                del self._idle[key]
+
+    def _reap(self) -> None:
+        """Reaper: close idle connections once they time out, until none are left"""
+        with self._condition:
+            while True:
+                self._evict()
+                if not self._idle:
+                    self._reaper = None
+                    return
+                oldest = min(since for idle in self._idle.values() for _, since in idle)
+                self._condition.wait(oldest + self.idle_timeout - time.monotonic())
+
+
+SSH_CONNECTIONS = SSHConnectionPool()
+
+
+def open_sftp_session(
+    key: ConnectionKey, connect: "Callable[[SSHClient], None]"
+) -> "tuple[SSHClient, SFTPClient]":
+    """Open an SFTP session on a pooled connection for the key, or on a new one
+
+    New connections are authenticated with `connect` and are checked in to the pool
+    by the caller like pooled ones.
+    """
+    pooled_client = SSH_CONNECTIONS.checkout(key)
+    if pooled_client is not None:
+        try:
+            return pooled_client, pooled_client.open_sftp()
+        except paramiko.SSHException:
+            pooled_client.close()
+    ssh_client = SSH_CONNECTIONS.open(key, connect)
+    try:
+        return ssh_client, ssh_client.open_sftp()
+    except BaseException:
+        ssh_client.close()
+        raise
+
+
+def open_transports(
+    key: ConnectionKey, count: int, connect: "Callable[[SSHClient], None]"
+) -> "list[SSHClient]":
+    """Check out or open further SSH connections for the key, all at the same time
+
+    New connections are authenticated with `connect`. Connections that cannot be
+    opened are skipped, e.g. if the server limits the connections per user or the
+    pool reached its limit of connections to the host, so fewer than `count`
+    connections may be returned.
+    """
+
+    def open_transport(_: int) -> "SSHClient | None":
+        ssh_client = SSH_CONNECTIONS.checkout(key)
+        if ssh_client is not None:
+            return ssh_client
+        try:
+            return SSH_CONNECTIONS.open(key, connect, wait=0)
+        except (paramiko.SSHException, OSError, ValueError):
+            return None
+
+    if count < 1:
+        return []
+    with ThreadPoolExecutor(max_workers=count, thread_name_prefix="ssh-connect") as executor:
+        return [client for client in executor.map(open_transport, range(count)) if client]
+
+
+def run_probe(
+    ssh_client: "SSHClient", command: str, timeout: float = PROBE_TIMEOUT
+) -> bytes | None:
+    """Run a short command and return its output, None if it fails or times out
+
+    Stdin is closed right away, so a forced command like `internal-sftp` ends instead
+    of waiting for input, and the wait for the exit status is bounded by `timeout`.
+    """
+    deadline = time.monotonic() + timeout
+    _, stdout, _ = ssh_client.exec_command(command, timeout=timeout)
+    channel = stdout.channel
+    try:
+        channel.shutdown_write()
+        try:
+            output = stdout.read()
+        except TimeoutError:
+            return None
+        while not channel.exit_status_ready():
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(PROBE_POLL_INTERVAL)
+        return output if channel.recv_exit_status() == 0 else None
+    finally:
+        channel.close()
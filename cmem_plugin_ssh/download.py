@@ -1,10 +1,11 @@
 """SSH download files task plugin"""
 
 import tempfile
-from collections.abc import Sequence
+import threading
+from collections.abc import Generator, Iterable, Iterator, Sequence
 from pathlib import Path
+from typing import TYPE_CHECKING
 
-import paramiko
 from cmem_plugin_base.dataintegration.context import (
     ExecutionContext,
     ExecutionReport,
@@ -15,20 +16,49 @@ from cmem_plugin_base.dataintegration.parameter.choice import ChoiceParameterTyp
 from cmem_plugin_base.dataintegration.parameter.password import Password, PasswordParameterType
 from cmem_plugin_base.dataintegration.plugins import WorkflowPlugin
 from cmem_plugin_base.dataintegration.ports import FixedNumberOfInputs, FixedSchemaPort
-from cmem_plugin_base.dataintegration.typed_entities.file import FileEntitySchema, LocalFile
-from paramiko import SFTPAttributes
 
 from cmem_plugin_ssh.autocompletion import DirectoryParameterType
-from cmem_plugin_ssh.list import generate_list_schema
-from cmem_plugin_ssh.retrieval import SSHRetrieval
+from cmem_plugin_ssh.cache import TransferCache
+from cmem_plugin_ssh.connection import (
+    SSH_CONNECTIONS,
+    ConnectionKey,
+    SFTPChannelPool,
+    connection_key,
+    open_sftp_session,
+    open_transports,
+)
+from cmem_plugin_ssh.lazy import paramiko, typed_files
+from cmem_plugin_ssh.retrieval import SSHRetrieval, Watchdog
+from cmem_plugin_ssh.snapshot import Snapshot
+from cmem_plugin_ssh.transfer import ParallelDownload, TarDownload
 from cmem_plugin_ssh.utils import (
+    ACCESS_CHECK_CHOICES,
     AUTHENTICATION_CHOICES,
     ERROR_HANDLING_CHOICES,
+    LISTING_METHOD_CHOICES,
+    METADATA,
+    SAMPLE_SIZE,
+    SFTP_LISTING,
+    SFTP_TRANSFER,
+    TAR_GZIP_TRANSFER,
+    TAR_TRANSFER,
+    TRANSFER_METHOD_CHOICES,
+    generate_list_entity,
+    generate_list_schema,
     load_private_key,
     preview_results,
+    setup_cache_size,
+    setup_max_depth,
     setup_max_workers,
+    setup_segment_size,
+    setup_ssh_connections,
+    split_patterns,
 )
 
+if TYPE_CHECKING:
+    from cmem_plugin_base.dataintegration.typed_entities.file import FileEntitySchema, LocalFile
+    from paramiko import SFTPAttributes
+
 
 @Plugin(
     label="Download SSH files",
@@ -57,11 +87,52 @@ Skips folders and files when there is no correct permission.
 all other files and skips files folder when there is no correct permission.
 * **Error:** Throws an error when there is a single file or folder with incorrect permission rights.
 
+#### Access check modes:
+* **File metadata:** Read access is derived from the mode, owner and group of each file and the
+user and group ids of the remote user (determined once with `id`). Symbolic links are opened.
+* **Open files (strict):** Every file is opened to verify read access. This also respects access
+control lists, but costs several requests per file.
+
+Files are downloaded and handed to the following workflow tasks while the folder is still
+being listed. With the error handling mode **Error**, all files are downloaded first, so no
+entities are output if a single file is not accessible.
+
+#### Incremental listing:
+With a snapshot file, the folders and files of each complete listing are stored locally.
+On the next execution, folders whose modification time did not change are taken from the
+snapshot instead of being listed again, and the output can be limited to new or changed files.
+Note that a file modified in place does not change the modification time of its folder.
+With a snapshot file, folders are always listed with SFTP.
+
+#### Listing methods:
+* **SFTP:** Every folder is listed with separate SFTP requests, distributed over the workers.
+* **Remote find:** The whole folder tree is listed with a single `find` command on the server.
+This needs GNU find and command execution on the server, otherwise SFTP is used.
+
 #### Note:
 * If a connection cannot be established within 20 seconds, a timeout occurs.
+* Connections are kept open for up to 5 minutes after the task finished and reused by tasks
+connecting to the same host with the same user and credentials. At most 16 connections
+to a host are open at the same time, further tasks wait for one to be released.
 * Currently supported key types are: RSA, DSS, ECDSA, Ed25519.
-* Setting the maximum amount of workers to more than 1 may cause a Channel Exception when
-the amount of files is too large
+* Up to the maximum amount of workers files are downloaded at the same time over a pool
+of at most one SFTP channel per worker. Without input, the listing shares this pool.
+Downloaded files are output in the order they are finished.
+* With a cache folder, downloaded files are kept there for later executions and output from
+there. Unchanged files are not downloaded again.
+* With a tar stream, all files are downloaded as one archive by a single `tar` command, the
+workers only list the folder. Files tar cannot read are reported at the end.
+* With more than one worker, files larger than the segment size are split into segments,
+which are downloaded at the same time over separate SFTP channels. The file is only output
+once the bytes received for all segments add up to the size on the server.
+* If the server allows fewer sessions per connection (MaxSessions), the pool shrinks to
+the channels it accepted and later probes for more, so a high number of workers does not
+fail the task.
+* With more than one SSH connection, new SFTP channels are opened on the connection with the
+fewest channels. Connections the server refuses are skipped.
+* If a connection is lost during an SFTP download, a new one is opened and the transfer is
+retried up to 5 times with doubling delays. Segments and files from 16 MB on continue where
+they stopped, a part file is only continued if the file did not change on the server.
     """,
     icon=Icon(package=__package__, file_name="ssh-icon.svg"),
     actions=[
@@ -136,8 +207,8 @@ the amount of files is too large
             "When choosing 'warning' all files get downloaded however there will be "
             "a mention that some of the files are not under the users permissions"
             "if there are any and these get skipped."
-            "When choosing 'error' the files will not get downloaded if there"
-            "is even a single file the user has no access to.",
+            "When choosing 'error' the task fails at the first file the user has no "
+            "access to.",
             param_type=ChoiceParameterType(ERROR_HANDLING_CHOICES),
             default_value="error",
         ),
@@ -148,22 +219,143 @@ the amount of files is too large
             "will be downloaded.",
             default_value=False,
         ),
+        PluginParameter(
+            name="access_check",
+            label="Access check",
+            description="How read access to files is checked for the error handling. "
+            "'File metadata' decides from the mode, owner and group of each file and the ids "
+            "of the remote user, which needs no extra requests per file. "
+            "'Open files (strict)' opens every file, which also respects access control lists "
+            "but is considerably slower.",
+            param_type=ChoiceParameterType(ACCESS_CHECK_CHOICES),
+            default_value=METADATA,
+            advanced=True,
+        ),
+        PluginParameter(
+            name="max_depth",
+            label="Maximum depth",
+            description="How many levels of subfolders are descended into. 0 only includes "
+            "the selected folder, -1 includes all subfolders.",
+            default_value=-1,
+            advanced=True,
+        ),
+        PluginParameter(
+            name="include_folders",
+            label="Include folders",
+            description="Comma separated patterns of subfolders to descend into, for example "
+            "'data*, reports'. A pattern matches the name of a folder at any depth or its "
+            "path relative to the selected folder. Subfolders of a matching folder are "
+            "included as well, other folders are only passed on the way to matching folders, "
+            "like 'archive' for 'archive/2024', without listing their files. "
+            "Leave empty to include all subfolders.",
+            default_value="",
+            advanced=True,
+        ),
+        PluginParameter(
+            name="exclude_folders",
+            label="Exclude folders",
+            description="Comma separated patterns of subfolders that are not descended into, "
+            "for example '.git, node_modules, archive/*'. A pattern matches the name of a "
+            "folder or its path relative to the selected folder. Files in excluded folders "
+            "are not downloaded and the folders are not listed at all.",
+            default_value="",
+            advanced=True,
+        ),
+        PluginParameter(
+            name="snapshot_file",
+            label="Snapshot file",
+            description="Local file in which the folders and files of the last complete listing "
+            "are stored. Folders whose modification time did not change since then are not "
+            "listed again. The snapshot is only updated if all files were downloaded. "
+            "Leave empty to list all folders on every execution.",
+            default_value="",
+            advanced=True,
+        ),
+        PluginParameter(
+            name="changed_only",
+            label="Only changed files",
+            description="When this flag is set, only files that are new or changed in size or "
+            "modification time since the last execution will be downloaded. "
+            "Needs a snapshot file.",
+            default_value=False,
+            advanced=True,
+        ),
+        PluginParameter(
+            name="listing_method",
+            label="Listing method",
+            description="How the folder is listed. 'SFTP' lists every folder with a separate "
+            "request. 'Remote find' lists the whole folder tree with a single `find` command "
+            "on the server, which is much faster for large trees. It needs GNU find and "
+            "command execution on the server and falls back to SFTP otherwise.",
+            param_type=ChoiceParameterType(LISTING_METHOD_CHOICES),
+            default_value=SFTP_LISTING,
+            advanced=True,
+        ),
         PluginParameter(
             name="max_workers",
             label="Maximum amount of workers.",
             description="Determines the amount of workers used for concurrent thread execution "
-            "of the task. Default is 1, maximum is 32. Note that too many workers can cause a "
-            "ChannelException.",
+            "of the task. Default is 1, maximum is 32.",
             default_value=1,
             advanced=True,
         ),
+        PluginParameter(
+            name="ssh_connections",
+            label="SSH connections",
+            description="Number of SSH connections the workers spread their SFTP channels over. "
+            "Every connection encrypts its traffic in a single thread, so with many workers "
+            "more connections can list and download faster. Default is 1, maximum is 8.",
+            default_value=1,
+            advanced=True,
+        ),
+        PluginParameter(
+            name="transfer_method",
+            label="Transfer method",
+            description="How the files are downloaded. 'SFTP' downloads every file with separate "
+            "requests, distributed over the workers. 'Tar stream' downloads all files as one "
+            "archive created with `tar` on the server and unpacked on the fly, which is much "
+            "faster for many small files. The compressed tar stream additionally uses gzip, "
+            "which helps on slow connections. Both need `tar` and command execution on the "
+            "server and fall back to SFTP otherwise.",
+            param_type=ChoiceParameterType(TRANSFER_METHOD_CHOICES),
+            default_value=SFTP_TRANSFER,
+            advanced=True,
+        ),
+        PluginParameter(
+            name="cache_dir",
+            label="Cache folder",
+            description="Local folder in which downloaded files are kept for later executions. "
+            "Files whose size and modification time did not change since they were cached are "
+            "taken from the cache instead of downloaded again, and the output refers to the "
+            "files in the cache. Leave empty to download all files into a new temporary folder "
+            "on every execution.",
+            default_value="",
+            advanced=True,
+        ),
+        PluginParameter(
+            name="cache_size",
+            label="Cache size (MB)",
+            description="Maximum size of the files in the cache folder. The files used least "
+            "recently are removed beyond this size, files of the current execution are kept.",
+            default_value=10240,
+            advanced=True,
+        ),
+        PluginParameter(
+            name="segment_size",
+            label="Segment size (MB)",
+            description="Files larger than this size are split into segments of this size, "
+            "which are downloaded at the same time by the workers. This speeds up the download "
+            "of large files. Only used with more than one worker, 0 disables segments.",
+            default_value=64,
+            advanced=True,
+        ),
     ],
 )
 class DownloadFiles(WorkflowPlugin):
     """SSH Workflow Plugin: File download"""
 
-    ssh_client: paramiko.SSHClient
-    sftp: paramiko.SFTPClient
+    ssh_client: "paramiko.SSHClient"
+    sftp: "paramiko.SFTPClient"
 
     def __init__(  # noqa: PLR0913
         self,
@@ -178,6 +370,18 @@ class DownloadFiles(WorkflowPlugin):
         no_subfolder: bool,
         regex: str = "",
         max_workers: int = 1,
+        ssh_connections: int = 1,
+        access_check: str = METADATA,
+        listing_method: str = SFTP_LISTING,
+        snapshot_file: str = "",
+        changed_only: bool = False,
+        max_depth: int = -1,
+        include_folders: str = "",
+        exclude_folders: str = "",
+        segment_size: int = 64,
+        transfer_method: str = SFTP_TRANSFER,
+        cache_dir: str = "",
+        cache_size: int = 10240,
     ):
         self.hostname = hostname
         self.port = port
@@ -190,15 +394,30 @@ class DownloadFiles(WorkflowPlugin):
         self.no_subfolder = no_subfolder
         self.regex = rf"{regex}"
         self.max_workers = setup_max_workers(max_workers)
+        self.ssh_connections = setup_ssh_connections(ssh_connections)
+        self.transports: list[paramiko.SSHClient] = []
+        self.access_check = access_check
+        self.listing_method = listing_method
+        self.snapshot_file = snapshot_file
+        self.changed_only = changed_only
+        setup_max_depth(max_depth)
+        self.max_depth = max_depth
+        self.include_folders = include_folders
+        self.exclude_folders = exclude_folders
+        self.segment_size = setup_segment_size(segment_size, self.max_workers)
+        self.transfer_method = transfer_method
+        self.cache_dir = cache_dir
+        self.cache_size = setup_cache_size(cache_size)
         self.input_ports = FixedNumberOfInputs([FixedSchemaPort(schema=generate_list_schema())])
-        self.output_port = FixedSchemaPort(schema=FileEntitySchema())
+        self.output_port = FixedSchemaPort(schema=typed_files.FileEntitySchema())
         self.download_dir = tempfile.mkdtemp()
 
-    def establish_ssh_connection(self) -> None:
+    def establish_ssh_connection(self, ssh_client: "paramiko.SSHClient | None" = None) -> None:
         """Connect to the ssh client with the selected authentication method"""
+        ssh_client = ssh_client or self.ssh_client
         if self.authentication_method == "key":
-            self.ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            self.ssh_client.connect(
+            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            ssh_client.connect(
                 hostname=self.hostname,
                 username=self.username,
                 pkey=load_private_key(self.private_key, self.password),
@@ -207,8 +426,8 @@ class DownloadFiles(WorkflowPlugin):
                 timeout=20,
             )
         elif self.authentication_method == "password":
-            self.ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            self.ssh_client.connect(
+            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            ssh_client.connect(
                 hostname=self.hostname,
                 username=self.username,
                 password=self.password,
@@ -217,40 +436,74 @@ class DownloadFiles(WorkflowPlugin):
             )
 
     def cleanup_ssh_connections(self) -> None:
-        """Close connection from sftp and ssh"""
+        """Close the SFTP session and return the SSH connection to the connection pool"""
         self.sftp.close()
-        self.ssh_client.close()
+        SSH_CONNECTIONS.checkin(self.connection_key(), self.ssh_client)
+        for transport in self.transports:
+            SSH_CONNECTIONS.checkin(self.connection_key(), transport)
+        self.transports = []
+
+    def open_transports(self) -> None:
+        """Open the SSH connections beyond the first one for the workers"""
+        self.transports = open_transports(
+            self.connection_key(), self.ssh_connections - 1, self.establish_ssh_connection
+        )
+
+    def connection_key(self) -> ConnectionKey:
+        """Key of the pooled SSH connections for the connection parameters"""
+        return connection_key(
+            self.hostname,
+            self.port,
+            self.username,
+            self.authentication_method,
+            self.private_key,
+            self.password,
+        )
 
     def _initialize_ssh_and_sftp_connections(self) -> None:
-        self.ssh_client = paramiko.SSHClient()
-        self.establish_ssh_connection()
-        self.sftp = self.ssh_client.open_sftp()
+        self.ssh_client, self.sftp = open_sftp_session(
+            self.connection_key(), self.establish_ssh_connection
+        )
 
     def preview_results(self) -> str:
         """Preview the results of an execution"""
         self._initialize_ssh_and_sftp_connections()
-        return preview_results(
-            ssh_client=self.ssh_client,
-            no_subfolder=self.no_subfolder,
-            regex=self.regex,
-            path=self.path,
-            error_handling=self.error_handling,
-            max_workers=self.max_workers,
-        )
+        try:
+            return preview_results(
+                ssh_client=self.ssh_client,
+                no_subfolder=self.no_subfolder,
+                regex=self.regex,
+                path=self.path,
+                error_handling=self.error_handling,
+                max_workers=self.max_workers,
+                access_check=self.access_check,
+                listing_method=self.listing_method,
+                depth=setup_max_depth(self.max_depth),
+                include_folders=split_patterns(self.include_folders),
+                exclude_folders=split_patterns(self.exclude_folders),
+            )
+        finally:
+            self.cleanup_ssh_connections()
 
     def execute(self, inputs: Sequence[Entities], context: ExecutionContext) -> Entities:
         """Execute the workflow task"""
         _ = inputs
-        schema = FileEntitySchema()
+        schema = typed_files.FileEntitySchema()
+        # read the snapshot first, so a broken file does not leave connections checked out
+        snapshot = Snapshot(self.snapshot_file) if self.snapshot_file and not inputs else None
 
         self._initialize_ssh_and_sftp_connections()
+        self.open_transports()
 
         context.report.update(
             ExecutionReport(entity_count=0, operation="wait", operation_desc="files listed.")
         )
 
         if len(inputs) > 0:
-            downloaded_files, faulty_files = self.download_with_input(inputs, context)
+            try:
+                downloaded_files, faulty_files = self.download_with_input(inputs, context)
+            finally:
+                self.cleanup_ssh_connections()
             entities = [schema.to_entity(file) for file in downloaded_files]
             faulty_entities = [schema.to_entity(file) for file in faulty_files]
             if self.error_handling == "warning" and len(faulty_files) > 0:
@@ -260,7 +513,7 @@ class DownloadFiles(WorkflowPlugin):
                         operation="done",
                         operation_desc="entities generated",
                         sample_entities=Entities(
-                            entities=iter(faulty_entities), schema=FileEntitySchema()
+                            entities=iter(faulty_entities), schema=typed_files.FileEntitySchema()
                         ),
                         warnings=[
                             "Some files have been ignored that the current user does not have "
@@ -285,52 +538,71 @@ class DownloadFiles(WorkflowPlugin):
             ssh_client=self.ssh_client,
             no_subfolder=self.no_subfolder,
             regex=self.regex,
+            access_check=self.access_check,
+            listing_method=self.listing_method,
+            snapshot=snapshot,
+            changed_only=self.changed_only,
+            include_folders=split_patterns(self.include_folders),
+            exclude_folders=split_patterns(self.exclude_folders),
+            transports=self.transports,
         )
-        files = retrieval.list_files_parallel(
-            files=[],
+        no_access_files: list[SFTPAttributes] = []
+        # listing and downloads share the channels, so the server sessions are not exceeded
+        channels = self.channel_pool()
+        files = retrieval.stream_files(
             context=context,
             path=self.path,
             error_handling=self.error_handling,
-            no_access_files=[],
+            no_access_files=no_access_files,
+            depth=setup_max_depth(self.max_depth),
+            workers=self.max_workers,
+            channels=channels,
+            save_snapshot=False,
+        )
+        downloads = self.download_no_input(files, channels, retrieval)
+        return Entities(
+            entities=self.generate_entities(downloads, no_access_files, context, schema),
+            schema=schema,
         )
-        downloaded_files = self.download_no_input(files)
-        entities = [schema.to_entity(file) for file in downloaded_files]
-
-        self.update_context(context, entities, files, schema)
 
-        self.cleanup_ssh_connections()
+    def generate_entities(
+        self,
+        downloaded_files: "Iterator[LocalFile]",
+        no_access_files: "list[SFTPAttributes]",
+        context: ExecutionContext,
+        schema: "FileEntitySchema",
+    ) -> Iterator[Entity]:
+        """Generate entities while the files are downloaded"""
+        entity_count = 0
+        sample_entities: list[Entity] = []
+        try:
+            for file in downloaded_files:
+                entity = schema.to_entity(file)
+                entity_count += 1
+                if len(sample_entities) < SAMPLE_SIZE:
+                    sample_entities.append(entity)
+                yield entity
+        finally:
+            if isinstance(downloaded_files, Generator):
+                downloaded_files.close()
+            self.cleanup_ssh_connections()
 
-        return Entities(entities=iter(entities), schema=schema)
+        self.update_context(context, entity_count, sample_entities, no_access_files, schema)
 
     def update_context(
         self,
         context: ExecutionContext,
-        entities: list[Entity],
-        files: tuple[list[SFTPAttributes], list[SFTPAttributes]],
+        entity_count: int,
+        sample_entities: list[Entity],
+        no_access_files: "list[SFTPAttributes]",
         schema: EntitySchema,
     ) -> None:
         """Give a context update depending on the selected error handling method"""
-        if self.error_handling == "warning" and len(files[1]) > 0:
-            faulty_files = files[1]
-            faulty_entities = []
-            for file in faulty_files:
-                faulty_entities.append(  # noqa: PERF401
-                    Entity(
-                        uri=file.filename,
-                        values=[
-                            [file.filename],
-                            [str(file.st_size)],
-                            [str(file.st_uid)],
-                            [str(file.st_gid)],
-                            [str(file.st_mode)],
-                            [str(file.st_atime)],
-                            [str(file.st_mtime)],
-                        ],
-                    )
-                )
+        if self.error_handling == "warning" and len(no_access_files) > 0:
+            faulty_entities = [generate_list_entity(file) for file in no_access_files]
             context.report.update(
                 ExecutionReport(
-                    entity_count=len(entities),
+                    entity_count=entity_count,
                     operation="done",
                     operation_desc="entities generated",
                     sample_entities=Entities(
@@ -346,57 +618,121 @@ class DownloadFiles(WorkflowPlugin):
         else:
             context.report.update(
                 ExecutionReport(
-                    entity_count=len(entities),
+                    entity_count=entity_count,
                     operation="done",
                     operation_desc="entities generated",
-                    sample_entities=Entities(entities=iter(entities[:10]), schema=schema),
+                    sample_entities=Entities(entities=iter(sample_entities), schema=schema),
                 )
             )
 
-    def download_no_input(self, files: tuple[list[SFTPAttributes], list[SFTPAttributes]]) -> list:
-        """Download files with no given input"""
-        entities = []
-        for file in files[0]:
+    def reconnect(self) -> "paramiko.SSHClient":
+        """Open a new SSH connection after one was lost, checked in with the transports"""
+        ssh_client = SSH_CONNECTIONS.open(self.connection_key(), self.establish_ssh_connection)
+        self.transports.append(ssh_client)
+        return ssh_client
+
+    def channel_pool(self) -> SFTPChannelPool:
+        """Create the pool of SFTP channels, which reconnects lost SSH connections"""
+        return SFTPChannelPool(
+            self.ssh_client,
+            max_size=self.max_workers,
+            transports=self.transports,
+            connect=self.reconnect,
+        )
+
+    def transfer_cache(self) -> TransferCache | None:
+        """Open the cache of downloaded files, None if no cache folder is given"""
+        if not self.cache_dir:
+            return None
+        host = f"{self.username}@{self.hostname}:{self.port}"
+        return TransferCache(self.cache_dir, host, self.cache_size)
+
+    def downloader(
+        self, channels: SFTPChannelPool, cache: TransferCache | None = None
+    ) -> "ParallelDownload | TarDownload":
+        """Download as tar stream if selected and available on the server, otherwise by SFTP"""
+        if self.transfer_method in {TAR_TRANSFER, TAR_GZIP_TRANSFER}:
+            compress = self.transfer_method == TAR_GZIP_TRANSFER
+            tar = TarDownload(self.ssh_client, self.download_dir, compress, cache)
+            if tar.available():
+                return tar
+        return ParallelDownload(
+            channels, self.download_dir, self.max_workers, self.segment_size, cache
+        )
+
+    def download_no_input(
+        self,
+        files: "Iterable[SFTPAttributes | None]",
+        channels: SFTPChannelPool | None = None,
+        retrieval: SSHRetrieval | None = None,
+    ) -> "Iterator[LocalFile]":
+        """Download files with no given input
+
+        Up to `max_workers` files are downloaded at the same time over the channels of
+        the pool, which is closed afterward. The files are yielded as they are finished,
+        also while the listing is still busy, which None in `files` stands for.
+        The snapshot of the listing `retrieval` is saved only if every file was
+        downloaded, so files that failed are output again by the next execution.
+        """
+        channels = channels or self.channel_pool()
+        cache = self.transfer_cache()
+        download = self.downloader(channels, cache)
+        failed = False
+        with channels:
             try:
-                remote_path = file.filename
-                local_path = self.download_dir / Path(Path(file.filename).name)
-                self.sftp.get(remotepath=remote_path, localpath=local_path)
-                entities.append(LocalFile(str(local_path)))
-            except (PermissionError, OSError) as e:
-                if self.error_handling in {"ignore", "warning"}:
-                    pass
-                else:
-                    raise ValueError(f"No access to '{file.filename}': {e}") from e
-
-        return entities
+                for remote_path, result in download.download(files):
+                    if isinstance(result, OSError):
+                        if self.error_handling in {"ignore", "warning"}:
+                            failed = True
+                            continue
+                        raise ValueError(f"No access to '{remote_path}': {result}") from result
+                    yield typed_files.LocalFile(str(result))
+                if retrieval is not None and not failed:
+                    retrieval.save_snapshot()
+            finally:
+                if cache is not None:
+                    cache.save()
 
     def download_with_input(
         self, inputs: Sequence[Entities], context: ExecutionContext
     ) -> tuple[list, list]:
-        """Download files with a given input"""
-        downloaded_entities = []
-        faulty_entities = []
-        for entity in inputs[0].entities:
-            try:
-                if context.workflow.status() == "Canceling":
-                    break
-            except AttributeError:
-                pass
-            filename = entity.values[0][0]
+        """Download files with a given input
+
+        The input entities are consumed while up to `max_workers` files are downloaded
+        at the same time over a pool of SFTP channels. Cancellation is checked and
+        progress is reported at most every 250 ms. After a cancellation, downloads
+        that have not started yet are skipped.
+        """
+        downloaded_entities: list[LocalFile] = []
+        faulty_entities: list[LocalFile] = []
+        watchdog = Watchdog(
+            context, threading.Event(), operation="write", operation_desc="files downloaded"
+        )
+
+        def filenames() -> Iterator[str]:
+            """Take the input entities until the workflow is cancelled"""
+            for entity in inputs[0].entities:
+                if watchdog.poll(len(downloaded_entities)):
+                    return
+                yield entity.values[0][0]
+
+        with self.channel_pool() as channels:
+            cache = self.transfer_cache()
+            download = self.downloader(channels, cache)
+            downloads = download.download(filenames())
             try:
-                local_path = self.download_dir / Path(Path(filename).name)
-                self.sftp.get(remotepath=filename, localpath=local_path)
-                downloaded_entities.append(LocalFile(str(local_path)))
-            except (PermissionError, OSError) as e:
-                if self.error_handling in {"ignore", "warning"}:
-                    faulty_entities.append(LocalFile(Path(filename).name))
-                else:
-                    raise ValueError(f"No access to '{filename}': {e}") from e
-            context.report.update(
-                ExecutionReport(
-                    entity_count=len(downloaded_entities),
-                    operation="write",
-                    operation_desc="files downloaded",
-                )
-            )
+                for filename, result in downloads:
+                    if isinstance(result, OSError):
+                        if self.error_handling not in {"ignore", "warning"}:
+                            raise ValueError(f"No access to '{filename}': {result}") from result
+                        faulty_entities.append(typed_files.LocalFile(Path(filename).name))
+                    else:
+                        downloaded_entities.append(typed_files.LocalFile(str(result)))
+                    if watchdog.poll(len(downloaded_entities)):
+                        break
+            finally:
+                downloads.close()
+                if cache is not None:
+                    cache.save()
+        watchdog.poll(len(downloaded_entities), force=True)
         return downloaded_entities, faulty_entities
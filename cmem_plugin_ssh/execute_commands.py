@@ -4,7 +4,6 @@ import tempfile
 from collections.abc import Sequence
 from pathlib import Path
 
-import paramiko
 from cmem_plugin_base.dataintegration.context import ExecutionContext, ExecutionReport
 from cmem_plugin_base.dataintegration.description import Icon, Plugin, PluginParameter
 from cmem_plugin_base.dataintegration.entity import Entities, Entity, EntityPath, EntitySchema
@@ -12,9 +11,15 @@ from cmem_plugin_base.dataintegration.parameter.choice import ChoiceParameterTyp
 from cmem_plugin_base.dataintegration.parameter.password import Password, PasswordParameterType
 from cmem_plugin_base.dataintegration.plugins import WorkflowPlugin
 from cmem_plugin_base.dataintegration.ports import FixedNumberOfInputs, FixedSchemaPort, Port
-from cmem_plugin_base.dataintegration.typed_entities.file import FileEntitySchema, LocalFile
 
 from cmem_plugin_ssh.autocompletion import DirectoryParameterType
+from cmem_plugin_ssh.connection import (
+    SSH_CONNECTIONS,
+    ConnectionKey,
+    connection_key,
+    open_sftp_session,
+)
+from cmem_plugin_ssh.lazy import paramiko, typed_files
 from cmem_plugin_ssh.utils import (
     AUTHENTICATION_CHOICES,
     COMMAND_INPUT_CHOICES,
@@ -81,6 +86,9 @@ will be used to decrypt it.
 
 #### Note:
 * If a connection cannot be established within 20 seconds, a timeout occurs.
+* Connections are kept open for up to 5 minutes after the task finished and reused by tasks
+connecting to the same host with the same user and credentials. At most 16 connections
+to a host are open at the same time, further tasks wait for one to be released.
 * Currently supported key types are: RSA, DSS, ECDSA, Ed25519.
     """,
     icon=Icon(package=__package__, file_name="ssh-icon.svg"),
@@ -168,8 +176,8 @@ will be used to decrypt it.
 class ExecuteCommands(WorkflowPlugin):
     """Execute commands Plugin SSH"""
 
-    ssh_client: paramiko.SSHClient
-    sftp: paramiko.SFTPClient
+    ssh_client: "paramiko.SSHClient"
+    sftp: "paramiko.SFTPClient"
 
     def __init__(  # noqa: PLR0913
         self,
@@ -199,11 +207,12 @@ class ExecuteCommands(WorkflowPlugin):
         self.input_ports = self.setup_input_port()
         self.output_port = self.setup_output_port()
 
-    def establish_ssh_connection(self) -> None:
+    def establish_ssh_connection(self, ssh_client: "paramiko.SSHClient | None" = None) -> None:
         """Connect to the ssh client with the selected authentication method"""
+        ssh_client = ssh_client or self.ssh_client
         if self.authentication_method == "key":
-            self.ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            self.ssh_client.connect(
+            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            ssh_client.connect(
                 hostname=self.hostname,
                 username=self.username,
                 pkey=load_private_key(self.private_key, self.password),
@@ -212,8 +221,8 @@ class ExecuteCommands(WorkflowPlugin):
                 timeout=20,
             )
         elif self.authentication_method == "password":
-            self.ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            self.ssh_client.connect(
+            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            ssh_client.connect(
                 hostname=self.hostname,
                 username=self.username,
                 password=self.password,
@@ -222,14 +231,25 @@ class ExecuteCommands(WorkflowPlugin):
             )
 
     def cleanup_ssh_connections(self) -> None:
-        """Close connection from sftp and ssh"""
+        """Close the SFTP session and return the SSH connection to the connection pool"""
         self.sftp.close()
-        self.ssh_client.close()
+        SSH_CONNECTIONS.checkin(self.connection_key(), self.ssh_client)
+
+    def connection_key(self) -> ConnectionKey:
+        """Key of the pooled SSH connections for the connection parameters"""
+        return connection_key(
+            self.hostname,
+            self.port,
+            self.username,
+            self.authentication_method,
+            self.private_key,
+            self.password,
+        )
 
     def _initialize_ssh_and_sftp_connections(self) -> None:
-        self.ssh_client = paramiko.SSHClient()
-        self.establish_ssh_connection()
-        self.sftp = self.ssh_client.open_sftp()
+        self.ssh_client, self.sftp = open_sftp_session(
+            self.connection_key(), self.establish_ssh_connection
+        )
 
     def execute(self, inputs: Sequence[Entities], context: ExecutionContext) -> Entities:
         """Execute the workflow task"""
@@ -243,13 +263,14 @@ class ExecuteCommands(WorkflowPlugin):
                 operation_desc=f"executing '{self.command}'",
             )
         )
-        if self.input_method == "file_input":
-            self.input_execution(context, entities, inputs)
+        try:
+            if self.input_method == "file_input":
+                self.input_execution(context, entities, inputs)
 
-        if self.input_method == "no_input":
-            self.no_input_execution(entities)
-
-        self.cleanup_ssh_connections()
+            if self.input_method == "no_input":
+                self.no_input_execution(entities)
+        finally:
+            self.cleanup_ssh_connections()
 
         operation_desc = (
             f"times executed '{self.command}'"
@@ -257,7 +278,11 @@ class ExecuteCommands(WorkflowPlugin):
             else f"executed '{self.command}'"
         )
 
-        schema = FileEntitySchema() if self.output_method == FILE_OUTPUT else generate_schema()
+        schema = (
+            typed_files.FileEntitySchema()
+            if self.output_method == FILE_OUTPUT
+            else generate_schema()
+        )
 
         context.report.update(
             ExecutionReport(
@@ -276,7 +301,7 @@ class ExecuteCommands(WorkflowPlugin):
         """Execute the command with given input files"""
         files = inputs[0].entities
         for file in files:
-            stdin_file = FileEntitySchema().from_entity(file)
+            stdin_file = typed_files.FileEntitySchema().from_entity(file)
             context.report.update(
                 ExecutionReport(
                     entity_count=len(entities),
@@ -307,8 +332,8 @@ class ExecuteCommands(WorkflowPlugin):
                 tmp_path = Path(tmp_dir) / f"{input_filename}_stdout.bin"
                 with Path.open(tmp_path, "wb") as f:
                     f.write(output_bytes)
-                local_file = LocalFile(path=str(tmp_path))
-                entity = FileEntitySchema().to_entity(value=local_file)
+                local_file = typed_files.LocalFile(path=str(tmp_path))
+                entity = typed_files.FileEntitySchema().to_entity(value=local_file)
                 entities.append(entity)
 
     def no_input_execution(self, entities: list) -> None:
@@ -330,8 +355,8 @@ class ExecuteCommands(WorkflowPlugin):
             with Path.open(tmp_path, "wb") as f:
                 f.write(output_bytes)
 
-            local_file = LocalFile(path=str(tmp_path))
-            entity = FileEntitySchema().to_entity(value=local_file)
+            local_file = typed_files.LocalFile(path=str(tmp_path))
+            entity = typed_files.FileEntitySchema().to_entity(value=local_file)
             entities.append(entity)
 
     def setup_input_port(self) -> FixedNumberOfInputs:
@@ -339,7 +364,7 @@ class ExecuteCommands(WorkflowPlugin):
         if self.input_method == NO_INPUT:
             return FixedNumberOfInputs([])
         if self.input_method == FILE_INPUT:
-            return FixedNumberOfInputs([FixedSchemaPort(schema=FileEntitySchema())])
+            return FixedNumberOfInputs([FixedSchemaPort(schema=typed_files.FileEntitySchema())])
         raise ValueError("Could not set up input port. Invalid input method!")
 
     def setup_output_port(self) -> Port | None:
@@ -349,5 +374,5 @@ class ExecuteCommands(WorkflowPlugin):
         if self.output_method == STRUCTURED_OUPUT:
             return FixedSchemaPort(schema=generate_schema())
         if self.output_method == FILE_OUTPUT:
-            return FixedSchemaPort(schema=FileEntitySchema())
+            return FixedSchemaPort(schema=typed_files.FileEntitySchema())
         raise ValueError("Could not set up output port. Invalid output method!")
@@ -0,0 +1,41 @@
+"""Lazily imported dependencies
+
+Corporate Memory imports all plugin packages to discover their plugins, also if no
+SSH task is executed. paramiko (and cryptography through it) and the file entities of
+cmem-plugin-base (and the Corporate Memory client through them) are therefore only
+loaded on the first access to one of their attributes, e.g. when connecting.
+"""
+
+import importlib.util
+import sys
+from types import ModuleType
+from typing import TYPE_CHECKING
+
+
+def lazy_import(name: str) -> ModuleType:
+    """Import a module on first attribute access instead of now"""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    if spec is None or spec.loader is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    parent, _, child = name.rpartition(".")
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+if TYPE_CHECKING:
+    import paramiko
+    from cmem_plugin_base.dataintegration.typed_entities import file as typed_files
+else:
+    paramiko = lazy_import("paramiko")
+    typed_files = lazy_import("cmem_plugin_base.dataintegration.typed_entities.file")
+
+__all__ = ["lazy_import", "paramiko", "typed_files"]
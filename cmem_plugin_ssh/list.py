@@ -1,8 +1,8 @@
 """SSH List files task plugin"""
 
-from collections.abc import Sequence
+from collections.abc import Generator, Iterator, Sequence
+from typing import TYPE_CHECKING
 
-import paramiko
 from cmem_plugin_base.dataintegration.context import ExecutionContext, ExecutionReport
 from cmem_plugin_base.dataintegration.description import Icon, Plugin, PluginAction, PluginParameter
 from cmem_plugin_base.dataintegration.entity import Entities, Entity
@@ -12,16 +12,37 @@ from cmem_plugin_base.dataintegration.plugins import WorkflowPlugin
 from cmem_plugin_base.dataintegration.ports import FixedNumberOfInputs, FixedSchemaPort
 
 from cmem_plugin_ssh.autocompletion import DirectoryParameterType
+from cmem_plugin_ssh.connection import (
+    SSH_CONNECTIONS,
+    ConnectionKey,
+    connection_key,
+    open_sftp_session,
+    open_transports,
+)
+from cmem_plugin_ssh.lazy import paramiko
 from cmem_plugin_ssh.retrieval import SSHRetrieval
+from cmem_plugin_ssh.snapshot import Snapshot
 from cmem_plugin_ssh.utils import (
+    ACCESS_CHECK_CHOICES,
     AUTHENTICATION_CHOICES,
     ERROR_HANDLING_CHOICES,
+    LISTING_METHOD_CHOICES,
+    METADATA,
+    SAMPLE_SIZE,
+    SFTP_LISTING,
+    generate_list_entity,
     generate_list_schema,
     load_private_key,
     preview_results,
+    setup_max_depth,
     setup_max_workers,
+    setup_ssh_connections,
+    split_patterns,
 )
 
+if TYPE_CHECKING:
+    from paramiko import SFTPAttributes
+
 
 @Plugin(
     label="List SSH files",
@@ -50,11 +71,39 @@ is no correct permission.
 and skips folder when there is no correct permission.
 * **Error:** Throws an error when there is a single file or folder with incorrect permission rights.
 
+#### Access check modes:
+* **File metadata:** Read access is derived from the mode, owner and group of each file and the
+user and group ids of the remote user (determined once with `id`). Symbolic links are opened.
+* **Open files (strict):** Every file is opened to verify read access. This also respects access
+control lists, but costs several requests per file.
+
+Files are handed to the following workflow tasks while the folder is still being listed.
+With the error handling mode **Error**, the listing is completed first, so no entities are
+output if a single file is not accessible.
+
+#### Incremental listing:
+With a snapshot file, the folders and files of each complete listing are stored locally.
+On the next execution, folders whose modification time did not change are taken from the
+snapshot instead of being listed again, and the output can be limited to new or changed files.
+Note that a file modified in place does not change the modification time of its folder.
+With a snapshot file, folders are always listed with SFTP.
+
+#### Listing methods:
+* **SFTP:** Every folder is listed with separate SFTP requests, distributed over the workers.
+* **Remote find:** The whole folder tree is listed with a single `find` command on the server.
+This needs GNU find and command execution on the server, otherwise SFTP is used.
+
 #### Note:
 * If a connection cannot be established within 20 seconds, a timeout occurs.
+* Connections are kept open for up to 5 minutes after the task finished and reused by tasks
+connecting to the same host with the same user and credentials. At most 16 connections
+to a host are open at the same time, further tasks wait for one to be released.
 * Currently supported key types are: RSA, DSS, ECDSA, Ed25519.
-* Setting the maximum amount of workers to more than 1 may cause a Channel Exception when
-the amount of files is too large
+* The workers share a pool of at most one SFTP channel per worker. If the server allows
+fewer sessions per connection (MaxSessions), the pool shrinks to the channels it accepted
+and later probes for more, so a high number of workers does not fail the task.
+* With more than one SSH connection, new SFTP channels are opened on the connection with the
+fewest channels. Connections the server refuses are skipped.
     """,
     icon=Icon(package=__package__, file_name="ssh-icon.svg"),
     actions=[
@@ -129,8 +178,8 @@ the amount of files is too large
             "When choosing 'warning' all files get listed however there will be "
             "a mention that some of the files are not under the users permissions"
             "if there are any"
-            "When choosing 'error' the files will not get listed if there"
-            "there are files the user has no access to.",
+            "When choosing 'error' the task fails at the first file the user has no "
+            "access to.",
             param_type=ChoiceParameterType(ERROR_HANDLING_CHOICES),
             default_value="error",
         ),
@@ -141,12 +190,91 @@ the amount of files is too large
             "will be listed.",
             default_value=False,
         ),
+        PluginParameter(
+            name="access_check",
+            label="Access check",
+            description="How read access to files is checked for the error handling. "
+            "'File metadata' decides from the mode, owner and group of each file and the ids "
+            "of the remote user, which needs no extra requests per file. "
+            "'Open files (strict)' opens every file, which also respects access control lists "
+            "but is considerably slower.",
+            param_type=ChoiceParameterType(ACCESS_CHECK_CHOICES),
+            default_value=METADATA,
+            advanced=True,
+        ),
+        PluginParameter(
+            name="max_depth",
+            label="Maximum depth",
+            description="How many levels of subfolders are descended into. 0 only includes "
+            "the selected folder, -1 includes all subfolders.",
+            default_value=-1,
+            advanced=True,
+        ),
+        PluginParameter(
+            name="include_folders",
+            label="Include folders",
+            description="Comma separated patterns of subfolders to descend into, for example "
+            "'data*, reports'. A pattern matches the name of a folder at any depth or its "
+            "path relative to the selected folder. Subfolders of a matching folder are "
+            "included as well, other folders are only passed on the way to matching folders, "
+            "like 'archive' for 'archive/2024', without listing their files. "
+            "Leave empty to include all subfolders.",
+            default_value="",
+            advanced=True,
+        ),
+        PluginParameter(
+            name="exclude_folders",
+            label="Exclude folders",
+            description="Comma separated patterns of subfolders that are not descended into, "
+            "for example '.git, node_modules, archive/*'. A pattern matches the name of a "
+            "folder or its path relative to the selected folder. Files in excluded folders "
+            "are not listed and the folders are not listed at all.",
+            default_value="",
+            advanced=True,
+        ),
+        PluginParameter(
+            name="snapshot_file",
+            label="Snapshot file",
+            description="Local file in which the folders and files of the last complete listing "
+            "are stored. Folders whose modification time did not change since then are not "
+            "listed again. Leave empty to list all folders on every execution.",
+            default_value="",
+            advanced=True,
+        ),
+        PluginParameter(
+            name="changed_only",
+            label="Only changed files",
+            description="When this flag is set, only files that are new or changed in size or "
+            "modification time since the last execution will be listed. "
+            "Needs a snapshot file.",
+            default_value=False,
+            advanced=True,
+        ),
+        PluginParameter(
+            name="listing_method",
+            label="Listing method",
+            description="How the folder is listed. 'SFTP' lists every folder with a separate "
+            "request. 'Remote find' lists the whole folder tree with a single `find` command "
+            "on the server, which is much faster for large trees. It needs GNU find and "
+            "command execution on the server and falls back to SFTP otherwise.",
+            param_type=ChoiceParameterType(LISTING_METHOD_CHOICES),
+            default_value=SFTP_LISTING,
+            advanced=True,
+        ),
         PluginParameter(
             name="max_workers",
             label="Maximum amount of workers.",
             description="Determines the amount of workers used for concurrent thread execution "
-            "of the task. Default is 1, maximum is 32. Note that too many workers can cause a "
-            "ChannelException.",
+            "of the task. Default is 1, maximum is 32.",
+            default_value=1,
+            advanced=True,
+        ),
+        PluginParameter(
+            name="ssh_connections",
+            label="SSH connections",
+            description="Number of SSH connections the workers spread their SFTP channels over. "
+            "Every connection encrypts its traffic in a single thread, so with many workers "
+            "more connections can list and download faster. Default is 1, maximum is 8.",
             default_value=1,
             advanced=True,
         ),
@@ -155,8 +283,8 @@ the amount of files is too large
 class ListFiles(WorkflowPlugin):
     """List Plugin SSH"""
 
-    ssh_client: paramiko.SSHClient
-    sftp: paramiko.SFTPClient
+    ssh_client: "paramiko.SSHClient"
+    sftp: "paramiko.SFTPClient"
 
     def __init__(  # noqa: PLR0913
         self,
@@ -171,6 +299,14 @@ class ListFiles(WorkflowPlugin):
         no_subfolder: bool,
         regex: str = "",
         max_workers: int = 1,
+        ssh_connections: int = 1,
+        access_check: str = METADATA,
+        listing_method: str = SFTP_LISTING,
+        snapshot_file: str = "",
+        changed_only: bool = False,
+        max_depth: int = -1,
+        include_folders: str = "",
+        exclude_folders: str = "",
     ):
         self.hostname = hostname
         self.port = port
@@ -183,19 +319,39 @@ class ListFiles(WorkflowPlugin):
         self.no_subfolder = no_subfolder
         self.regex = rf"{regex}"
         self.max_workers = setup_max_workers(max_workers)
+        self.ssh_connections = setup_ssh_connections(ssh_connections)
+        self.transports: list[paramiko.SSHClient] = []
+        self.access_check = access_check
+        self.listing_method = listing_method
+        self.snapshot_file = snapshot_file
+        self.changed_only = changed_only
+        setup_max_depth(max_depth)
+        self.max_depth = max_depth
+        self.include_folders = include_folders
+        self.exclude_folders = exclude_folders
         self.input_ports = FixedNumberOfInputs([])
         self.output_port = FixedSchemaPort(schema=generate_list_schema())
 
     def cleanup_ssh_connections(self) -> None:
-        """Close connection from sftp and ssh"""
+        """Close the SFTP session and return the SSH connection to the connection pool"""
         self.sftp.close()
-        self.ssh_client.close()
+        SSH_CONNECTIONS.checkin(self.connection_key(), self.ssh_client)
+        for transport in self.transports:
+            SSH_CONNECTIONS.checkin(self.connection_key(), transport)
+        self.transports = []
+
+    def open_transports(self) -> None:
+        """Open the SSH connections beyond the first one for the workers"""
+        self.transports = open_transports(
+            self.connection_key(), self.ssh_connections - 1, self.establish_ssh_connection
+        )
 
-    def establish_ssh_connection(self) -> None:
+    def establish_ssh_connection(self, ssh_client: "paramiko.SSHClient | None" = None) -> None:
         """Connect to the ssh client with the selected authentication method"""
+        ssh_client = ssh_client or self.ssh_client
         if self.authentication_method == "key":
-            self.ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            self.ssh_client.connect(
+            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            ssh_client.connect(
                 hostname=self.hostname,
                 username=self.username,
                 pkey=load_private_key(self.private_key, self.password),
@@ -204,8 +360,8 @@ class ListFiles(WorkflowPlugin):
                 timeout=20,
             )
         elif self.authentication_method == "password":
-            self.ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            self.ssh_client.connect(
+            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            ssh_client.connect(
                 hostname=self.hostname,
                 username=self.username,
                 password=self.password,
@@ -216,19 +372,38 @@ class ListFiles(WorkflowPlugin):
     def preview_results(self) -> str:
         """Preview the results of an execution"""
         self._initialize_ssh_and_sftp_connections()
-        return preview_results(
-            ssh_client=self.ssh_client,
-            no_subfolder=self.no_subfolder,
-            regex=self.regex,
-            path=self.path,
-            error_handling=self.error_handling,
-            max_workers=self.max_workers,
+        try:
+            return preview_results(
+                ssh_client=self.ssh_client,
+                no_subfolder=self.no_subfolder,
+                regex=self.regex,
+                path=self.path,
+                error_handling=self.error_handling,
+                max_workers=self.max_workers,
+                access_check=self.access_check,
+                listing_method=self.listing_method,
+                depth=setup_max_depth(self.max_depth),
+                include_folders=split_patterns(self.include_folders),
+                exclude_folders=split_patterns(self.exclude_folders),
+            )
+        finally:
+            self.cleanup_ssh_connections()
+
+    def connection_key(self) -> ConnectionKey:
+        """Key of the pooled SSH connections for the connection parameters"""
+        return connection_key(
+            self.hostname,
+            self.port,
+            self.username,
+            self.authentication_method,
+            self.private_key,
+            self.password,
         )
 
     def _initialize_ssh_and_sftp_connections(self) -> None:
-        self.ssh_client = paramiko.SSHClient()
-        self.establish_ssh_connection()
-        self.sftp = self.ssh_client.open_sftp()
+        self.ssh_client, self.sftp = open_sftp_session(
+            self.connection_key(), self.establish_ssh_connection
+        )
 
     def execute(self, inputs: Sequence[Entities], context: ExecutionContext) -> Entities:
         """Execute the workflow task"""
@@ -236,74 +411,65 @@ class ListFiles(WorkflowPlugin):
         context.report.update(
             ExecutionReport(entity_count=0, operation="wait", operation_desc="files listed.")
         )
-        entities = []
 
+        # read the snapshot first, so a broken file does not leave connections checked out
+        snapshot = Snapshot(self.snapshot_file) if self.snapshot_file else None
+        depth = setup_max_depth(self.max_depth)
         self._initialize_ssh_and_sftp_connections()
+        self.open_transports()
 
         retrieval = SSHRetrieval(
             ssh_client=self.ssh_client,
             no_subfolder=self.no_subfolder,
             regex=self.regex,
+            access_check=self.access_check,
+            listing_method=self.listing_method,
+            snapshot=snapshot,
+            changed_only=self.changed_only,
+            include_folders=split_patterns(self.include_folders),
+            exclude_folders=split_patterns(self.exclude_folders),
+            transports=self.transports,
         )
-        all_files = retrieval.list_files_parallel(
-            files=[],
+        no_access_files: list[SFTPAttributes] = []
+        files = retrieval.iter_files(
             context=context,
             path=self.path,
             workers=self.max_workers,
             error_handling=self.error_handling,
-            no_access_files=[],
+            no_access_files=no_access_files,
+            depth=depth,
         )
-        files = all_files[0]
-        context.report.update(
-            ExecutionReport(
-                entity_count=len(files), operation="wait", operation_desc="files listed."
-            )
+        return Entities(
+            entities=self.generate_entities(files, no_access_files, context),
+            schema=generate_list_schema(),
         )
 
-        for file in files:
-            entities.append(
-                Entity(
-                    uri=file.filename,
-                    values=[
-                        [file.filename],
-                        [str(file.st_size)],
-                        [str(file.st_uid)],
-                        [str(file.st_gid)],
-                        [str(file.st_mode)],
-                        [str(file.st_atime)],
-                        [str(file.st_mtime)],
-                    ],
-                )
-            )
-            context.report.update(
-                ExecutionReport(
-                    entity_count=len(entities),
-                    operation="write",
-                    operation_desc="entities generated",
-                )
-            )
+    def generate_entities(
+        self,
+        files: "Iterator[SFTPAttributes]",
+        no_access_files: "list[SFTPAttributes]",
+        context: ExecutionContext,
+    ) -> Iterator[Entity]:
+        """Generate entities while the files are listed"""
+        entity_count = 0
+        sample_entities: list[Entity] = []
+        try:
+            for file in files:
+                entity = generate_list_entity(file)
+                entity_count += 1
+                if len(sample_entities) < SAMPLE_SIZE:
+                    sample_entities.append(entity)
+                yield entity
+        finally:
+            if isinstance(files, Generator):
+                files.close()
+            self.cleanup_ssh_connections()
 
-        if self.error_handling == "warning" and len(all_files[1]) > 0:
-            faulty_files = all_files[1]
-            faulty_entities = []
-            for file in faulty_files:
-                faulty_entities.append(  # noqa: PERF401
-                    Entity(
-                        uri=file.filename,
-                        values=[
-                            [file.filename],
-                            [str(file.st_size)],
-                            [str(file.st_uid)],
-                            [str(file.st_gid)],
-                            [str(file.st_mode)],
-                            [str(file.st_atime)],
-                            [str(file.st_mtime)],
-                        ],
-                    )
-                )
+        if self.error_handling == "warning" and len(no_access_files) > 0:
+            faulty_entities = [generate_list_entity(file) for file in no_access_files]
             context.report.update(
                 ExecutionReport(
-                    entity_count=len(entities),
+                    entity_count=entity_count,
                     operation="done",
                     operation_desc="entities generated",
                     sample_entities=Entities(
@@ -319,18 +485,11 @@ class ListFiles(WorkflowPlugin):
         else:
             context.report.update(
                 ExecutionReport(
-                    entity_count=len(entities),
+                    entity_count=entity_count,
                     operation="done",
                     operation_desc="entities generated",
                     sample_entities=Entities(
-                        entities=iter(entities[:10]), schema=generate_list_schema()
+                        entities=iter(sample_entities), schema=generate_list_schema()
                     ),
                 )
             )
-
-        self.cleanup_ssh_connections()
-
-        return Entities(
-            entities=iter(entities),
-            schema=generate_list_schema(),
-        )
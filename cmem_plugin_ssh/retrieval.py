@@ -1,169 +1,783 @@
 """Retrieval class for SSH files"""
 
+import contextlib
+import errno
+import itertools
+import os
+import queue
 import re
+import shlex
 import stat
 import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Any
+import time
+from collections import deque
+from contextlib import contextmanager
+from fnmatch import fnmatchcase
+from typing import TYPE_CHECKING, Any
 
-import paramiko
 from cmem_plugin_base.dataintegration.context import ExecutionContext, ExecutionReport
-from paramiko import SFTPAttributes, SSHClient
 
+from cmem_plugin_ssh.connection import SFTPChannelPool, run_probe
+from cmem_plugin_ssh.lazy import paramiko
+from cmem_plugin_ssh.snapshot import Snapshot
 
-def context_report(context: ExecutionContext, files: list[Any]) -> None:
+if TYPE_CHECKING:
+    from collections.abc import Generator, Iterator, Sequence
+
+    from paramiko import SFTPAttributes, SFTPClient, SSHClient
+
+RESULT_QUEUE_SIZE = 1000
+REPORT_INTERVAL = 0.25
+
+
+FIND_FORMAT = r"%y %m %U %G %s %A@ %T@ %P\0"
+FIND_CHUNK_SIZE = 32768
+FIND_FILE_TYPES = {
+    "f": stat.S_IFREG,
+    "d": stat.S_IFDIR,
+    "l": stat.S_IFLNK,
+    "p": stat.S_IFIFO,
+    "s": stat.S_IFSOCK,
+    "c": stat.S_IFCHR,
+    "b": stat.S_IFBLK,
+}
+
+
+def parse_find_record(root: str, record: bytes) -> "tuple[str, SFTPAttributes]":
+    """Parse a record printed with FIND_FORMAT into its directory and attributes"""
+    file_type, mode, uid, gid, size, atime, mtime, relative_path = record.decode(
+        errors="replace"
+    ).split(" ", 7)
+    directory, _, filename = relative_path.rpartition("/")
+    item = paramiko.SFTPAttributes()
+    item.filename = filename
+    item.st_mode = FIND_FILE_TYPES.get(file_type, 0) | int(mode, 8)
+    item.st_uid = int(uid)
+    item.st_gid = int(gid)
+    item.st_size = int(size)
+    item.st_atime = int(float(atime))
+    item.st_mtime = int(float(mtime))
+    return f"{root.rstrip('/')}/{directory}" if directory else root, item
+
+
+def context_report(
+    context: ExecutionContext | None,
+    count: int,
+    operation: str = "wait",
+    operation_desc: str = "files listed",
+) -> None:
     """Report for user context"""
     if context is not None:
         context.report.update(
-            ExecutionReport(
-                entity_count=len(files), operation="wait", operation_desc="files listed"
-            )
+            ExecutionReport(entity_count=count, operation=operation, operation_desc=operation_desc)
         )
 
 
+class Watchdog:
+    """Throttled cancellation check and progress report for an execution context
+
+    The context is only touched from the thread calling `poll`, and at most once per
+    interval, so the crawler threads never wait for it and only read `stop_event`.
+    """
+
+    def __init__(
+        self,
+        context: ExecutionContext | None,
+        stop_event: threading.Event,
+        interval: float = REPORT_INTERVAL,
+        operation: str = "wait",
+        operation_desc: str = "files listed",
+    ):
+        self.context = context
+        self.stop_event = stop_event
+        self.interval = interval
+        self.operation = operation
+        self.operation_desc = operation_desc
+        self.reported = -1
+        self.next_poll = 0.0
+        self.cancelled = False
+
+    def poll(self, count: int, force: bool = False) -> bool:
+        """Check for cancellation and report the count if the interval has passed
+
+        Returns True once the workflow is cancelled.
+        """
+        if self.context is None or self.cancelled:
+            return self.cancelled
+        now = time.monotonic()
+        if not force and now < self.next_poll:
+            return False
+        self.next_poll = now + self.interval
+        if self.is_canceling():
+            self.cancelled = True
+            self.stop_event.set()
+        if count != self.reported:
+            self.reported = count
+            context_report(self.context, count, self.operation, self.operation_desc)
+        return self.cancelled
+
+    def is_canceling(self) -> bool:
+        """Check whether the workflow is being cancelled"""
+        try:
+            return bool(self.context.workflow.status() == "Canceling")  # type: ignore[union-attr]
+        except AttributeError:
+            return False
+
+
+# directory path, depth and modification time (None if not known yet)
+WorkItem = tuple[str, int, int | None]
+
+
+class Frontier:
+    """Shared work queue of directories that still have to be listed
+
+    Tracks enqueued but unfinished directories, so the crawl is finished as soon as
+    the queue is empty and no worker is still listing a directory.
+    """
+
+    def __init__(self):
+        self._items: deque[WorkItem] = deque()
+        self._pending = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def put(self, item: WorkItem) -> None:
+        """Add a directory to the frontier"""
+        with self._condition:
+            self._items.append(item)
+            self._pending += 1
+            self._condition.notify()
+
+    def get(self) -> WorkItem | None:
+        """Take the next directory, or None when the crawl is finished or closed"""
+        with self._condition:
+            while not self._items:
+                if self._closed or self._pending == 0:
+                    return None
+                self._condition.wait()
+            if self._closed:
+                return None
+            return self._items.popleft()
+
+    def task_done(self) -> None:
+        """Mark a directory taken with get as listed"""
+        with self._condition:
+            self._pending -= 1
+            if self._pending == 0:
+                self._condition.notify_all()
+
+    def close(self) -> None:
+        """Stop handing out directories and release all waiting workers"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
 class SSHRetrieval:
     """Retrieval class for listing files of an SSH instance"""
 
-    def __init__(
+    def __init__(  # noqa: PLR0913
         self,
-        ssh_client: SSHClient,
+        ssh_client: "SSHClient",
         no_subfolder: bool,
         regex: str,
+        access_check: str = "metadata",
+        listing_method: str = "sftp",
+        snapshot: Snapshot | None = None,
+        changed_only: bool = False,
+        include_folders: list[str] | None = None,
+        exclude_folders: list[str] | None = None,
+        transports: "Sequence[SSHClient]" = (),
     ):
         self.ssh_client = ssh_client  # Use SSHClient instead of SFTPClient
+        self.transports = transports  # further SSH clients the SFTP channels are spread over
         self.no_subfolder = no_subfolder
         self.regex = regex
-        self.lock = threading.Lock()
+        self.access_check = access_check
+        self.listing_method = listing_method
+        self.snapshot = snapshot
+        self.changed_only = changed_only and snapshot is not None
+        self.include_folders = include_folders or []
+        self.exclude_folders = exclude_folders or []
+        self.identity: tuple[int, set[int]] | None = None
         self.stop_event = threading.Event()
-        self.sftp_pool = threading.local()  # Thread-local SFTP client
+        self.hit_counter = itertools.count(1)
+        self.crawl_complete = False
+        self.root = ""
+        self.channels: SFTPChannelPool | None = None
+
+    @contextmanager
+    def sftp_channel(self) -> "Iterator[SFTPClient]":
+        """Check out a channel of the pool for a request"""
+        if self.channels is None:
+            raise ValueError("SFTP channels are only available while listing files")
+        with self.channels.channel() as client:
+            yield client
 
-    def get_sftp(self) -> Any:  # noqa: ANN401
-        """Generate thread-local SFTP-client access"""
-        if not hasattr(self.sftp_pool, "client"):
-            self.sftp_pool.client = self.ssh_client.open_sftp()
-        return self.sftp_pool.client
+    def normalize_path(self, path: str) -> str:
+        """Resolve the canonical absolute path of the directory to list
+
+        Subdirectories are addressed by appending their names to this path, so the
+        server is asked only once. If the path cannot be resolved, it is kept as
+        given and listing it reports the error according to the error handling.
+        """
+        try:
+            with self.sftp_channel() as sftp:
+                return str(sftp.normalize(path or "."))
+        except (paramiko.SFTPError, OSError):
+            return path
 
-    def list_files_parallel(  # noqa: PLR0913, C901, PLR0912
+    def list_files_parallel(  # noqa: PLR0913
         self,
         path: str,
-        files: list[SFTPAttributes],
-        no_access_files: list[SFTPAttributes],
+        files: "list[SFTPAttributes]",
+        no_access_files: "list[SFTPAttributes]",
         error_handling: str,
         context: ExecutionContext | None,
         depth: int = -1,
-        curr_depth: int = 0,
         no_of_max_hits: int = -1,
         workers: int = 1,
-    ) -> tuple[list[SFTPAttributes], list[SFTPAttributes]]:
+    ) -> "tuple[list[SFTPAttributes], list[SFTPAttributes]]":
         """List all files recursively with concurrency"""
-        if curr_depth == 0:
-            self.stop_event.clear()
+        files.extend(
+            self.iter_files(
+                path=path,
+                no_access_files=no_access_files,
+                error_handling=error_handling,
+                context=context,
+                depth=depth,
+                no_of_max_hits=no_of_max_hits,
+                workers=workers,
+            )
+        )
+        return files, no_access_files
 
-        self.cancel_listdir(context)
-        if self.stop_event.is_set() or (depth != -1 and curr_depth >= depth):
-            return files, no_access_files
+    def iter_files(  # noqa: PLR0913
+        self,
+        path: str,
+        no_access_files: "list[SFTPAttributes]",
+        error_handling: str,
+        context: ExecutionContext | None,
+        depth: int = -1,
+        no_of_max_hits: int = -1,
+        workers: int = 1,
+        channels: SFTPChannelPool | None = None,
+    ) -> "Iterator[SFTPAttributes]":
+        """Yield matching files while the directory tree is still being crawled
 
-        subdirectories: list[str] = []
-        items = self._get_folder_items(path, error_handling)
+        A fixed pool of `workers` crawler threads pulls directories from one shared
+        frontier. Every worker checks out a channel of a pool with at most `workers`
+        SFTP channels per request and issues one request at a time, so `workers` is a
+        hard cap on concurrent SFTP requests. All channels are closed when the listing
+        ends, unless the pool is given as `channels` to share it with the consumer.
+        Found files are handed over through a bounded queue, which blocks the crawlers
+        while the consumer is busy, so memory does not grow with the size of the tree.
+        Files without access are appended to `no_access_files` on the way.
+        If a snapshot is given, it is saved once the whole tree has been crawled.
+        """
+        files = self.stream_files(
+            path, no_access_files, error_handling, context, depth, no_of_max_hits, workers, channels
+        )
+        with contextlib.closing(files):
+            for item in files:
+                if item is not None:
+                    yield item
 
-        for item in items:
-            full_path = f"{path.rstrip('/')}/{item.filename}"
-            item_mode = item.st_mode
+    def stream_files(  # noqa: PLR0913
+        self,
+        path: str,
+        no_access_files: "list[SFTPAttributes]",
+        error_handling: str,
+        context: ExecutionContext | None,
+        depth: int = -1,
+        no_of_max_hits: int = -1,
+        workers: int = 1,
+        channels: SFTPChannelPool | None = None,
+        save_snapshot: bool = True,
+    ) -> "Generator[SFTPAttributes | None]":
+        """Like `iter_files`, but yield None whenever no file was found for 100 ms
 
-            if not stat.S_ISDIR(item_mode):
-                try:
-                    with self.get_sftp().open(full_path, "r") as f:
-                        f.read(1)
-                except (PermissionError, OSError) as e:
-                    if error_handling == "ignore":
-                        pass
-                    elif error_handling == "warning":
-                        no_access_files.append(item)
-                    else:
-                        raise ValueError(f"No access to '{item.filename}': {e}") from e
-            self.cancel_listdir(context)
-            if self.stop_event.is_set():
-                return files, no_access_files
+        This hands control back to the consumer while the crawlers are busy, so it can
+        do other work meanwhile, e.g. output finished downloads. Without `save_snapshot`,
+        the consumer calls the method of that name once it is done with the files.
+        """
+        self.stop_event.clear()
+        self.hit_counter = itertools.count(1)
+        self.crawl_complete = False
+        if self.access_check != "strict" and self.identity is None:
+            self.identity = self.get_remote_identity()
+        self.channels = channels or SFTPChannelPool(
+            self.ssh_client, max_size=workers, transports=self.transports
+        )
+        with contextlib.nullcontext() if channels else self.channels:
+            yield from self._crawl_tree(
+                path, no_access_files, error_handling, context, depth, no_of_max_hits, workers
+            )
+        if save_snapshot:
+            self.save_snapshot()
 
-            added = self.add_node(files, item, no_of_max_hits, path)
+    def save_snapshot(self) -> None:
+        """Save the snapshot, if one is given and the last crawl visited every directory"""
+        if self.snapshot is not None and self.crawl_complete:
+            self.snapshot.save()
 
-            context_report(context, files)
+    def _crawl_tree(  # noqa: PLR0913
+        self,
+        path: str,
+        no_access_files: "list[SFTPAttributes]",
+        error_handling: str,
+        context: ExecutionContext | None,
+        depth: int,
+        no_of_max_hits: int,
+        workers: int,
+    ) -> "Iterator[SFTPAttributes | None]":
+        """Start the crawlers and yield their results until the crawl is finished
+
+        None is yielded whenever no result arrived within 100 ms.
+        """
+        root = self.normalize_path(path)
+        self.root = root
+        frontier = Frontier()
+        results: queue.Queue[SFTPAttributes] = queue.Queue(maxsize=RESULT_QUEUE_SIZE)
+        errors: list[Exception] = []
+        crawlers = self._start_crawlers(
+            root,
+            frontier,
+            results,
+            no_access_files,
+            error_handling,
+            depth,
+            no_of_max_hits,
+            workers,
+            errors,
+        )
 
-            if added and self.check_stop(files, no_of_max_hits):
-                return files, no_access_files
+        count = 0
+        crawl_complete = False
+        watchdog = Watchdog(context, self.stop_event)
+        try:
+            while True:
+                if watchdog.poll(count):
+                    break
+                if errors:
+                    raise errors[0]
+                try:
+                    item = results.get(timeout=0.1)
+                except queue.Empty:
+                    if not any(crawler.is_alive() for crawler in crawlers) and results.empty():
+                        break
+                    yield None
+                    continue
+                count += 1
+                yield item
+            crawl_complete = not self.stop_event.is_set()
+            watchdog.poll(count, force=True)
+        finally:
+            self.stop_event.set()
+            frontier.close()
+            # unblock crawlers waiting for space in the result queue
+            while any(crawler.is_alive() for crawler in crawlers):
+                with contextlib.suppress(queue.Empty):
+                    results.get(timeout=0.05)
 
-            if item_mode and stat.S_ISDIR(item_mode) and not self.no_subfolder:
-                subdirectories.append(full_path)
+        if errors:
+            raise errors[0]
+        # a stopped crawl did not visit every directory
+        self.crawl_complete = crawl_complete
 
-        if subdirectories and not self.stop_event.is_set():
-            with ThreadPoolExecutor(max_workers=workers) as executor:
-                futures = [
-                    executor.submit(
-                        self.list_files_parallel,
-                        sd,
-                        files,
+    def _start_crawlers(  # noqa: PLR0913
+        self,
+        root: str,
+        frontier: Frontier,
+        results: "queue.Queue[SFTPAttributes]",
+        no_access_files: "list[SFTPAttributes]",
+        error_handling: str,
+        depth: int,
+        no_of_max_hits: int,
+        workers: int,
+        errors: list[Exception],
+    ) -> list[threading.Thread]:
+        """Start a single find crawler if selected and available, SFTP crawlers otherwise"""
+        # the snapshot is built from per-directory listings, which find does not provide
+        if self.listing_method == "find" and self.snapshot is None and self.find_available(root):
+            crawlers = [
+                threading.Thread(
+                    target=self._find,
+                    args=(
+                        root,
+                        results,
                         no_access_files,
                         error_handling,
-                        None,
                         depth,
-                        curr_depth + 1,
                         no_of_max_hits,
-                        workers,
+                        errors,
+                    ),
+                    daemon=True,
+                )
+            ]
+        else:
+            frontier.put((root, 0, None))
+            crawlers = [
+                threading.Thread(
+                    target=self._crawl,
+                    args=(
+                        frontier,
+                        results,
+                        no_access_files,
+                        error_handling,
+                        depth,
+                        no_of_max_hits,
+                        errors,
+                    ),
+                    daemon=True,
+                )
+                for _ in range(workers)
+            ]
+        for crawler in crawlers:
+            crawler.start()
+        return crawlers
+
+    def _crawl(  # noqa: PLR0913
+        self,
+        frontier: Frontier,
+        results: "queue.Queue[SFTPAttributes]",
+        no_access_files: "list[SFTPAttributes]",
+        error_handling: str,
+        depth: int,
+        no_of_max_hits: int,
+        errors: list[Exception],
+    ) -> None:
+        """Crawler worker: list directories from the frontier until it is exhausted"""
+        while (work_item := frontier.get()) is not None:
+            path, curr_depth, mtime = work_item
+            try:
+                if not self.stop_event.is_set() and (depth == -1 or curr_depth < depth):
+                    # channels are only checked out per request, so a crawler blocked on the
+                    # full result queue does not hold one that a consumer is waiting for
+                    self._list_directory(
+                        frontier,
+                        results,
+                        path,
+                        curr_depth,
+                        mtime,
+                        no_access_files,
+                        error_handling,
+                        no_of_max_hits,
                     )
-                    for sd in subdirectories
-                ]
-                for fut in as_completed(futures):
-                    self.cancel_listdir(context)
-                    if self.stop_event.is_set():
-                        break
-                    fut.result()
-                    context_report(context, files)
+            except Exception as e:  # noqa: BLE001
+                errors.append(e)
+                self.stop_event.set()
+            finally:
+                frontier.task_done()
+            if self.stop_event.is_set():
+                frontier.close()
 
-        return files, no_access_files
+    def _list_directory(  # noqa: PLR0913
+        self,
+        frontier: Frontier,
+        results: "queue.Queue[SFTPAttributes]",
+        path: str,
+        curr_depth: int,
+        mtime: int | None,
+        no_access_files: "list[SFTPAttributes]",
+        error_handling: str,
+        no_of_max_hits: int,
+    ) -> None:
+        """List a single directory and add its subdirectories to the frontier
 
-    def check_stop(self, files: list[Any], max_results: int) -> bool:
-        """Check whether max_results reached and stop if so"""
-        with self.lock:
-            if max_results != -1 and len(files) >= max_results:
-                self.stop_event.set()
+        `path` is the canonical absolute path of the directory, so paths of files and
+        subdirectories are built without asking the server.
+        """
+        items, unchanged = self._get_directory_items(path, mtime, error_handling)
+        # folders only descended into on the way to an include pattern list no files
+        selected = self.folder_selected(path)
+
+        for item in items:
+            full_path = f"{path.rstrip('/')}/{item.filename}"
+            changed = not self.changed_only or (
+                not unchanged and self.snapshot is not None and self.snapshot.is_changed(path, item)
+            )
+            if (
+                selected
+                and changed
+                and self._process_item(
+                    results, item, path, full_path, no_access_files, error_handling, no_of_max_hits
+                )
+            ):
+                return
+
+            if (
+                item.st_mode
+                and stat.S_ISDIR(item.st_mode)
+                and not self.no_subfolder
+                and self.folder_selected(full_path, descend=True)
+            ):
+                # the modification time of subdirectories taken from the snapshot is outdated
+                frontier.put((full_path, curr_depth + 1, None if unchanged else item.st_mtime))
+
+    def folder_selected(self, path: str, descend: bool = False) -> bool:
+        """Check a folder below the root against the folder include and exclude patterns
+
+        Patterns match the name or the path relative to the root of a folder. The files
+        of a folder are listed if neither it nor one of its parent folders matches an
+        exclude pattern and, if include patterns are given, it or one of its parent
+        folders matches an include pattern. Parent folders are checked as well, so the
+        result is the same for items that find reports from deep inside the tree.
+
+        With `descend`, a folder is selected as well if a folder below it may match an
+        include pattern, so the crawl reaches it: any folder for a pattern without a
+        path, which matches a name at any depth, or the beginning of a pattern with a
+        path, e.g. `archive` for `archive/2024`.
+        """
+        if not (self.include_folders or self.exclude_folders):
+            return True
+        relative_path = path[len(self.root.rstrip("/")) + 1 :]
+        if not relative_path:
+            return True
+        parts = relative_path.split("/")
+        included = not self.include_folders
+        for index, name in enumerate(parts):
+            prefix = "/".join(parts[: index + 1])
+            if any(
+                fnmatchcase(name, pattern) or fnmatchcase(prefix, pattern)
+                for pattern in self.exclude_folders
+            ):
+                return False
+            included = included or any(
+                fnmatchcase(name, pattern) or fnmatchcase(prefix, pattern)
+                for pattern in self.include_folders
+            )
+        return included or (descend and self.leads_to_include(parts))
+
+    def leads_to_include(self, parts: list[str]) -> bool:
+        """Check whether a folder below a relative folder path may match an include pattern"""
+        for pattern in self.include_folders:
+            pattern_parts = pattern.split("/")
+            if len(pattern_parts) == 1:
+                return True
+            if len(parts) < len(pattern_parts) and all(
+                fnmatchcase(part, pattern_part)
+                for part, pattern_part in zip(parts, pattern_parts, strict=False)
+            ):
                 return True
         return False
 
-    def cancel_listdir(self, context: ExecutionContext) -> None:
-        """Cancel listdir if workflow is cancelled"""
+    def _get_directory_items(
+        self, path: str, mtime: int | None, error_handling: str
+    ) -> tuple[Any, bool]:
+        """List a directory, from the snapshot if it is unchanged since the last crawl
+
+        Returns the items and whether they were taken from the snapshot.
+        """
+        if self.snapshot is None:
+            return self._get_folder_items(path, error_handling), False
+
+        if mtime is None:
+            try:
+                with self.sftp_channel() as sftp:
+                    mtime = sftp.stat(path).st_mtime or 0
+            except (paramiko.ChannelException, OSError, paramiko.SFTPError):
+                # listing the directory reports the error according to the error handling
+                return self._get_folder_items(path, error_handling), False
+
+        cached_items = self.snapshot.cached_entries(path, mtime)
+        if cached_items is not None:
+            self.snapshot.record(path, mtime, cached_items)
+            return cached_items, True
+        return self._get_folder_items(path, error_handling, mtime), False
+
+    def _process_item(  # noqa: PLR0913
+        self,
+        results: "queue.Queue[SFTPAttributes]",
+        item: "SFTPAttributes",
+        path: str,
+        full_path: str,
+        no_access_files: "list[SFTPAttributes]",
+        error_handling: str,
+        no_of_max_hits: int,
+    ) -> bool:
+        """Check access to a listed item and add it, return True if the crawl has to stop"""
+        if not stat.S_ISDIR(item.st_mode or 0):
+            try:
+                self.check_access(item, full_path)
+            except (PermissionError, OSError) as e:
+                if error_handling == "ignore":
+                    pass
+                elif error_handling == "warning":
+                    no_access_files.append(item)
+                else:
+                    raise ValueError(f"No access to '{item.filename}': {e}") from e
+        if self.stop_event.is_set():
+            return True
+
+        self.add_node(results, item, no_of_max_hits, path)
+        return self.stop_event.is_set()
+
+    def find_available(self, root: str) -> bool:
+        """Check whether the server can list the folder with GNU find"""
         try:
-            if context.workflow.status() == "Canceling":
-                self.stop_event.set()
-        except AttributeError:
-            pass
+            probe = run_probe(self.ssh_client, f"find {shlex.quote(root)} -maxdepth 0 -printf %y")
+        except (paramiko.SSHException, OSError):
+            return False
+        return probe == b"d"
+
+    def _find(  # noqa: PLR0913
+        self,
+        root: str,
+        results: "queue.Queue[SFTPAttributes]",
+        no_access_files: "list[SFTPAttributes]",
+        error_handling: str,
+        depth: int,
+        no_of_max_hits: int,
+        errors: list[Exception],
+    ) -> None:
+        """Crawler: list the whole tree with a single streamed remote find command"""
+        try:
+            self._stream_find(root, results, no_access_files, error_handling, depth, no_of_max_hits)
+        except Exception as e:  # noqa: BLE001
+            errors.append(e)
+            self.stop_event.set()
+
+    def find_command(self, root: str, depth: int) -> str:
+        """Build the find command listing the tree below root"""
+        max_depth = 1 if self.no_subfolder else depth
+        command = f"find {shlex.quote(root)} -mindepth 1"
+        if max_depth != -1:
+            command += f" -maxdepth {max_depth}"
+        if self.exclude_folders:
+            # excluded folders are not descended into on the server
+            root_pattern = re.sub(r"([*?\[])", r"[\1]", root.rstrip("/"))
+            conditions = " -o ".join(
+                f"-name {shlex.quote(pattern)} -o -path {shlex.quote(f'{root_pattern}/{pattern}')}"
+                for pattern in self.exclude_folders
+            )
+            command += f" -type d \\( {conditions} \\) -prune -o"
+        return f"{command} -printf '{FIND_FORMAT}'"
+
+    def _stream_find(  # noqa: PLR0913
+        self,
+        root: str,
+        results: "queue.Queue[SFTPAttributes]",
+        no_access_files: "list[SFTPAttributes]",
+        error_handling: str,
+        depth: int,
+        no_of_max_hits: int,
+    ) -> None:
+        """Read the records of a remote find command and process them as listed items"""
+        _, stdout, stderr = self.ssh_client.exec_command(self.find_command(root, depth))
+        channel = stdout.channel
+        channel.settimeout(0.1)
+        try:
+            buffer = b""
+            while not self.stop_event.is_set():
+                try:
+                    chunk = channel.recv(FIND_CHUNK_SIZE)
+                except TimeoutError:
+                    continue
+                if not chunk:
+                    break
+                *records, buffer = (buffer + chunk).split(b"\0")
+                for record in records:
+                    path, item = parse_find_record(root, record)
+                    if not self.folder_selected(path):
+                        continue
+                    full_path = f"{path.rstrip('/')}/{item.filename}"
+                    if self._process_item(
+                        results,
+                        item,
+                        path,
+                        full_path,
+                        no_access_files,
+                        error_handling,
+                        no_of_max_hits,
+                    ):
+                        return
+            if self.stop_event.is_set():
+                return
+            channel.settimeout(None)
+            if channel.recv_exit_status() != 0 and error_handling == "error":
+                message = stderr.read().decode(errors="replace").strip()
+                raise ValueError(f"Unable to list folder items at '{root}': {message}")
+        finally:
+            channel.close()
+
+    def get_remote_identity(self) -> tuple[int, set[int]] | None:
+        """Fetch user and group ids of the remote user, None if `id` is not available"""
+        try:
+            probe = run_probe(self.ssh_client, "id -u && id -G")
+            if probe is None:
+                return None
+            output = probe.decode().split("\n")
+            return int(output[0]), {int(gid) for gid in output[1].split()}
+        except (paramiko.SSHException, OSError, ValueError, IndexError):
+            return None
+
+    def check_access(self, item: "SFTPAttributes", full_path: str) -> None:
+        """Raise PermissionError if the remote user is not allowed to read a file
+
+        Read access is decided from the file mode, owner and group of the listed
+        attributes. Files are opened instead if the strict access check is selected,
+        the remote user ids are unknown or the item is a symbolic link.
+        """
+        mode = item.st_mode or 0
+        if (
+            self.identity is None
+            or stat.S_ISLNK(mode)
+            or item.st_uid is None
+            or item.st_gid is None
+        ):
+            with self.sftp_channel() as sftp, sftp.open(full_path, "r") as f:
+                f.read(1)
+            return
+
+        uid, gids = self.identity
+        if uid == 0:
+            return
+        if item.st_uid == uid:
+            readable = mode & stat.S_IRUSR
+        elif item.st_gid in gids:
+            readable = mode & stat.S_IRGRP
+        else:
+            readable = mode & stat.S_IROTH
+        if not readable:
+            raise PermissionError(errno.EACCES, os.strerror(errno.EACCES))
 
     def add_node(
-        self, files: list[SFTPAttributes], item: SFTPAttributes, no_of_max_hits: int, path: str
+        self,
+        results: "queue.Queue[SFTPAttributes]",
+        item: "SFTPAttributes",
+        no_of_max_hits: int,
+        path: str,
     ) -> bool:
-        """Add file or folder node to result"""
-        with self.lock:
-            if no_of_max_hits != -1 and len(files) >= no_of_max_hits:
+        """Add a matching file to the result, set the stop event with the last allowed hit
+
+        Hits are numbered by an atomic counter, so workers never wait for each other.
+        """
+        mode = item.st_mode
+        if not (mode and re.fullmatch(self.regex, item.filename) and not stat.S_ISDIR(mode)):
+            return False
+
+        if no_of_max_hits != -1:
+            hit = next(self.hit_counter)
+            if hit >= no_of_max_hits:
                 self.stop_event.set()
+            if hit > no_of_max_hits:
                 return False
 
-            mode = item.st_mode
-            if mode and re.fullmatch(self.regex, item.filename) and not stat.S_ISDIR(mode):
-                path = self.get_sftp().normalize(path)
-                full_path = f"{path.rstrip('/')}/{item.filename}"
-                item.filename = full_path
-                files.append(item)
-                if no_of_max_hits != -1 and len(files) >= no_of_max_hits:
-                    self.stop_event.set()
-                return True
-
-        return False
+        item.filename = f"{path.rstrip('/')}/{item.filename}"
+        results.put(item)
+        return True
 
-    def _get_folder_items(self, path: str, error_handling: str) -> Any:  # noqa: ANN401
+    def _get_folder_items(self, path: str, error_handling: str, mtime: int | None = None) -> Any:  # noqa: ANN401
         try:
-            return self.get_sftp().listdir_attr(path or ".")
+            with self.sftp_channel() as sftp:
+                items = sftp.listdir_attr(path or ".")
         except (paramiko.ChannelException, OSError, paramiko.SFTPError) as e:
             if error_handling in {"warning", "ignore"}:
                 return []
             if error_handling == "error":
                 raise ValueError(f"Unable to list folder items at '{path or '.'}': {e}") from e
             return None
+        if self.snapshot is not None and mtime is not None:
+            self.snapshot.record(path, mtime, items)
+        return items
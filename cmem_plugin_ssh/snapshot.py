@@ -0,0 +1,105 @@
+"""Persistent directory snapshot for incremental listings"""
+
+import gzip
+import json
+import os
+import tempfile
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from cmem_plugin_ssh.lazy import paramiko
+
+if TYPE_CHECKING:
+    from paramiko import SFTPAttributes
+
+SNAPSHOT_VERSION = 1
+
+
+def to_entry(item: "SFTPAttributes") -> list:
+    """Convert listed attributes to a snapshot entry"""
+    return [
+        item.filename,
+        item.st_size,
+        item.st_uid,
+        item.st_gid,
+        item.st_mode,
+        item.st_atime,
+        item.st_mtime,
+    ]
+
+
+def from_entry(entry: list) -> "SFTPAttributes":
+    """Convert a snapshot entry to listed attributes"""
+    item = paramiko.SFTPAttributes()
+    (
+        item.filename,
+        item.st_size,
+        item.st_uid,
+        item.st_gid,
+        item.st_mode,
+        item.st_atime,
+        item.st_mtime,
+    ) = entry
+    return item
+
+
+class Snapshot:
+    """Per-directory modification times and entries of the last complete crawl
+
+    A directory whose modification time did not change since the last crawl still
+    has the same entries, so its listing is taken from the snapshot instead of the
+    server. Note that modifying a file in place does not change the modification
+    time of its directory, so the size and modification time of such a file are only
+    refreshed once an entry of its directory is added, removed or renamed.
+    """
+
+    def __init__(self, path: str | Path):
+        self.path = Path(path)
+        self.previous: dict[str, tuple[int, dict[str, list]]] = {
+            directory: (mtime, {entry[0]: entry for entry in entries})
+            for directory, (mtime, entries) in self._load().items()
+        }
+        self.current: dict[str, list] = {}
+
+    def _load(self) -> dict[str, list]:
+        """Load the snapshot of the last crawl, an empty one if there is none"""
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            raise ValueError(f"Unable to read snapshot file '{self.path}': {e}") from e
+        if data.get("version") != SNAPSHOT_VERSION:
+            return {}
+        directories: dict[str, list] = data["directories"]
+        return directories
+
+    def cached_entries(self, directory: str, mtime: int) -> "list[SFTPAttributes] | None":
+        """Entries of a directory if it is unchanged since the last crawl"""
+        previous = self.previous.get(directory)
+        if previous is None or previous[0] != mtime:
+            return None
+        return [from_entry(entry) for entry in previous[1].values()]
+
+    def record(self, directory: str, mtime: int, items: "list[SFTPAttributes]") -> None:
+        """Record the entries of a directory listed in the current crawl"""
+        self.current[directory] = [mtime, [to_entry(item) for item in items]]
+
+    def is_changed(self, directory: str, item: "SFTPAttributes") -> bool:
+        """Check whether a file is new or changed in size or mtime since the last crawl"""
+        previous = self.previous.get(directory)
+        entry = previous[1].get(item.filename) if previous is not None else None
+        return entry is None or entry[1] != item.st_size or entry[6] != item.st_mtime
+
+    def save(self) -> None:
+        """Replace the snapshot file with the directories of the current crawl"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.path.parent, prefix=f".{self.path.name}.")
+        try:
+            with os.fdopen(fd, "wb") as raw, gzip.open(raw, "wt", encoding="utf-8") as file:
+                json.dump({"version": SNAPSHOT_VERSION, "directories": self.current}, file)
+            Path(temp_path).replace(self.path)
+        except BaseException:
+            Path(temp_path).unlink(missing_ok=True)
+            raise
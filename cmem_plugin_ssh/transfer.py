@@ -0,0 +1,591 @@
+"""Parallel file transfers over pooled SFTP channels"""
+
+import contextlib
+import json
+import queue
+import shutil
+import tarfile
+import tempfile
+import threading
+from collections import Counter, defaultdict, deque
+from collections.abc import Callable, Generator, Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import TYPE_CHECKING, BinaryIO, TypeVar
+
+from cmem_plugin_ssh.cache import TransferCache
+from cmem_plugin_ssh.connection import SFTPChannelPool, run_probe
+from cmem_plugin_ssh.lazy import paramiko
+
+if TYPE_CHECKING:
+    from paramiko import ChannelFile, SFTPAttributes, SFTPClient, SFTPFile, SSHClient
+
+T = TypeVar("T")
+
+# downloads waiting for a worker per worker, so workers do not idle between files
+PENDING_PER_WORKER = 2
+# blocks a segment is read in, and how many of them are requested ahead
+SEGMENT_BLOCK_SIZE = 1024 * 1024
+PREFETCH_REQUESTS = 64
+# blocks a whole file is read in
+TRANSFER_BLOCK_SIZE = 32768
+# files from this size on are downloaded into a part file that a retry continues
+RESUMABLE_SIZE = 16 * 1024 * 1024
+# retries of a transfer after the connection was lost, the delay doubles every time
+RESUME_RETRIES = 5
+RESUME_DELAY = 1.0
+# seconds the tar reader is waited for after the download was closed early
+TAR_JOIN_TIMEOUT = 1
+
+
+class SegmentedFile:
+    """Download state of a file whose segments are fetched in parallel
+
+    The segments are written into a preallocated part file next to the final local
+    path, which is only replaced once all segments are complete and the bytes they
+    received add up to the size of the remote file.
+    """
+
+    def __init__(
+        self, remote_path: str, local_path: Path, item: "SFTPAttributes", segment_size: int
+    ):
+        self.remote_path = remote_path
+        self.local_path = local_path
+        self.item = item
+        size = self.size = item.st_size or 0
+        self.segments = deque(
+            (offset, min(segment_size, size - offset)) for offset in range(0, size, segment_size)
+        )
+        self.remaining = len(self.segments)
+        self.received = 0
+        self.error: OSError | None = None
+        part_file = tempfile.NamedTemporaryFile(  # noqa: SIM115
+            dir=local_path.parent, prefix=f".{local_path.name}.", suffix=".part", delete=False
+        )
+        with part_file:
+            part_file.truncate(size)
+        self.part_path = Path(part_file.name)
+
+    def finish(self) -> Path | OSError:
+        """Verify the received bytes and move the part file to the local path"""
+        if self.error is None:
+            if self.received == self.size:
+                self.part_path.replace(self.local_path)
+                return self.local_path
+            self.error = OSError(f"Downloaded {self.received} of {self.size} bytes")
+        self.discard()
+        return self.error
+
+    def discard(self) -> None:
+        """Remove the part file"""
+        with contextlib.suppress(FileNotFoundError):
+            self.part_path.unlink()
+
+
+class PartFile:
+    """Part file of a large download, which is continued by a later attempt
+
+    It is kept next to the local path together with a record of the remote path, size
+    and modification time. The part file of a remote file that changed is started anew.
+    """
+
+    def __init__(self, remote_path: str, local_path: Path, size: int, mtime: int | None):
+        self.local_path = local_path
+        self.size = size
+        self.path = local_path.with_name(f".{local_path.name}.part")
+        self.record_path = local_path.with_name(f".{local_path.name}.part.json")
+        self.record = {"path": remote_path, "size": size, "mtime": mtime}
+
+    def offset(self) -> int:
+        """Return the size of the part file to continue at, 0 if it is started anew"""
+        try:
+            record = json.loads(self.record_path.read_text(encoding="utf-8"))
+            offset = self.path.stat().st_size
+        except (OSError, ValueError):
+            record, offset = None, 0
+        if record == self.record and offset <= self.size:
+            return offset
+        self.path.write_bytes(b"")
+        self.record_path.write_text(json.dumps(self.record), encoding="utf-8")
+        return 0
+
+    def finish(self) -> None:
+        """Verify the size of the part file and move it to the local path"""
+        part_size = self.path.stat().st_size
+        if part_size != self.size:
+            raise OSError(f"Downloaded {part_size} of {self.size} bytes")
+        self.path.replace(self.local_path)
+        self.record_path.unlink(missing_ok=True)
+
+
+def connection_lost(error: Exception) -> bool:
+    """Check whether an error is caused by the connection rather than by the remote file"""
+    return isinstance(error, EOFError | paramiko.SSHException | ConnectionError | TimeoutError)
+
+
+def copy_remote(remote: "SFTPFile", local: "BinaryIO", size: int) -> None:
+    """Copy a remote file from its current position to the end of its size"""
+    remote.prefetch(size, PREFETCH_REQUESTS)
+    while data := remote.read(TRANSFER_BLOCK_SIZE):
+        local.write(data)
+    if local.tell() != size:
+        raise OSError(f"Downloaded {local.tell()} of {size} bytes")
+
+
+class Segments:
+    """Queue of the segments of started files, the segments of one file after another"""
+
+    def __init__(self) -> None:
+        self.queue: deque[SegmentedFile] = deque()
+        self.started: list[SegmentedFile] = []
+
+    def __bool__(self) -> bool:
+        """Check whether segments are waiting"""
+        return bool(self.queue)
+
+    def add(self, file: SegmentedFile) -> None:
+        """Queue the segments of a file"""
+        self.started.append(file)
+        self.queue.append(file)
+
+    def take(self) -> tuple[SegmentedFile, int, int]:
+        """Take the next segment with its file, offset and length"""
+        file = self.queue[0]
+        offset, length = file.segments.popleft()
+        if not file.segments:
+            self.queue.popleft()
+        return file, offset, length
+
+    def drop(self, file: SegmentedFile) -> None:
+        """Drop the segments of a file that are not started yet"""
+        file.remaining -= len(file.segments)
+        file.segments.clear()
+        if file in self.queue:
+            self.queue.remove(file)
+
+    def discard(self) -> None:
+        """Remove the part files of all unfinished files"""
+        for file in self.started:
+            file.discard()
+
+
+class ParallelDownload:
+    """Download files with a bounded number of workers sharing a pool of SFTP channels
+
+    Every worker checks out one channel of the pool per file, so `workers` is also the
+    maximum number of concurrent downloads. Files with the same name end up at the
+    same local path, their downloads are serialized so the file is not garbled.
+
+    Files larger than `segment_size` (0 to disable) are split into segments of that
+    size, which are downloaded by the workers in parallel like separate files.
+
+    With a cache, files are downloaded into the cache, and files whose size and
+    modification time did not change are taken from it without a transfer.
+
+    Transfers interrupted by a lost connection are retried `RESUME_RETRIES` times with
+    doubling delays, over channels the pool opens on a new connection. Segments and
+    files from `RESUMABLE_SIZE` on continue where the last attempt stopped.
+    """
+
+    def __init__(
+        self,
+        channels: SFTPChannelPool,
+        download_dir: str | Path,
+        workers: int,
+        segment_size: int = 0,
+        cache: TransferCache | None = None,
+    ):
+        self.channels = channels
+        self.download_dir = Path(download_dir)
+        self.workers = workers
+        self.segment_size = segment_size
+        self.cache = cache
+        self._path_locks: defaultdict[Path, threading.Lock] = defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def local_path(self, remote_path: str) -> Path:
+        """Local path of a downloaded file"""
+        if self.cache is not None:
+            return self.cache.local_path(remote_path)
+        return self.download_dir / Path(remote_path).name
+
+    def path_lock(self, local_path: Path) -> threading.Lock:
+        """Lock serializing the writes to a local path"""
+        with self._lock:
+            return self._path_locks[local_path]
+
+    def download_file(
+        self, remote_path: str, item: "SFTPAttributes | None" = None
+    ) -> "Path | SFTPAttributes":
+        """Download a single file over a channel of the pool
+
+        Files to download in segments are not downloaded, their attributes are returned
+        instead. Without attributes from the listing, they are requested if needed.
+        """
+        if item is None and (self.segment_size or self.cache is not None):
+            item = self.retrying(remote_path, lambda: self.stat(remote_path))
+        if self.cache is not None and item is not None:
+            cached = self.cache.lookup(remote_path, item.st_size, item.st_mtime)
+            if cached is not None:
+                return cached
+        if item is not None and self.segment_size and (item.st_size or 0) > self.segment_size:
+            return item
+        local_path = self.local_path(remote_path)
+        with self.path_lock(local_path):
+            self.retrying(remote_path, lambda: self.fetch(remote_path, local_path))
+        if self.cache is not None and item is not None:
+            self.cache.add(remote_path, item.st_size, item.st_mtime, local_path)
+        return local_path
+
+    @contextlib.contextmanager
+    def channel(self) -> "Iterator[SFTPClient]":
+        """Check out a channel of the pool, errors of a lost channel become ConnectionError"""
+        with self.channels.channel() as sftp:
+            try:
+                yield sftp
+            except OSError as e:
+                # e.g. "Socket is closed", the errors of the remote file come with an errno
+                if e.errno is None and not self.channels.is_healthy(sftp):
+                    raise ConnectionError(str(e)) from e
+                raise
+
+    def stat(self, remote_path: str) -> "SFTPAttributes":
+        """Get the attributes of a file over a channel of the pool"""
+        with self.channel() as sftp:
+            return sftp.stat(remote_path)
+
+    def fetch(self, remote_path: str, local_path: Path) -> None:
+        """Download a file over a channel of the pool, large files into a part file"""
+        with self.channel() as sftp, sftp.open(remote_path, "rb") as remote:
+            attributes = remote.stat()
+            size = attributes.st_size or 0
+            if size < RESUMABLE_SIZE:
+                with local_path.open("wb") as local:
+                    copy_remote(remote, local, size)
+                return
+            part = PartFile(remote_path, local_path, size, attributes.st_mtime)
+            offset = part.offset()
+            remote.seek(offset)
+            with part.path.open("ab") as local:
+                copy_remote(remote, local, size)
+        part.finish()
+
+    def download_segment(self, file: SegmentedFile, offset: int, length: int) -> int:
+        """Download a segment of a file into its part file, return the bytes received"""
+        end = offset + length
+        position = offset
+
+        def fetch_blocks() -> None:
+            """Read the blocks from the position reached by the last attempt"""
+            nonlocal position
+            blocks = [
+                (start, min(SEGMENT_BLOCK_SIZE, end - start))
+                for start in range(position, end, SEGMENT_BLOCK_SIZE)
+            ]
+            with (
+                self.channel() as sftp,
+                sftp.open(file.remote_path, "rb") as remote,
+                file.part_path.open("r+b") as local,
+            ):
+                local.seek(position)
+                for data in remote.readv(blocks, PREFETCH_REQUESTS):
+                    local.write(data)
+                    position += len(data)
+
+        self.retrying(file.remote_path, fetch_blocks)
+        if position != end:
+            raise OSError(f"Received {position - offset} of {length} bytes at offset {offset}")
+        return length
+
+    def retrying(self, remote_path: str, transfer: Callable[[], T]) -> T:
+        """Run a transfer, and run it again after a delay while the connection is lost
+
+        A ValueError is raised after the last retry or once the download is closed, so
+        the file is not mistaken for one without access.
+        """
+        attempt = 0
+        while True:
+            try:
+                return transfer()
+            except (EOFError, OSError, paramiko.SSHException) as e:
+                if not connection_lost(e):
+                    raise
+                if attempt >= RESUME_RETRIES or self._stopped.wait(RESUME_DELAY * 2**attempt):
+                    raise ValueError(
+                        f"Download of '{remote_path}' failed after {attempt + 1} attempts: {e}"
+                    ) from e
+                attempt += 1
+
+    def take_file(
+        self,
+        executor: ThreadPoolExecutor,
+        files: "Iterator[str | SFTPAttributes | None]",
+        pending: "dict[Future, tuple[str, SegmentedFile | None]]",
+    ) -> bool:
+        """Start the download of the next file, return False if there are no more files"""
+        try:
+            remote_file = next(files)
+        except StopIteration:
+            return False
+        if isinstance(remote_file, str):
+            future = executor.submit(self.download_file, remote_file)
+            pending[future] = (remote_file, None)
+        elif remote_file is not None:
+            # size and modification time are known from the listing, which spares a request
+            remote_path = remote_file.filename
+            future = executor.submit(self.download_file, remote_path, remote_file)
+            pending[future] = (remote_path, None)
+        return True
+
+    def file_done(
+        self, remote_path: str, file: SegmentedFile | None, future: Future, segments: "Segments"
+    ) -> Path | OSError | None:
+        """Return the result of a finished download, None while segments are missing
+
+        A file to download in segments is queued for its segments instead. After the
+        first failed segment, the segments not started yet are dropped.
+        """
+        try:
+            result = future.result()
+        except OSError as e:
+            if file is None:
+                return e
+            result = e
+        if file is None:
+            if isinstance(result, Path):
+                return result
+            try:
+                segments.add(
+                    SegmentedFile(
+                        remote_path, self.local_path(remote_path), result, self.segment_size
+                    )
+                )
+            except OSError as e:
+                return e
+            return None
+        file.remaining -= 1
+        if isinstance(result, int):
+            file.received += result
+        if isinstance(result, OSError) and file.error is None:
+            file.error = result
+            segments.drop(file)
+        if file.remaining > 0:
+            return None
+        segments.started.remove(file)
+        with self.path_lock(file.local_path):
+            finished = file.finish()
+        if self.cache is not None and isinstance(finished, Path):
+            self.cache.add(file.remote_path, file.size, file.item.st_mtime, finished)
+        return finished
+
+    def download(
+        self, remote_files: "Iterable[str | SFTPAttributes | None]"
+    ) -> Generator[tuple[str, Path | OSError]]:
+        """Download files in parallel and yield their local paths as they are finished
+
+        The remote files are given by path or by their attributes from a listing, which
+        spares a request per file to get the size for segmenting. They are taken in the
+        calling thread, only as many as needed to keep the workers busy. None stands for
+        a file that is not known yet, e.g. while the files are still being listed, and
+        is used to yield finished downloads meanwhile. Segments of files already started
+        are taken before new files. Files that cannot be read are yielded with their
+        error instead of the local path, other errors are raised, also transfers that
+        failed for a lost connection after all retries. Downloads that have
+        not started yet are cancelled when the generator is closed.
+        """
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="download")
+        limit = self.workers * PENDING_PER_WORKER
+        pending: dict[Future, tuple[str, SegmentedFile | None]] = {}
+        segments = Segments()
+        files = iter(remote_files)
+        exhausted = False
+        self._stopped.clear()
+        try:
+            while True:
+                if segments and len(pending) < limit:
+                    segmented, offset, length = segments.take()
+                    future = executor.submit(self.download_segment, segmented, offset, length)
+                    pending[future] = (segmented.remote_path, segmented)
+                    continue
+                if not exhausted and len(pending) < limit:
+                    exhausted = not self.take_file(executor, files, pending)
+                if not pending:
+                    if exhausted:
+                        return
+                    continue
+                # only wait for a download if no more files can be taken
+                full = exhausted or len(pending) >= limit
+                done, _ = wait(pending, timeout=None if full else 0, return_when=FIRST_COMPLETED)
+                for future in done:
+                    remote_path, file = pending.pop(future)
+                    result = self.file_done(remote_path, file, future, segments)
+                    if result is not None:
+                        yield remote_path, result
+        finally:
+            self._stopped.set()
+            executor.shutdown(cancel_futures=True)
+            segments.discard()
+
+
+class TarDownload:
+    """Download files as one tar stream created on the server
+
+    The remote paths are written to the standard input of a remote tar command, which
+    streams the files as one archive, optionally gzip compressed. The archive is
+    unpacked into the download folder on the fly by a reader thread, so many small
+    files cost no round trips per file. Like with SFTP, symbolic links are followed and
+    files with the same name end up at the same local path.
+
+    With a cache, files are unpacked into the cache, and listed files whose size and
+    modification time did not change are taken from it instead of passed to tar.
+    """
+
+    def __init__(
+        self,
+        ssh_client: "SSHClient",
+        download_dir: str | Path,
+        compress: bool = False,
+        cache: TransferCache | None = None,
+    ):
+        self.ssh_client = ssh_client
+        self.download_dir = Path(download_dir)
+        self.compress = compress
+        self.cache = cache
+
+    def command(self, file_list: str) -> str:
+        """Build the tar command archiving the NUL separated paths in a file list"""
+        return f"tar -c{'z' if self.compress else ''}hPf - --null -T {file_list}"
+
+    def available(self) -> bool:
+        """Check whether the server can create the tar stream"""
+        try:
+            probe = run_probe(self.ssh_client, f"{self.command('/dev/null')} > /dev/null")
+        except (paramiko.SSHException, OSError):
+            return False
+        return probe is not None
+
+    def local_path(self, remote_path: str) -> Path:
+        """Local path of a downloaded file"""
+        if self.cache is not None:
+            return self.cache.local_path(remote_path)
+        return self.download_dir / Path(remote_path).name
+
+    def unpack(
+        self, stdout: "ChannelFile", results: "queue.Queue[tuple[str, Path | Exception] | None]"
+    ) -> None:
+        """Reader: unpack the archive and put the remote and local path of each file
+
+        None is put when the archive ends, errors are put in place of a path.
+        """
+        try:
+            with tarfile.open(fileobj=stdout, mode="r|gz" if self.compress else "r|") as archive:
+                for member in archive:
+                    local_path = self.local_path(member.name)
+                    if member.islnk():
+                        # a file already in the archive, e.g. listed twice or hard linked
+                        shutil.copyfile(self.local_path(member.linkname), local_path)
+                    elif member.isfile():
+                        source = archive.extractfile(member)
+                        if source is None:
+                            continue
+                        with source, local_path.open("wb") as local:
+                            shutil.copyfileobj(source, local)
+                    else:
+                        continue
+                    if self.cache is not None:
+                        # hard link members have no size of their own
+                        size = local_path.stat().st_size
+                        self.cache.add(member.name, size, int(member.mtime), local_path)
+                    results.put((member.name, local_path))
+        except Exception as e:  # noqa: BLE001
+            results.put(("", e))
+        results.put(None)
+
+    def download(
+        self, remote_files: "Iterable[str | SFTPAttributes | None]"
+    ) -> Generator[tuple[str, Path | OSError]]:
+        """Download files and yield their local paths as they are unpacked
+
+        The remote files are given by path or by their attributes from a listing and are
+        passed to tar in the calling thread. None stands for a file that is not known
+        yet, the paths passed so far are sent to the server then, and unpacked files are
+        yielded meanwhile. Files that tar cannot read are yielded with their error at the
+        end, other errors are raised.
+        """
+        stdin, stdout, stderr = self.ssh_client.exec_command(self.command("-"))
+        results: queue.Queue[tuple[str, Path | Exception] | None] = queue.Queue()
+        reader = threading.Thread(
+            target=self.unpack, args=(stdout, results), name="tar-download", daemon=True
+        )
+        reader.start()
+        requested: Counter[str] = Counter()
+        try:
+            for remote_file in remote_files:
+                if remote_file is None:
+                    stdin.flush()
+                else:
+                    self.request(remote_file, stdin, requested, results)
+                yield from self.unpacked(results, requested, block=False)
+            stdin.flush()
+            stdin.channel.shutdown_write()
+            yield from self.unpacked(results, requested, block=True)
+            reader.join()
+            message = stderr.read().decode(errors="replace")
+            for remote_path, count in requested.items():
+                error = OSError(self.tar_error(message, remote_path))
+                for _ in range(count):
+                    yield remote_path, error
+        finally:
+            stdout.channel.close()
+            reader.join(timeout=TAR_JOIN_TIMEOUT)
+
+    def request(
+        self,
+        remote_file: "str | SFTPAttributes",
+        stdin: "ChannelFile",
+        requested: "Counter[str]",
+        results: "queue.Queue[tuple[str, Path | Exception] | None]",
+    ) -> None:
+        """Pass a file to tar, or put it as unpacked if it is unchanged in the cache"""
+        if isinstance(remote_file, str):
+            remote_path = remote_file
+        else:
+            remote_path = remote_file.filename
+            if self.cache is not None:
+                cached = self.cache.lookup(remote_path, remote_file.st_size, remote_file.st_mtime)
+                if cached is not None:
+                    requested[remote_path] += 1
+                    results.put((remote_path, cached))
+                    return
+        if not requested[remote_path]:
+            stdin.write(f"{remote_path}\0")
+        requested[remote_path] += 1
+
+    @staticmethod
+    def unpacked(
+        results: "queue.Queue[tuple[str, Path | Exception] | None]",
+        requested: "Counter[str]",
+        block: bool,
+    ) -> Iterator[tuple[str, Path]]:
+        """Yield the unpacked files, until the archive ends if `block` is set"""
+        while True:
+            try:
+                result = results.get(block=block)
+            except queue.Empty:
+                return
+            if result is None:
+                return
+            remote_path, local_path = result
+            if isinstance(local_path, Exception):
+                raise local_path
+            for _ in range(requested.pop(remote_path, 0)):
+                yield remote_path, local_path
+
+    @staticmethod
+    def tar_error(message: str, remote_path: str) -> str:
+        """Take the message tar printed for a file, e.g. if it cannot be opened"""
+        for line in message.splitlines():
+            if remote_path in line:
+                return line.removeprefix("tar: ")
+        return f"'{remote_path}' is missing in the tar stream: {message.strip()}"
@@ -5,7 +5,6 @@ import io
 from collections.abc import Sequence
 from pathlib import Path
 
-import paramiko
 from cmem_plugin_base.dataintegration.context import ExecutionContext, ExecutionReport
 from cmem_plugin_base.dataintegration.description import Icon, Plugin, PluginParameter
 from cmem_plugin_base.dataintegration.entity import Entities
@@ -13,10 +12,16 @@ from cmem_plugin_base.dataintegration.parameter.choice import ChoiceParameterTyp
 from cmem_plugin_base.dataintegration.parameter.password import Password, PasswordParameterType
 from cmem_plugin_base.dataintegration.plugins import WorkflowPlugin
 from cmem_plugin_base.dataintegration.ports import FixedNumberOfInputs, FixedSchemaPort
-from cmem_plugin_base.dataintegration.typed_entities.file import File, FileEntitySchema
 from cmem_plugin_base.dataintegration.utils import setup_cmempy_user_access
 
 from cmem_plugin_ssh.autocompletion import DirectoryParameterType
+from cmem_plugin_ssh.connection import (
+    SSH_CONNECTIONS,
+    ConnectionKey,
+    connection_key,
+    open_sftp_session,
+)
+from cmem_plugin_ssh.lazy import paramiko, typed_files
 from cmem_plugin_ssh.utils import AUTHENTICATION_CHOICES, load_private_key
 
 
@@ -44,6 +49,9 @@ will be used to decrypt it.
 
 #### Note:
 * If a connection cannot be established within 20 seconds, a timeout occurs.
+* Connections are kept open for up to 5 minutes after the task finished and reused by tasks
+connecting to the same host with the same user and credentials. At most 16 connections
+to a host are open at the same time, further tasks wait for one to be released.
 * Currently supported key types are: RSA, DSS, ECDSA, Ed25519.
     """,
     icon=Icon(package=__package__, file_name="ssh-icon.svg"),
@@ -102,8 +110,8 @@ will be used to decrypt it.
 class UploadFiles(WorkflowPlugin):
     """Upload Plugin SSH"""
 
-    ssh_client: paramiko.SSHClient
-    sftp: paramiko.SFTPClient
+    ssh_client: "paramiko.SSHClient"
+    sftp: "paramiko.SFTPClient"
 
     def __init__(  # noqa: PLR0913
         self,
@@ -122,14 +130,17 @@ class UploadFiles(WorkflowPlugin):
         self.private_key = private_key
         self.password = password if isinstance(password, str) else password.decrypt()
         self.path = path
-        self.input_ports = FixedNumberOfInputs([FixedSchemaPort(schema=FileEntitySchema())])
+        self.input_ports = FixedNumberOfInputs(
+            [FixedSchemaPort(schema=typed_files.FileEntitySchema())]
+        )
         self.output_port = None
 
-    def establish_ssh_connection(self) -> None:
+    def establish_ssh_connection(self, ssh_client: "paramiko.SSHClient | None" = None) -> None:
         """Connect to the ssh client with the selected authentication method"""
+        ssh_client = ssh_client or self.ssh_client
         if self.authentication_method == "key":
-            self.ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            self.ssh_client.connect(
+            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            ssh_client.connect(
                 hostname=self.hostname,
                 username=self.username,
                 pkey=load_private_key(self.private_key, self.password),
@@ -138,8 +149,8 @@ class UploadFiles(WorkflowPlugin):
                 timeout=20,
             )
         elif self.authentication_method == "password":
-            self.ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            self.ssh_client.connect(
+            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            ssh_client.connect(
                 hostname=self.hostname,
                 username=self.username,
                 password=self.password,
@@ -148,14 +159,25 @@ class UploadFiles(WorkflowPlugin):
             )
 
     def cleanup_ssh_connections(self) -> None:
-        """Close connection from sftp and ssh"""
+        """Close the SFTP session and return the SSH connection to the connection pool"""
         self.sftp.close()
-        self.ssh_client.close()
+        SSH_CONNECTIONS.checkin(self.connection_key(), self.ssh_client)
+
+    def connection_key(self) -> ConnectionKey:
+        """Key of the pooled SSH connections for the connection parameters"""
+        return connection_key(
+            self.hostname,
+            self.port,
+            self.username,
+            self.authentication_method,
+            self.private_key,
+            self.password,
+        )
 
     def _initialize_ssh_and_sftp_connections(self) -> None:
-        self.ssh_client = paramiko.SSHClient()
-        self.establish_ssh_connection()
-        self.sftp = self.ssh_client.open_sftp()
+        self.ssh_client, self.sftp = open_sftp_session(
+            self.connection_key(), self.establish_ssh_connection
+        )
 
     def execute(self, inputs: Sequence[Entities], context: ExecutionContext) -> Entities:
         """Execute the workflow task"""
@@ -167,58 +189,61 @@ class UploadFiles(WorkflowPlugin):
         self._initialize_ssh_and_sftp_connections()
 
         files: list = []
-        schema = FileEntitySchema()
+        schema = typed_files.FileEntitySchema()
         setup_cmempy_user_access(context.user)
 
-        for entity in inputs[0].entities:
-            file = schema.from_entity(entity)
-            file_name = Path(file.path).name
-            context.report.update(
-                ExecutionReport(
-                    entity_count=len(files),
-                    operation="upload",
-                    operation_desc=f"uploading {file_name}",
+        try:
+            for entity in inputs[0].entities:
+                file = schema.from_entity(entity)
+                file_name = Path(file.path).name
+                context.report.update(
+                    ExecutionReport(
+                        entity_count=len(files),
+                        operation="upload",
+                        operation_desc=f"uploading {file_name}",
+                    )
                 )
-            )
-            with file.read_stream(context.task.project_id()) as input_file:
-                # Wrap input in buffered stream if needed
-                buffered = io.BufferedReader(input_file)
-
-                # Check if Gzip by peeking at first two bytes
-                if _is_gzip(buffered):
-                    decompressed_stream = gzip.GzipFile(fileobj=buffered)
-                else:
-                    decompressed_stream = buffered  # type: ignore[assignment]
-
-                # Decide whether it's text or binary (peek and try decode)
-                sample = decompressed_stream.read(1024)
-                decompressed_stream.seek(0)
-
-                try:
-                    sample.decode("utf-8")
-                    is_text = True
-                except UnicodeDecodeError:
-                    is_text = False
-
-                if is_text:
-                    stream_for_upload = io.TextIOWrapper(decompressed_stream, encoding="utf-8")
-                else:
-                    stream_for_upload = decompressed_stream  # type: ignore[assignment]
-
-                try:
-                    # Stream directly to SFTP — no full buffering
-                    self.sftp.putfo(stream_for_upload, f"{self.path}/{file_name}")  # type: ignore[arg-type]
-                except (FileNotFoundError, PermissionError, OSError) as e:
-                    raise ValueError(f"An error occurred during upload: {e}") from e
-
-            files.append(
-                File(
-                    path=file.path,
-                    entry_path=file.entry_path,
-                    mime=file.mime,
-                    file_type=file.file_type,
+                with file.read_stream(context.task.project_id()) as input_file:
+                    # Wrap input in buffered stream if needed
+                    buffered = io.BufferedReader(input_file)
+
+                    # Check if Gzip by peeking at first two bytes
+                    if _is_gzip(buffered):
+                        decompressed_stream = gzip.GzipFile(fileobj=buffered)
+                    else:
+                        decompressed_stream = buffered  # type: ignore[assignment]
+
+                    # Decide whether it's text or binary (peek and try decode)
+                    sample = decompressed_stream.read(1024)
+                    decompressed_stream.seek(0)
+
+                    try:
+                        sample.decode("utf-8")
+                        is_text = True
+                    except UnicodeDecodeError:
+                        is_text = False
+
+                    if is_text:
+                        stream_for_upload = io.TextIOWrapper(decompressed_stream, encoding="utf-8")
+                    else:
+                        stream_for_upload = decompressed_stream  # type: ignore[assignment]
+
+                    try:
+                        # Stream directly to SFTP — no full buffering
+                        self.sftp.putfo(stream_for_upload, f"{self.path}/{file_name}")  # type: ignore[arg-type]
+                    except (FileNotFoundError, PermissionError, OSError) as e:
+                        raise ValueError(f"An error occurred during upload: {e}") from e
+
+                files.append(
+                    typed_files.File(
+                        path=file.path,
+                        entry_path=file.entry_path,
+                        mime=file.mime,
+                        file_type=file.file_type,
+                    )
                 )
-            )
+        finally:
+            self.cleanup_ssh_connections()
 
         entities = [schema.to_entity(file) for file in files]
 
@@ -230,5 +255,4 @@ class UploadFiles(WorkflowPlugin):
                 sample_entities=Entities(entities=iter(entities[:10]), schema=schema),
             )
         )
-        self.cleanup_ssh_connections()
         return Entities(entities=iter(entities), schema=schema)
@@ -1,15 +1,24 @@
 """Utils for SSH plugins"""
 
+import base64
+import binascii
+import hashlib
 import io
 import re
+import struct
+import threading
 from collections import OrderedDict
+from typing import TYPE_CHECKING
 
-from cmem_plugin_base.dataintegration.entity import EntityPath, EntitySchema
+from cmem_plugin_base.dataintegration.entity import Entity, EntityPath, EntitySchema
 from cmem_plugin_base.dataintegration.parameter.password import Password
-from paramiko import DSSKey, ECDSAKey, Ed25519Key, PKey, RSAKey, SSHClient, SSHException
 
+from cmem_plugin_ssh.lazy import paramiko
 from cmem_plugin_ssh.retrieval import SSHRetrieval
 
+if TYPE_CHECKING:
+    from paramiko import PKey, SFTPAttributes, SSHClient
+
 PASSWORD = "password"  # noqa: S105
 PRIVATE_KEY = "key"
 AUTHENTICATION_CHOICES = OrderedDict({PASSWORD: "Password", PRIVATE_KEY: "Key"})
@@ -19,6 +28,27 @@ WARNING = "warning"
 ERROR = "error"
 ERROR_HANDLING_CHOICES = OrderedDict({IGNORE: "Ignore", WARNING: "Warning", ERROR: "Error"})
 
+METADATA = "metadata"
+STRICT = "strict"
+ACCESS_CHECK_CHOICES = OrderedDict({METADATA: "File metadata", STRICT: "Open files (strict)"})
+
+SFTP_LISTING = "sftp"
+FIND_LISTING = "find"
+LISTING_METHOD_CHOICES = OrderedDict(
+    {SFTP_LISTING: "SFTP", FIND_LISTING: "Remote find (falls back to SFTP)"}
+)
+
+SFTP_TRANSFER = "sftp"
+TAR_TRANSFER = "tar"
+TAR_GZIP_TRANSFER = "tar_gzip"
+TRANSFER_METHOD_CHOICES = OrderedDict(
+    {
+        SFTP_TRANSFER: "SFTP",
+        TAR_TRANSFER: "Tar stream (falls back to SFTP)",
+        TAR_GZIP_TRANSFER: "Compressed tar stream (falls back to SFTP)",
+    }
+)
+
 NO_INPUT = "no_input"
 FILE_INPUT = "file_input"
 COMMAND_INPUT_CHOICES = OrderedDict({NO_INPUT: "No input", FILE_INPUT: "File input"})
@@ -35,10 +65,63 @@ COMMAND_OUTPUT_CHOICES = OrderedDict(
 )
 
 MAX_WORKERS = 32
+MAX_SSH_CONNECTIONS = 8
+
+MEGABYTE = 1024 * 1024
+
+SAMPLE_SIZE = 10
+
+OPENSSH_KEY_MAGIC = b"openssh-key-v1\0"
+# names of the paramiko key classes, so paramiko is not loaded on import
+KEY_LOADERS = {
+    "RSA": "RSAKey",
+    "DSA": "DSSKey",
+    "EC": "ECDSAKey",
+    "ssh-rsa": "RSAKey",
+    "ssh-dss": "DSSKey",
+    "ssh-ed25519": "Ed25519Key",
+    "ecdsa-sha2-nistp256": "ECDSAKey",
+    "ecdsa-sha2-nistp384": "ECDSAKey",
+    "ecdsa-sha2-nistp521": "ECDSAKey",
+}
+# loaded keys (None if not loadable) by hash of key and password, least recently used first
+PRIVATE_KEY_CACHE: "OrderedDict[str, PKey | None]" = OrderedDict()
+PRIVATE_KEY_CACHE_SIZE = 32
+PRIVATE_KEY_CACHE_LOCK = threading.Lock()
+
+
+def openssh_key_type(body: str) -> str | None:
+    """Read the key type from the unencrypted public key of an OpenSSH private key"""
+    try:
+        data = base64.b64decode("".join(body.split()), validate=True)
+        if not data.startswith(OPENSSH_KEY_MAGIC):
+            return None
+        offset = len(OPENSSH_KEY_MAGIC)
+        # skip cipher name, KDF name and KDF options, the number of keys and the blob size
+        for _ in range(3):
+            (length,) = struct.unpack_from(">I", data, offset)
+            offset += 4 + length
+        offset += 8
+        (length,) = struct.unpack_from(">I", data, offset)
+        return data[offset + 4 : offset + 4 + length].decode()
+    except (binascii.Error, struct.error, UnicodeDecodeError):
+        return None
+
+
+def private_key_loaders(label: str, body: str) -> "list[type[PKey]]":
+    """Loaders for a private key, only the matching one if the key type is known"""
+    key_type = openssh_key_type(body) if label == "OPENSSH" else label
+    loader = KEY_LOADERS.get(key_type or "")
+    names = [loader] if loader is not None else ["RSAKey", "DSSKey", "ECDSAKey", "Ed25519Key"]
+    return [getattr(paramiko, name) for name in names]
+
 
+def load_private_key(private_key: str | Password, password: str | Password) -> "PKey | None":
+    """Load the private key correctly
 
-def load_private_key(private_key: str | Password, password: str | Password) -> PKey | None:
-    """Load the private key correctly"""
+    The key type is taken from the PEM label or the OpenSSH public key, so only the
+    matching loader is used. Loaded keys are cached by a hash of key and password.
+    """
     if not private_key:
         return None
     pkey = private_key if isinstance(private_key, str) else private_key.decrypt()
@@ -54,17 +137,30 @@ def load_private_key(private_key: str | Password, password: str | Password) -> P
     begin, body, end = match.group(1), match.group(3).strip(), match.group(4)
     pkey = f"{begin}\n{body}\n{end}"
 
+    cache_key = hashlib.sha256(f"{pkey}\0{password}".encode()).hexdigest()
+    with PRIVATE_KEY_CACHE_LOCK:
+        if cache_key in PRIVATE_KEY_CACHE:
+            PRIVATE_KEY_CACHE.move_to_end(cache_key)
+            return PRIVATE_KEY_CACHE[cache_key]
+
+    loaded_key = None
     key_file = io.StringIO(pkey)
-    loaders: list[type[PKey]] = [RSAKey, DSSKey, ECDSAKey, Ed25519Key]
-    for loader in loaders:
+    for loader in private_key_loaders(match.group(2), body):
         try:
             if password:
-                return loader.from_private_key(key_file, password=password)
-            return loader.from_private_key(key_file)
-        except SSHException:
+                loaded_key = loader.from_private_key(key_file, password=password)
+            else:
+                loaded_key = loader.from_private_key(key_file)
+            break
+        except paramiko.SSHException:
             key_file.seek(0)  # Reset file pointer for next try
             continue
-    return None
+
+    with PRIVATE_KEY_CACHE_LOCK:
+        PRIVATE_KEY_CACHE[cache_key] = loaded_key
+        if len(PRIVATE_KEY_CACHE) > PRIVATE_KEY_CACHE_SIZE:
+            PRIVATE_KEY_CACHE.popitem(last=False)
+    return loaded_key
 
 
 def setup_max_workers(max_workers: int) -> int:
@@ -74,6 +170,42 @@ def setup_max_workers(max_workers: int) -> int:
     raise ValueError("Range of max_workers exceeded")
 
 
+def setup_ssh_connections(ssh_connections: int) -> int:
+    """Return the correct number of SSH connections"""
+    if 0 < ssh_connections <= MAX_SSH_CONNECTIONS:
+        return ssh_connections
+    raise ValueError("Range of ssh_connections exceeded")
+
+
+def setup_max_depth(max_depth: int) -> int:
+    """Return the listing depth for a maximum subfolder depth, -1 for no limit"""
+    if max_depth == -1:
+        return -1
+    if max_depth >= 0:
+        return max_depth + 1
+    raise ValueError("Maximum depth has to be -1 (no limit) or at least 0")
+
+
+def setup_segment_size(segment_size: int, max_workers: int) -> int:
+    """Return the segment size in bytes for a size in MB, 0 if files are not segmented"""
+    if segment_size < 0:
+        raise ValueError("Segment size has to be 0 (no segments) or a positive number of MB")
+    # a single worker downloads the segments one after another anyway
+    return segment_size * MEGABYTE if max_workers > 1 else 0
+
+
+def setup_cache_size(cache_size: int) -> int:
+    """Return the cache size in bytes for a size in MB"""
+    if cache_size > 0:
+        return cache_size * MEGABYTE
+    raise ValueError("Cache size has to be a positive number of MB")
+
+
+def split_patterns(patterns: str) -> list[str]:
+    """Split comma separated patterns"""
+    return [pattern.strip() for pattern in patterns.split(",") if pattern.strip()]
+
+
 def generate_list_schema() -> EntitySchema:
     """Provide the schema for files"""
     return EntitySchema(
@@ -90,24 +222,50 @@ def generate_list_schema() -> EntitySchema:
     )
 
 
+def generate_list_entity(file: "SFTPAttributes") -> Entity:
+    """Provide the entity of a listed file"""
+    return Entity(
+        uri=file.filename,
+        values=[
+            [file.filename],
+            [str(file.st_size)],
+            [str(file.st_uid)],
+            [str(file.st_gid)],
+            [str(file.st_mode)],
+            [str(file.st_atime)],
+            [str(file.st_mtime)],
+        ],
+    )
+
+
 def preview_results(  # noqa: PLR0913
-    ssh_client: SSHClient,
+    ssh_client: "SSHClient",
     no_subfolder: bool,
     regex: str,
     path: str,
     error_handling: str,
     max_workers: int,
+    access_check: str = METADATA,
+    listing_method: str = SFTP_LISTING,
+    depth: int = -1,
+    include_folders: list[str] | None = None,
+    exclude_folders: list[str] | None = None,
 ) -> str:
     """Preview the results of an execution"""
     retrieval = SSHRetrieval(
         ssh_client=ssh_client,
         no_subfolder=no_subfolder,
         regex=regex,
+        access_check=access_check,
+        listing_method=listing_method,
+        include_folders=include_folders,
+        exclude_folders=exclude_folders,
     )
     all_files = retrieval.list_files_parallel(
         files=[],
         context=None,
         path=path,
+        depth=depth,
         no_of_max_hits=10,
         error_handling=error_handling,
         workers=max_workers,
@@ -1,9 +1,18 @@
 """Autocompletion test suite"""
 
+import time
+
 import pytest
 from cmem_plugin_base.testing import TestPluginContext
 
-from cmem_plugin_ssh.autocompletion import DirectoryParameterType
+from cmem_plugin_ssh.autocompletion import (
+    LISTING_CACHE,
+    DirectoryParameterType,
+    find_folders,
+    listing_key,
+    open_sftp,
+)
+from cmem_plugin_ssh.connection import connection_key
 from tests.conftest import TestingEnvironment
 
 
@@ -105,3 +114,136 @@ def test_path_autocompletion_order(testing_environment: TestingEnvironment) -> N
     )
     assert "/home/testuser/volume/MoreTextFiles" in autocompletion_result[0].label
     assert "home/testuser" in autocompletion_result[-1].label
+
+
+def test_autocompletion_listing_cache(testing_environment: TestingEnvironment) -> None:
+    """Test repeated queries for a folder are answered from the listing cache"""
+    plugin = testing_environment.list_plugin
+    depends_on = [
+        plugin.hostname,
+        plugin.port,
+        plugin.username,
+        plugin.private_key,
+        plugin.password,
+        plugin.authentication_method,
+        plugin.path,
+    ]
+    key = (
+        connection_key(
+            plugin.hostname,
+            plugin.port,
+            plugin.username,
+            plugin.authentication_method,
+            plugin.private_key,
+            plugin.password,
+        ),
+        "volume",
+    )
+    LISTING_CACHE.clear()
+    autocompletion = DirectoryParameterType(url_expand="", display_name="")
+    first_result = autocompletion.autocomplete(
+        query_terms=["volume"],
+        depend_on_parameter_values=depends_on,
+        context=TestPluginContext(),
+    )
+    current_dir, folders = LISTING_CACHE.get(key) or ("", [])
+    assert current_dir == "/home/testuser/volume"
+    assert sorted(folders) == ["MoreTextFiles", "TextFiles"]
+
+    LISTING_CACHE.put(key, ("/home/testuser/volume", ["Cached"]))
+    cached_result = autocompletion.autocomplete(
+        query_terms=["volume"],
+        depend_on_parameter_values=depends_on,
+        context=TestPluginContext(),
+    )
+    assert len(cached_result) == len(first_result) - 1
+    assert cached_result[0].value == "/home/testuser/volume/Cached"
+
+    depends_on[6] = "/restricted"
+    for _ in range(2):
+        with pytest.raises(ValueError, match=r"Permission denied"):
+            autocompletion.autocomplete(
+                query_terms=["/restricted"],
+                depend_on_parameter_values=depends_on,
+                context=TestPluginContext(),
+            )
+    LISTING_CACHE.clear()
+
+
+def test_autocompletion_prefetch(testing_environment: TestingEnvironment) -> None:
+    """Test the suggested subfolders are listed in the background"""
+    plugin = testing_environment.list_plugin
+    depends_on = [
+        plugin.hostname,
+        plugin.port,
+        plugin.username,
+        plugin.private_key,
+        plugin.password,
+        plugin.authentication_method,
+        plugin.path,
+    ]
+    LISTING_CACHE.clear()
+    autocompletion = DirectoryParameterType(url_expand="", display_name="")
+    autocompletion.autocomplete(
+        query_terms=["volume"],
+        depend_on_parameter_values=depends_on,
+        context=TestPluginContext(),
+    )
+    key = listing_key(depends_on, "/home/testuser/volume/TextFiles")
+    deadline = time.monotonic() + 10
+    while LISTING_CACHE.get(key) is None and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert LISTING_CACHE.get(key) == ("/home/testuser/volume/TextFiles", [])
+
+    result = autocompletion.autocomplete(
+        query_terms=["/home/testuser/volume/TextFiles"],
+        depend_on_parameter_values=depends_on,
+        context=TestPluginContext(),
+    )
+    assert [suggestion.value for suggestion in result] == [
+        "/home/testuser/volume/TextFiles",
+        "/home/testuser/volume",
+    ]
+    LISTING_CACHE.clear()
+
+
+def test_autocompletion_folder_filter(testing_environment: TestingEnvironment) -> None:
+    """Test a partial folder name is completed with a limited folders-only listing"""
+    plugin = testing_environment.list_plugin
+    depends_on = [
+        plugin.hostname,
+        plugin.port,
+        plugin.username,
+        plugin.private_key,
+        plugin.password,
+        plugin.authentication_method,
+        plugin.path,
+    ]
+    LISTING_CACHE.clear()
+    autocompletion = DirectoryParameterType(url_expand="", display_name="")
+    result = autocompletion.autocomplete(
+        query_terms=["volume/more"],
+        depend_on_parameter_values=depends_on,
+        context=TestPluginContext(),
+    )
+    assert [suggestion.value for suggestion in result] == [
+        "/home/testuser/volume/MoreTextFiles",
+        "/home/testuser/volume",
+        "/home/testuser",
+    ]
+
+    key = listing_key(depends_on, None)[0]
+    ssh_client, sftp = open_sftp(depends_on, key)
+    try:
+        directory = "/home/testuser/volume/MoreTextFiles"
+        sftp.chdir(directory)
+        assert sorted(autocompletion.list_folders(sftp)) == ["EvenMoreFiles", "EvenMoreFiles2"]
+        assert autocompletion.list_folders(sftp, "files2") == ["EvenMoreFiles2"]
+        assert len(autocompletion.list_folders(sftp, limit=1)) == 1
+        assert find_folders(ssh_client, directory, "files2") == ["EvenMoreFiles2"]
+        assert find_folders(ssh_client, directory, "Test.txt") == []
+        assert len(find_folders(ssh_client, directory, "", limit=1) or []) == 1
+    finally:
+        sftp.close()
+        ssh_client.close()
+    LISTING_CACHE.clear()
@@ -0,0 +1,181 @@
+"""Benchmarks of listing, hit aggregation and download throughput
+
+The benchmarks are skipped unless the environment variable BENCHMARK is set and log
+their measurements, e.g. `BENCHMARK=1 pytest tests/test_benchmark.py --log-cli-level=INFO`.
+"""
+
+import logging
+import os
+import queue
+import stat
+import threading
+import time
+from pathlib import Path
+
+import pytest
+from cmem_plugin_base.testing import TestExecutionContext
+from paramiko import SFTPAttributes, SSHClient
+
+from cmem_plugin_ssh.retrieval import SSHRetrieval
+from tests.conftest import TestingEnvironment
+
+logger = logging.getLogger(__name__)
+
+pytestmark = pytest.mark.skipif(
+    not os.environ.get("BENCHMARK"), reason="set BENCHMARK to run the benchmarks"
+)
+
+BENCHMARK_DIR = "/tmp/benchmark"  # noqa: S108
+# files downloaded in parallel to measure the transfer rate
+LARGE_FILES = 8
+LARGE_FILE_MB = 16
+# a tree of 4 + 16 + 64 + 256 folders below the root, with 5 files in each folder
+TREE_FANOUT = 4
+TREE_DEPTH = 4
+TREE_FILES = 5
+HIT_WORKERS = 32
+HITS_PER_WORKER = 20000
+TREE_FOLDERS = sum(TREE_FANOUT**level for level in range(TREE_DEPTH + 1))
+SETUP_COMMAND = f"""bash -c '
+[ -f {BENCHMARK_DIR}/complete ] && exit 0
+rm -rf {BENCHMARK_DIR} && mkdir -p {BENCHMARK_DIR}/tree
+cd {BENCHMARK_DIR}/tree && mkdir -p {"/".join(["{0..3}"] * TREE_DEPTH)}
+for folder in $(find {BENCHMARK_DIR}/tree -type d); do
+  for file in $(seq {TREE_FILES}); do echo "$folder" > "$folder/file$file.txt"; done
+done
+mkdir -p {BENCHMARK_DIR}/large
+for file in $(seq {LARGE_FILES}); do
+  head -c {LARGE_FILE_MB}M /dev/urandom > {BENCHMARK_DIR}/large/file$file.bin
+done
+touch {BENCHMARK_DIR}/complete
+'"""
+
+
+@pytest.fixture
+def benchmark_tree(testing_environment: TestingEnvironment) -> str:
+    """Create the folder tree of the benchmarks on the server once, return its path"""
+    plugin = testing_environment.list_plugin
+    plugin._initialize_ssh_and_sftp_connections()  # noqa: SLF001
+    try:
+        _, stdout, stderr = plugin.ssh_client.exec_command(SETUP_COMMAND)
+        if stdout.channel.recv_exit_status() != 0:
+            pytest.fail(f"Unable to create the benchmark tree: {stderr.read().decode()}")
+    finally:
+        plugin.cleanup_ssh_connections()
+    return BENCHMARK_DIR
+
+
+def test_listing_folders_per_second(
+    testing_environment: TestingEnvironment, benchmark_tree: str
+) -> None:
+    """Measure the folders listed per second by the crawler workers"""
+    plugin = testing_environment.list_plugin
+    plugin.path = f"{benchmark_tree}/tree"
+    for workers in (1, 4, 8, 16):
+        plugin.max_workers = workers
+        start = time.perf_counter()
+        result = plugin.execute(inputs=[], context=TestExecutionContext())
+        files = len(list(result.entities))
+        elapsed = time.perf_counter() - start
+        assert files == TREE_FOLDERS * TREE_FILES
+        logger.info(
+            f"{workers:>2} workers: {TREE_FOLDERS / elapsed:7.1f} folders/s ({elapsed:.2f} s)"
+        )
+
+
+def test_throughput_per_ssh_connections(
+    testing_environment: TestingEnvironment, benchmark_tree: str, tmp_path: Path
+) -> None:
+    """Measure folders listed and megabytes downloaded per second over N SSH connections"""
+    list_plugin = testing_environment.list_plugin
+    list_plugin.path = f"{benchmark_tree}/tree"
+    list_plugin.max_workers = 16
+    download_plugin = testing_environment.download_plugin
+    download_plugin.path = f"{benchmark_tree}/large"
+    download_plugin.max_workers = LARGE_FILES
+    download_plugin.download_dir = str(tmp_path)
+    for connections in (1, 2, 4):
+        list_plugin.ssh_connections = connections
+        start = time.perf_counter()
+        files = len(list(list_plugin.execute(inputs=[], context=TestExecutionContext()).entities))
+        listing = time.perf_counter() - start
+        assert files == TREE_FOLDERS * TREE_FILES
+
+        download_plugin.ssh_connections = connections
+        start = time.perf_counter()
+        result = download_plugin.execute(inputs=[], context=TestExecutionContext())
+        files = len(list(result.entities))
+        download = time.perf_counter() - start
+        assert files == LARGE_FILES
+        logger.info(
+            f"{connections} connections: {TREE_FOLDERS / listing:7.1f} folders/s,"
+            f" {LARGE_FILES * LARGE_FILE_MB / download:6.1f} MB/s"
+        )
+
+
+class LockedRetrieval(SSHRetrieval):
+    """Retrieval counting hits under one shared lock, as before the atomic counter"""
+
+    def __init__(self):
+        super().__init__(SSHClient(), no_subfolder=False, regex=r".*\.txt")
+        self.lock = threading.Lock()
+        self.hits = 0
+
+    def add_node(
+        self,
+        results: "queue.Queue[SFTPAttributes]",
+        item: SFTPAttributes,
+        no_of_max_hits: int,
+        path: str,
+    ) -> bool:
+        """Add a matching file to the result while holding the lock"""
+        if not super().add_node(results, item, -1, path):
+            return False
+        with self.lock:
+            if no_of_max_hits != -1 and self.hits >= no_of_max_hits:
+                self.stop_event.set()
+                return False
+            self.hits += 1
+        return True
+
+
+def add_hits(retrieval: SSHRetrieval, no_of_max_hits: int) -> float:
+    """Add files from many workers at the same time, return the seconds taken"""
+    results: queue.Queue[SFTPAttributes] = queue.Queue()
+    barrier = threading.Barrier(HIT_WORKERS + 1)
+
+    def work(items: list[SFTPAttributes]) -> None:
+        barrier.wait()
+        for item in items:
+            retrieval.add_node(results, item, no_of_max_hits, "/tree")
+
+    threads = []
+    for worker in range(HIT_WORKERS):
+        items = []
+        for number in range(HITS_PER_WORKER):
+            item = SFTPAttributes()
+            item.filename = f"file{worker}-{number}.txt"
+            item.st_mode = stat.S_IFREG | 0o644
+            items.append(item)
+        threads.append(threading.Thread(target=work, args=(items,)))
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    assert results.qsize() == HIT_WORKERS * HITS_PER_WORKER
+    return elapsed
+
+
+def test_hit_aggregation() -> None:
+    """Compare adding hits with the atomic counter and with a shared lock"""
+    max_hits = HIT_WORKERS * HITS_PER_WORKER
+    counted = SSHRetrieval(SSHClient(), no_subfolder=False, regex=r".*\.txt")
+    for name, retrieval in (("atomic counter", counted), ("shared lock", LockedRetrieval())):
+        elapsed = add_hits(retrieval, max_hits)
+        logger.info(
+            f"{name:>14}: {max_hits / elapsed:9.0f} hits/s with {HIT_WORKERS} workers"
+            f" ({elapsed:.2f} s)"
+        )
@@ -0,0 +1,277 @@
+"""Connection pool test suite"""
+
+import contextlib
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import pytest
+from cmem_plugin_base.testing import TestExecutionContext
+
+from cmem_plugin_ssh.connection import (
+    SSH_CONNECTIONS,
+    SFTPChannelPool,
+    SSHConnectionPool,
+    run_probe,
+)
+from cmem_plugin_ssh.retrieval import SSHRetrieval
+from tests.conftest import TestingEnvironment
+
+if TYPE_CHECKING:
+    from paramiko import SSHClient
+
+
+def test_sftp_channel_pool(testing_environment: TestingEnvironment) -> None:
+    """Test channels are reused, bounded, replaced when dead and closed with the pool"""
+    plugin = testing_environment.list_plugin
+    plugin._initialize_ssh_and_sftp_connections()  # noqa: SLF001
+    pool = SFTPChannelPool(plugin.ssh_client, max_size=2)
+    first = pool.checkout()
+    second = pool.checkout()
+    assert pool.size == 2  # noqa: PLR2004
+
+    waiting = threading.Thread(target=lambda: pool.checkin(pool.checkout()))
+    waiting.start()
+    waiting.join(timeout=0.5)
+    assert waiting.is_alive()
+    pool.checkin(first)
+    waiting.join(timeout=5)
+    assert not waiting.is_alive()
+
+    with pool.channel() as channel:
+        assert channel is first
+    second.close()
+    pool.checkin(second)
+    assert pool.size == 1
+    with pool.channel() as channel:
+        assert channel.listdir(testing_environment.path)
+
+    pool.close()
+    assert pool.size == 0
+    assert first.sock.closed
+    with pytest.raises(ValueError, match="closed"):
+        pool.checkout()
+    plugin.cleanup_ssh_connections()
+
+
+def test_sftp_channel_pool_session_limit(testing_environment: TestingEnvironment) -> None:
+    """Test the pool limit drops to the sessions the server allows (MaxSessions 10)"""
+    plugin = testing_environment.list_plugin
+    plugin._initialize_ssh_and_sftp_connections()  # noqa: SLF001
+    pool = SFTPChannelPool(plugin.ssh_client, max_size=32)
+    clients = []
+
+    def check_out_until_refused() -> None:
+        while pool.limit == pool.max_size:
+            clients.append(pool.checkout())
+
+    thread = threading.Thread(target=check_out_until_refused)
+    thread.start()
+    thread.join(timeout=10)
+    assert thread.is_alive(), "waits for a channel after the refusal"
+    assert pool.limit < pool.max_size
+    pool.checkin(clients[0])
+    thread.join(timeout=10)
+    assert not thread.is_alive()
+    assert pool.size == pool.limit
+    pool.close()
+    for client in clients[1:]:
+        pool.checkin(client)
+    assert pool.size == 0
+    plugin.cleanup_ssh_connections()
+
+
+def test_sftp_channel_pool_fairness(testing_environment: TestingEnvironment) -> None:
+    """Test a waiting thread gets a channel while another one keeps checking out"""
+    plugin = testing_environment.list_plugin
+    plugin._initialize_ssh_and_sftp_connections()  # noqa: SLF001
+    pool = SFTPChannelPool(plugin.ssh_client, max_size=1)
+    stop = threading.Event()
+
+    def check_out_repeatedly() -> None:
+        while not stop.is_set():
+            pool.checkin(pool.checkout())
+
+    busy = threading.Thread(target=check_out_repeatedly)
+    busy.start()
+    waiting = threading.Thread(target=lambda: pool.checkin(pool.checkout()))
+    waiting.start()
+    waiting.join(timeout=5)
+    stop.set()
+    busy.join(timeout=5)
+    assert not waiting.is_alive(), "is served in order of arrival"
+    pool.close()
+    assert pool.size == 0
+    plugin.cleanup_ssh_connections()
+
+
+def test_sftp_channel_pool_transports(testing_environment: TestingEnvironment) -> None:
+    """Test channels are spread over several SSH connections and listing uses them"""
+    plugin = testing_environment.list_plugin
+    plugin.ssh_connections = 2
+    plugin._initialize_ssh_and_sftp_connections()  # noqa: SLF001
+    plugin.open_transports()
+    assert len(plugin.transports) == 1
+    pool = SFTPChannelPool(plugin.ssh_client, max_size=4, transports=plugin.transports)
+    clients = [pool.checkout() for _ in range(4)]
+    transports = []
+    for client in clients:
+        channel = client.get_channel()
+        assert channel is not None
+        transports.append(channel.get_transport())
+    for ssh_client in (plugin.ssh_client, *plugin.transports):
+        assert sum(transport is ssh_client.get_transport() for transport in transports) == 2  # noqa: PLR2004
+    for client in clients:
+        pool.checkin(client)
+    pool.close()
+    plugin.cleanup_ssh_connections()
+
+    plugin.max_workers = 4
+    result = plugin.execute(inputs=[], context=TestExecutionContext())
+    assert len(list(result.entities)) == testing_environment.no_of_files
+
+
+def test_listing_closes_channels(testing_environment: TestingEnvironment) -> None:
+    """Test all pooled channels of a listing with many workers are closed afterward"""
+    plugin = testing_environment.list_plugin
+    plugin._initialize_ssh_and_sftp_connections()  # noqa: SLF001
+    retrieval = SSHRetrieval(
+        ssh_client=plugin.ssh_client,
+        no_subfolder=plugin.no_subfolder,
+        regex=plugin.regex,
+    )
+    files = retrieval.iter_files(
+        context=TestExecutionContext(),
+        path=plugin.path,
+        workers=32,
+        error_handling=plugin.error_handling,
+        no_access_files=[],
+    )
+    assert len(list(files)) == testing_environment.no_of_files
+    assert retrieval.channels is not None
+    assert retrieval.channels.size == 0
+    plugin.cleanup_ssh_connections()
+
+
+def test_ssh_connection_reuse(testing_environment: TestingEnvironment) -> None:
+    """Test consecutive executions reuse the authenticated connection while it is healthy"""
+    plugin = testing_environment.list_plugin
+    plugin._initialize_ssh_and_sftp_connections()  # noqa: SLF001
+    first = plugin.ssh_client
+    plugin.cleanup_ssh_connections()
+    plugin.cleanup_ssh_connections()
+
+    download_plugin = testing_environment.download_plugin
+    download_plugin._initialize_ssh_and_sftp_connections()  # noqa: SLF001
+    assert download_plugin.ssh_client is first
+    plugin._initialize_ssh_and_sftp_connections()  # noqa: SLF001
+    assert plugin.ssh_client is not first
+    download_plugin.cleanup_ssh_connections()
+    plugin.cleanup_ssh_connections()
+
+    plugin.authentication_method = "password"
+    plugin._initialize_ssh_and_sftp_connections()  # noqa: SLF001
+    assert plugin.ssh_client is not first
+    plugin.cleanup_ssh_connections()
+
+    first.close()
+    plugin.authentication_method = testing_environment.authentication_method
+    plugin._initialize_ssh_and_sftp_connections()  # noqa: SLF001
+    assert plugin.ssh_client is not first
+    assert len(list(plugin.sftp.listdir(testing_environment.path))) > 0
+    plugin.cleanup_ssh_connections()
+    SSH_CONNECTIONS.clear()
+
+
+def test_ssh_connection_pool_limits(testing_environment: TestingEnvironment) -> None:
+    """Test the connections per host are capped and idle connections are closed in time"""
+    plugin = testing_environment.list_plugin
+    key = plugin.connection_key()
+    pool = SSHConnectionPool(max_per_host=2, idle_timeout=0.5, connect_wait=0.5)
+    first = pool.open(key, plugin.establish_ssh_connection)
+    second = pool.open(key, plugin.establish_ssh_connection)
+    with pytest.raises(ValueError, match="in use"):
+        pool.open(key, plugin.establish_ssh_connection)
+    pool.checkin(key, first)
+    assert pool.checkout(key) is first
+    pool.checkin(key, first)
+
+    other_key = (*key[:3], "other credentials")
+    third = pool.open(other_key, plugin.establish_ssh_connection)
+    assert not pool.is_healthy(first), "is closed to make room"
+    second.close()
+    fourth = pool.open(other_key, plugin.establish_ssh_connection)
+    pool.checkin(other_key, third)
+    pool.checkin(other_key, fourth)
+    time.sleep(1.5)
+    assert not pool.is_healthy(third), "is closed by the reaper without a further checkout"
+    assert not pool.is_healthy(fourth)
+    assert pool.checkout(other_key) is None
+
+
+def test_run_probe(testing_environment: TestingEnvironment) -> None:
+    """Test probes end commands waiting for input and give up after the timeout"""
+    plugin = testing_environment.list_plugin
+    plugin._initialize_ssh_and_sftp_connections()  # noqa: SLF001
+    start = time.monotonic()
+    assert run_probe(plugin.ssh_client, "cat && echo done", timeout=5) == b"done\n"
+    assert run_probe(plugin.ssh_client, "false", timeout=5) is None
+    assert time.monotonic() - start < 5, "stdin is closed instead of waiting"  # noqa: PLR2004
+    start = time.monotonic()
+    assert run_probe(plugin.ssh_client, "sleep 10", timeout=0.5) is None
+    assert time.monotonic() - start < 5  # noqa: PLR2004
+    plugin.cleanup_ssh_connections()
+
+
+def test_failed_tasks_check_in_connections(
+    testing_environment: TestingEnvironment, tmp_path: Path
+) -> None:
+    """Test connections are not left checked out if a task fails before it lists files"""
+    snapshot_file = tmp_path / "snapshot.json.gz"
+    snapshot_file.write_bytes(b"no snapshot")
+    for plugin in (testing_environment.list_plugin, testing_environment.download_plugin):
+        plugin.snapshot_file = str(snapshot_file)
+        plugin.ssh_connections = 2
+        with pytest.raises(ValueError, match="Unable to read snapshot file"):
+            plugin.execute(inputs=[], context=TestExecutionContext())
+        checked_out = SSH_CONNECTIONS._checked_out.get(plugin.connection_key()[:2], set())  # noqa: SLF001
+        assert not checked_out
+
+
+class SlowCounter(Counter):
+    """Counter taking its time to update, to widen the window for races"""
+
+    def __setitem__(self, key: tuple[str, int], value: int) -> None:
+        """Wait before updating the count"""
+        time.sleep(0.1)
+        super().__setitem__(key, value)
+
+
+def test_ssh_connection_pool_concurrent_opens(testing_environment: TestingEnvironment) -> None:
+    """Test concurrent opens do not exceed the connections per host"""
+    plugin = testing_environment.list_plugin
+    key = plugin.connection_key()
+    pool = SSHConnectionPool(max_per_host=2)
+    pool._connecting = SlowCounter()  # noqa: SLF001
+    start = threading.Barrier(4)
+    opened = []
+
+    def slow_connect(ssh_client: "SSHClient") -> None:
+        time.sleep(0.2)
+        plugin.establish_ssh_connection(ssh_client)
+
+    def open_connection() -> None:
+        start.wait()
+        with contextlib.suppress(ValueError):
+            opened.append(pool.open(key, slow_connect, wait=0))
+
+    threads = [threading.Thread(target=open_connection) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(opened) == 2  # noqa: PLR2004
+    for ssh_client in opened:
+        ssh_client.close()
@@ -1,11 +1,25 @@
 """Download plugin test suite"""
 
+import contextlib
+import io
+import os
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING
+
 import pytest
-from cmem_plugin_base.testing import TestExecutionContext
+from cmem_plugin_base.dataintegration.entity import Entities
+from cmem_plugin_base.testing import TestExecutionContext, TestWorkflowContext
+from paramiko import SFTPAttributes
 
+from cmem_plugin_ssh import retrieval, transfer
+from cmem_plugin_ssh.cache import TransferCache
 from cmem_plugin_ssh.download import DownloadFiles
 from cmem_plugin_ssh.retrieval import SSHRetrieval
-from tests.conftest import TestingEnvironment
+from tests.conftest import DOCKER_DIR, TestingEnvironment
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Iterator
 
 
 def test_base_execution(testing_environment: TestingEnvironment) -> None:
@@ -15,6 +29,43 @@ def test_base_execution(testing_environment: TestingEnvironment) -> None:
     assert len(list(result.entities)) == testing_environment.no_of_files
 
 
+def test_parallel_download(testing_environment: TestingEnvironment) -> None:
+    """Test download with no inputs given over several workers"""
+    plugin = testing_environment.download_plugin
+    plugin.max_workers = 4
+    result = plugin.execute(inputs=[], context=TestExecutionContext())
+    paths = [entity.values[0][0] for entity in result.entities]
+    assert len(paths) == testing_environment.no_of_files
+    assert all(Path(path).is_file() for path in paths)
+
+    plugin.error_handling = "error"
+    plugin.path = "/etc"
+    plugin.regex = testing_environment.restricted_file
+    with pytest.raises(ValueError, match=r"Permission denied"):
+        list(plugin.execute(inputs=[], context=TestExecutionContext()).entities)
+
+
+def test_parallel_download_full_result_queue(
+    testing_environment: TestingEnvironment, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test listing workers waiting for the consumer do not hold the channels of downloads"""
+    monkeypatch.setattr(retrieval, "RESULT_QUEUE_SIZE", 1)
+    plugin = testing_environment.download_plugin
+
+    def download(paths: list[str]) -> None:
+        result = plugin.execute(inputs=[], context=TestExecutionContext())
+        paths.extend(entity.values[0][0] for entity in result.entities)
+
+    for max_workers in (1, 4):
+        plugin.max_workers = max_workers
+        paths: list[str] = []
+        thread = threading.Thread(target=download, args=(paths,), daemon=True)
+        thread.start()
+        thread.join(timeout=30)
+        assert not thread.is_alive(), "does not deadlock"
+        assert len(paths) == testing_environment.no_of_files
+
+
 def test_download_restricted_file_error(testing_environment: TestingEnvironment) -> None:
     """Test download with error as error_handling"""
     plugin = testing_environment.download_plugin
@@ -22,7 +73,7 @@ def test_download_restricted_file_error(testing_environment: TestingEnvironment)
     plugin.path = "/etc"
     plugin.regex = testing_environment.restricted_file
     with pytest.raises(ValueError, match=r"Permission denied"):
-        plugin.execute(inputs=[], context=TestExecutionContext())
+        list(plugin.execute(inputs=[], context=TestExecutionContext()).entities)
 
 
 def test_download_restricted_file_warning(testing_environment: TestingEnvironment) -> None:
@@ -71,6 +122,144 @@ def test_download_with_input(testing_environment: TestingEnvironment) -> None:
     assert len(list(download_result.entities)) == testing_environment.no_of_files
 
 
+def test_parallel_download_with_input(testing_environment: TestingEnvironment) -> None:
+    """Test download with input from list plugin over several workers and cancellation"""
+    list_plugin = testing_environment.list_plugin
+    download_plugin = testing_environment.download_plugin
+    download_plugin.max_workers = 4
+    context = TestExecutionContext()
+    list_result = [list_plugin.execute(inputs=[], context=context)]
+    download_result = download_plugin.execute(inputs=list_result, context=context)
+    paths = [entity.values[0][0] for entity in download_result.entities]
+    assert len(paths) == testing_environment.no_of_files
+    assert all(Path(path).is_file() for path in paths)
+
+    listed = list_plugin.execute(inputs=[], context=context)
+    list_result = [Entities(entities=iter(list(listed.entities)), schema=listed.schema)]
+    context.workflow = TestWorkflowContext(status="Canceling")
+    download_result = download_plugin.execute(inputs=list_result, context=context)
+    assert list(download_result.entities) == []
+
+
+def test_segmented_download(testing_environment: TestingEnvironment, tmp_path: Path) -> None:
+    """Test files larger than the segment size are downloaded completely in segments"""
+    content = os.urandom(1024 * 1024 + 123)
+    plugin = testing_environment.download_plugin
+    plugin._initialize_ssh_and_sftp_connections()  # noqa: SLF001
+    remote_dir = "/tmp/segmented"  # noqa: S108
+    with contextlib.suppress(OSError):
+        plugin.sftp.mkdir(remote_dir)
+    plugin.sftp.putfo(io.BytesIO(content), f"{remote_dir}/large.bin")
+    plugin.cleanup_ssh_connections()
+
+    plugin.path = remote_dir
+    plugin.max_workers = 4
+    plugin.segment_size = 100 * 1024
+    result = plugin.execute(inputs=[], context=TestExecutionContext())
+    paths = [Path(entity.values[0][0]) for entity in result.entities]
+    assert [path.name for path in paths] == ["large.bin"]
+    assert paths[0].read_bytes() == content
+    assert list(paths[0].parent.glob("*.part")) == []
+
+    item = SFTPAttributes()
+    item.st_size = 10
+    incomplete = transfer.SegmentedFile("/tmp/short.bin", tmp_path / "short.bin", item, 4)  # noqa: S108
+    incomplete.received = 6
+    assert isinstance(incomplete.finish(), OSError), "is not complete although preallocated"
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_resumed_download(
+    testing_environment: TestingEnvironment, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test a download continues its part file over a new connection after a lost one"""
+    content = os.urandom(1024 * 1024)
+    plugin = testing_environment.download_plugin
+    plugin._initialize_ssh_and_sftp_connections()  # noqa: SLF001
+    remote_dir = "/tmp/resumed"  # noqa: S108
+    with contextlib.suppress(OSError):
+        plugin.sftp.mkdir(remote_dir)
+    remote_path = f"{remote_dir}/large.bin"
+    plugin.sftp.putfo(io.BytesIO(content), remote_path)
+    item = plugin.sftp.stat(remote_path)
+
+    monkeypatch.setattr(transfer, "RESUMABLE_SIZE", 1024)
+    part = transfer.PartFile(remote_path, tmp_path / "large.bin", len(content), item.st_mtime)
+    assert part.offset() == 0
+    part.path.write_bytes(b"x" * 1000)
+    transport = plugin.ssh_client.get_transport()
+    assert transport is not None
+    transport.close()
+    with plugin.channel_pool() as channels:
+        download = transfer.ParallelDownload(channels, tmp_path, workers=2)
+        assert dict(download.download([remote_path])) == {remote_path: tmp_path / "large.bin"}
+    assert (tmp_path / "large.bin").read_bytes() == b"x" * 1000 + content[1000:]
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["large.bin"]
+    assert len(plugin.transports) == 1, "replaces the lost connection"
+    plugin.cleanup_ssh_connections()
+
+
+@pytest.mark.parametrize("transfer_method", ["tar", "tar_gzip"])
+def test_tar_download(testing_environment: TestingEnvironment, transfer_method: str) -> None:
+    """Test download as tar stream with and without input and a file without access"""
+    plugin = testing_environment.download_plugin
+    plugin.transfer_method = transfer_method
+    plugin.max_workers = 4
+    result = plugin.execute(inputs=[], context=TestExecutionContext())
+    paths = [Path(entity.values[0][0]) for entity in result.entities]
+    assert len(paths) == testing_environment.no_of_files
+    volume = DOCKER_DIR / "volume"
+    for path in paths:
+        assert path.read_bytes() == next(volume.rglob(path.name)).read_bytes()
+
+    list_result = [
+        testing_environment.list_plugin.execute(inputs=[], context=TestExecutionContext())
+    ]
+    result = plugin.execute(inputs=list_result, context=TestExecutionContext())
+    assert len(list(result.entities)) == testing_environment.no_of_files
+
+    plugin.error_handling = "error"
+    plugin.path = "/etc"
+    plugin.regex = testing_environment.restricted_file
+    with pytest.raises(ValueError, match=r"Permission denied"):
+        list(plugin.execute(inputs=[], context=TestExecutionContext()).entities)
+
+
+@pytest.mark.parametrize("transfer_method", ["sftp", "tar"])
+def test_download_cache(
+    testing_environment: TestingEnvironment, tmp_path: Path, transfer_method: str
+) -> None:
+    """Test unchanged files are taken from the cache folder on the next execution"""
+    plugin = testing_environment.download_plugin
+    plugin.cache_dir = str(tmp_path / "cache")
+    plugin.transfer_method = transfer_method
+    plugin.max_workers = 4
+    result = plugin.execute(inputs=[], context=TestExecutionContext())
+    paths = sorted(Path(entity.values[0][0]) for entity in result.entities)
+    assert len(paths) == testing_environment.no_of_files
+    assert all(path.is_relative_to(tmp_path / "cache") for path in paths)
+    modified = [path.stat().st_mtime_ns for path in paths]
+
+    result = plugin.execute(inputs=[], context=TestExecutionContext())
+    cached = sorted(Path(entity.values[0][0]) for entity in result.entities)
+    assert cached == paths
+    assert [path.stat().st_mtime_ns for path in cached] == modified
+
+    cache = TransferCache(tmp_path / "cache", "host", max_size=10)
+    first = cache.local_path("first")
+    first.write_bytes(b"first")
+    cache.add("first", 5, 1, first)
+    cache.save()
+    cache = TransferCache(tmp_path / "cache", "host", max_size=10)
+    assert cache.lookup("first", 5, 2) is None, "is changed"
+    second = cache.local_path("second")
+    second.write_bytes(b"second")
+    cache = TransferCache(tmp_path / "cache", "host", max_size=10)
+    cache.add("second", 6, 1, second)
+    assert not first.exists(), "is evicted as least recently used"
+    assert cache.lookup("second", 6, 1) == second
+
+
 def test_download_with_input_error(testing_environment: TestingEnvironment) -> None:
     """Test input download error when a file is not permitted for download"""
     list_plugin = testing_environment.list_plugin
@@ -134,3 +323,54 @@ def test_plugin_password_authentication_only(testing_environment: TestingEnviron
         error_handling=testing_environment.error_handling,
     )
     assert plugin is not None
+
+
+def test_snapshot_saved_after_downloads(
+    testing_environment: TestingEnvironment, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """Test the snapshot is not saved if a download failed, so the file is output again"""
+    plugin = testing_environment.download_plugin
+    plugin.snapshot_file = str(tmp_path / "snapshot.json.gz")
+    plugin.changed_only = True
+    plugin.error_handling = "warning"
+    download = transfer.ParallelDownload.download
+
+    def failing_download(
+        self: transfer.ParallelDownload, remote_files: "Iterable[str | SFTPAttributes | None]"
+    ) -> "Iterator[tuple[str, Path | OSError]]":
+        for remote_path, result in download(self, remote_files):
+            failed = remote_path.endswith("RootFile.txt")
+            yield remote_path, OSError("Connection lost") if failed else result
+
+    with monkeypatch.context() as patch:
+        patch.setattr(transfer.ParallelDownload, "download", failing_download)
+        result = plugin.execute(inputs=[], context=TestExecutionContext())
+        assert len(list(result.entities)) == testing_environment.no_of_files - 1
+    assert not (tmp_path / "snapshot.json.gz").exists()
+
+    result = plugin.execute(inputs=[], context=TestExecutionContext())
+    assert len(list(result.entities)) == testing_environment.no_of_files
+    assert (tmp_path / "snapshot.json.gz").exists()
+    result = plugin.execute(inputs=[], context=TestExecutionContext())
+    assert list(result.entities) == []
+
+
+def test_tar_download_cache_hard_link(
+    testing_environment: TestingEnvironment, tmp_path: Path
+) -> None:
+    """Test a hard linked file in the tar stream is cached with its real size"""
+    plugin = testing_environment.download_plugin
+    plugin._initialize_ssh_and_sftp_connections()  # noqa: SLF001
+    remote_dir = "/tmp/hardlink"  # noqa: S108
+    _, stdout, _ = plugin.ssh_client.exec_command(
+        f"mkdir -p {remote_dir} && echo linked > {remote_dir}/first.txt"
+        f" && ln -f {remote_dir}/first.txt {remote_dir}/second.txt"
+    )
+    assert stdout.channel.recv_exit_status() == 0
+    item = plugin.sftp.stat(f"{remote_dir}/second.txt")
+    cache = TransferCache(tmp_path / "cache", "host", max_size=1024)
+    tar = transfer.TarDownload(plugin.ssh_client, tmp_path, cache=cache)
+    paths = [f"{remote_dir}/first.txt", f"{remote_dir}/second.txt"]
+    assert [path for path, _ in tar.download(paths)] == paths
+    plugin.cleanup_ssh_connections()
+    assert cache.lookup(paths[1], item.st_size, item.st_mtime) is not None
@@ -0,0 +1,43 @@
+"""Plugin import test suite"""
+
+import subprocess
+import sys
+
+ENTRY_POINTS = [
+    "cmem_plugin_ssh.list",
+    "cmem_plugin_ssh.download",
+    "cmem_plugin_ssh.upload",
+    "cmem_plugin_ssh.execute_commands",
+]
+# the plugin API of cmem-plugin-base is needed by every plugin and loaded beforehand
+PLUGIN_API = [
+    "cmem_plugin_base.dataintegration.description",
+    "cmem_plugin_base.dataintegration.entity",
+    "cmem_plugin_base.dataintegration.plugins",
+    "cmem_plugin_base.dataintegration.ports",
+    "cmem_plugin_base.dataintegration.types",
+]
+IMPORT_BUDGET = 0.5
+DEFERRED_MODULES = ["paramiko.transport", "cryptography", "cmem_client"]
+
+
+def test_plugin_import_time() -> None:
+    """Test importing the plugins for discovery loads no SSH or transfer modules"""
+    code = "\n".join(
+        [
+            "import sys, time",
+            f"import {', '.join(PLUGIN_API)}",
+            "start = time.perf_counter()",
+            f"import {', '.join(ENTRY_POINTS)}",
+            "print(time.perf_counter() - start)",
+            "print(' '.join(sys.modules))",
+        ]
+    )
+    result = subprocess.run(  # noqa: S603
+        [sys.executable, "-c", code], capture_output=True, check=True, text=True
+    )
+    import_time, modules = result.stdout.splitlines()
+    assert float(import_time) < IMPORT_BUDGET
+    loaded = set(modules.split())
+    for module in DEFERRED_MODULES:
+        assert module not in loaded
@@ -1,14 +1,20 @@
 """Tests for list plugin"""
 
 import re
+from pathlib import Path
 
 import pytest
-from cmem_plugin_base.testing import TestExecutionContext, TestPluginContext
-from paramiko import AuthenticationException
+from cmem_plugin_base.testing import (
+    TestExecutionContext,
+    TestPluginContext,
+    TestWorkflowContext,
+)
+from paramiko import AuthenticationException, Ed25519Key
 
 from cmem_plugin_ssh.autocompletion import DirectoryParameterType
 from cmem_plugin_ssh.list import ListFiles
 from cmem_plugin_ssh.retrieval import SSHRetrieval
+from cmem_plugin_ssh.utils import load_private_key
 from tests.conftest import TestingEnvironment
 
 
@@ -29,6 +35,19 @@ def test_private_key_with_wrong_password(testing_environment: TestingEnvironment
         ).execute(inputs=[], context=TestExecutionContext())
 
 
+def test_load_private_key_cached(testing_environment: TestingEnvironment) -> None:
+    """Test private keys are loaded with the loader of their type and cached"""
+    key = load_private_key(testing_environment.private_key_with_password, "wrong_password")
+    assert key is None
+    key = load_private_key(
+        testing_environment.private_key_with_password, testing_environment.password
+    )
+    assert isinstance(key, Ed25519Key)
+    assert key is load_private_key(
+        testing_environment.private_key_with_password, testing_environment.password
+    )
+
+
 def test_private_key_with_password_execution(testing_environment: TestingEnvironment) -> None:
     """Test autocompletion and base execution with a password encrypted private key"""
     plugin = ListFiles(
@@ -195,7 +214,7 @@ def test_plugin_nonexistent_directory(testing_environment: TestingEnvironment) -
     plugin = testing_environment.list_plugin
     plugin.path = "non/existent/path"
     with pytest.raises(ValueError, match=r"\[Errno 2\] No such file"):
-        plugin.execute(inputs=[], context=TestExecutionContext())
+        list(plugin.execute(inputs=[], context=TestExecutionContext()).entities)
 
 
 def test_preview_action(testing_environment: TestingEnvironment) -> None:
@@ -211,7 +230,7 @@ def test_execution_denied_permission(testing_environment: TestingEnvironment) ->
     plugin.path = "/etc"
     plugin.no_subfolder = True
     with pytest.raises(ValueError, match=r"No access to '"):
-        plugin.execute(inputs=[], context=TestExecutionContext())
+        list(plugin.execute(inputs=[], context=TestExecutionContext()).entities)
 
 
 def test_execution_warning_error_handling(testing_environment: TestingEnvironment) -> None:
@@ -284,3 +303,169 @@ def test_preview_with_warning_error_handling(testing_environment: TestingEnviron
     preview = plugin.preview_results()
     assert "entities were found that the current user has no access to" in preview
     assert "restricted.txt" in preview
+
+
+def test_iter_files_max_hits(testing_environment: TestingEnvironment) -> None:
+    """Test streamed listing stops after the maximum number of hits"""
+    plugin = testing_environment.list_plugin
+    plugin._initialize_ssh_and_sftp_connections()  # noqa: SLF001
+    retrieval = SSHRetrieval(
+        ssh_client=plugin.ssh_client,
+        no_subfolder=plugin.no_subfolder,
+        regex=plugin.regex,
+    )
+    files = retrieval.iter_files(
+        context=TestExecutionContext(),
+        path=plugin.path,
+        workers=4,
+        error_handling=plugin.error_handling,
+        no_access_files=[],
+        no_of_max_hits=3,
+    )
+    first_file = next(files)
+    assert first_file.filename.startswith("/home/testuser/volume/")
+    assert len([first_file, *files]) == 3  # noqa: PLR2004
+
+
+def test_iter_files_cancelled_workflow(testing_environment: TestingEnvironment) -> None:
+    """Test listing stops when the workflow is cancelled"""
+    plugin = testing_environment.list_plugin
+    plugin._initialize_ssh_and_sftp_connections()  # noqa: SLF001
+    retrieval = SSHRetrieval(
+        ssh_client=plugin.ssh_client,
+        no_subfolder=plugin.no_subfolder,
+        regex=plugin.regex,
+    )
+    context = TestExecutionContext()
+    files = retrieval.iter_files(
+        context=context,
+        path=plugin.path,
+        error_handling=plugin.error_handling,
+        no_access_files=[],
+    )
+    assert len(list(files)) > 1
+
+    context.workflow = TestWorkflowContext(status="Canceling")
+    files = retrieval.iter_files(
+        context=context,
+        path=plugin.path,
+        error_handling=plugin.error_handling,
+        no_access_files=[],
+    )
+    assert list(files) == []
+
+
+def test_access_check_modes(testing_environment: TestingEnvironment) -> None:
+    """Test metadata based access check finds the same files as opening each file"""
+    plugin = testing_environment.list_plugin
+    plugin._initialize_ssh_and_sftp_connections()  # noqa: SLF001
+    no_access_filenames = []
+    for access_check in ("metadata", "strict"):
+        retrieval = SSHRetrieval(
+            ssh_client=plugin.ssh_client,
+            no_subfolder=True,
+            regex=plugin.regex,
+            access_check=access_check,
+        )
+        _, no_access_files = retrieval.list_files_parallel(
+            files=[],
+            context=TestExecutionContext(),
+            path="/etc",
+            error_handling="warning",
+            no_access_files=[],
+        )
+        no_access_filenames.append(sorted(file.filename for file in no_access_files))
+    assert "/etc/sudoers" in no_access_filenames[0]
+    assert no_access_filenames[0] == no_access_filenames[1]
+
+
+def test_find_listing_method(testing_environment: TestingEnvironment) -> None:
+    """Test listing with remote find returns the same files as listing with SFTP"""
+    plugin = testing_environment.list_plugin
+    sftp_result = plugin.execute(inputs=[], context=TestExecutionContext())
+    sftp_entities = sorted((e.uri, e.values) for e in sftp_result.entities)
+
+    plugin.listing_method = "find"
+    find_result = plugin.execute(inputs=[], context=TestExecutionContext())
+    find_entities = sorted((e.uri, e.values) for e in find_result.entities)
+    assert len(find_entities) == testing_environment.no_of_files
+    assert find_entities == sftp_entities
+
+    plugin.no_subfolder = True
+    assert "RootFile.txt" in plugin.preview_results()
+
+
+def test_snapshot_changed_only(testing_environment: TestingEnvironment, tmp_path: Path) -> None:
+    """Test incremental listing with a snapshot file outputs only changed files"""
+    plugin = testing_environment.list_plugin
+    plugin.snapshot_file = str(tmp_path / "snapshot.json.gz")
+    plugin.changed_only = True
+    result_execution = plugin.execute(inputs=[], context=TestExecutionContext())
+    assert len(list(result_execution.entities)) == testing_environment.no_of_files
+    assert (tmp_path / "snapshot.json.gz").exists()
+
+    result_execution = plugin.execute(inputs=[], context=TestExecutionContext())
+    assert len(list(result_execution.entities)) == 0
+
+    plugin.changed_only = False
+    result_execution = plugin.execute(inputs=[], context=TestExecutionContext())
+    assert len(list(result_execution.entities)) == testing_environment.no_of_files
+
+
+def test_folder_depth_and_patterns(testing_environment: TestingEnvironment) -> None:
+    """Test maximum depth and folder patterns limit the listed subfolders"""
+    plugin = testing_environment.list_plugin
+    plugin.max_depth = 0
+    result_execution = plugin.execute(inputs=[], context=TestExecutionContext())
+    assert len(list(result_execution.entities)) == 1
+
+    plugin.max_depth = 1
+    result_execution = plugin.execute(inputs=[], context=TestExecutionContext())
+    assert len(list(result_execution.entities)) == 5  # noqa: PLR2004
+
+    plugin.max_depth = -1
+    plugin.exclude_folders = "TextFiles, MoreTextFiles/EvenMoreFiles2"
+    result_execution = plugin.execute(inputs=[], context=TestExecutionContext())
+    filenames = [entity.uri for entity in result_execution.entities]
+    assert len(filenames) == 4  # noqa: PLR2004
+    assert "/home/testuser/volume/MoreTextFiles/EvenMoreFiles/File.txt" in filenames
+
+    plugin.exclude_folders = ""
+    plugin.include_folders = "TextFiles"
+    result_execution = plugin.execute(inputs=[], context=TestExecutionContext())
+    assert len(list(result_execution.entities)) == 5  # noqa: PLR2004
+
+    plugin.include_folders = "MoreTextFiles/EvenMoreFiles, MoreTextFiles/*2/Missing"
+    for listing_method in ("sftp", "find"):
+        plugin.listing_method = listing_method
+        result_execution = plugin.execute(inputs=[], context=TestExecutionContext())
+        filenames = sorted(Path(entity.uri).name for entity in result_execution.entities)
+        assert filenames == ["File.txt", "File_2.txt", "File_3.md", "RootFile.txt"]
+
+    plugin.include_folders = "EvenMoreFiles2"
+    for listing_method in ("sftp", "find"):
+        plugin.listing_method = listing_method
+        result_execution = plugin.execute(inputs=[], context=TestExecutionContext())
+        filenames = sorted(Path(entity.uri).name for entity in result_execution.entities)
+        assert filenames == [
+            "Another_File_1.txt",
+            "Another_File_2.txt",
+            "Another_File_3.md",
+            "Another_File_4.txt",
+            "RootFile.txt",
+        ]
+
+    with pytest.raises(ValueError, match="Maximum depth"):
+        ListFiles(
+            hostname=testing_environment.hostname,
+            port=testing_environment.port,
+            username=testing_environment.username,
+            private_key=testing_environment.private_key,
+            password=testing_environment.password,
+            authentication_method=testing_environment.authentication_method,
+            path=testing_environment.path,
+            regex=testing_environment.regex,
+            no_subfolder=testing_environment.no_subfolder,
+            error_handling=testing_environment.error_handling,
+            max_depth=-2,
+        )